@@ -44,6 +44,9 @@ CURRENT_DIR=$(pwd)
 #python3 $CURRENT_DIR/corpus/conv_note2ref.py -f_list $CURRENT_DIR/corpus/MAESTRO-V3/list/valid.list -d_note $CURRENT_DIR/corpus/MAESTRO-V3/note -d_ref $CURRENT_DIR/corpus/MAESTRO-V3/reference
 #python3 $CURRENT_DIR/corpus/conv_note2ref.py -f_list $CURRENT_DIR/corpus/MAESTRO-V3/list/test.list -d_note $CURRENT_DIR/corpus/MAESTRO-V3/note -d_ref $CURRENT_DIR/corpus/MAESTRO-V3/reference
 
+## 4.-7. (all splits, in parallel; up-to-date files are skipped)
+#python3 $CURRENT_DIR/corpus/build_corpus.py -d_list $CURRENT_DIR/corpus/MAESTRO-V3/list -d_wav $CURRENT_DIR/corpus/MAESTRO-V3/wav -d_midi $CURRENT_DIR/corpus/MAESTRO-V3/midi -d_feature $CURRENT_DIR/corpus/MAESTRO-V3/feature -d_note $CURRENT_DIR/corpus/MAESTRO-V3/note -d_label $CURRENT_DIR/corpus/MAESTRO-V3/label -d_ref $CURRENT_DIR/corpus/MAESTRO-V3/reference -config $CURRENT_DIR/corpus/config.json -n_proc 8 -f_report $CURRENT_DIR/corpus/MAESTRO-V3/build_corpus.json
+
 # 8. make dataset
 mkdir -p $CURRENT_DIR/corpus/MAESTRO-V3/dataset
 python3 $CURRENT_DIR/corpus/make_dataset.py -f_config_in $CURRENT_DIR/corpus/config.json -f_config_out $CURRENT_DIR/corpus/MAESTRO-V3/dataset/config.json -d_dataset $CURRENT_DIR/corpus/MAESTRO-V3/dataset -d_list $CURRENT_DIR/corpus/MAESTRO-V3/list -d_feature $CURRENT_DIR/corpus/MAESTRO-V3/feature -d_label $CURRENT_DIR/corpus/MAESTRO-V3/label -n_div_train 4 -n_div_valid 1 -n_div_test 1
@@ -0,0 +1,219 @@
+#! python
+
+import os
+import argparse
+import json
+import pickle
+import sys
+import time
+import collections
+import concurrent.futures
+sys.path.append(os.getcwd())
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import conv_midi2note
+import conv_note2label
+import conv_note2ref
+
+##
+## corpus preparation (EXE-CORPUS-*.sh steps 4-7) over a process pool
+##  fe    : wav -> feature (conv_wav2fe.py)
+##  note  : midi -> note (conv_midi2note.py)
+##  label : note -> label (conv_note2label.py)
+##  ref   : note -> reference (conv_note2ref.py)
+## label/ref of a file are queued as soon as its note is written, so that the
+## stages overlap; a job is skipped when its outputs are newer than its inputs
+## a failed job is reported (label/ref of a failed note are not run), and the
+## exit status is 1 if any job failed
+##
+a_stage_all = ['fe', 'note', 'label', 'ref']
+
+AMT_worker = None
+def run_job(stage, fname, config, args):
+    # (worker process) return: stage, fname, start time, end time
+    global AMT_worker
+    time_s = time.time()
+    if stage == 'fe':
+        if AMT_worker is None:
+            import torch
+            from model import amt
+            torch.set_num_threads(args.n_thread)
+            AMT_worker = amt.AMT(config, None, None)
+        a_feature = AMT_worker.wav2feature(args.d_wav.rstrip('/')+'/'+fname+'.wav')
+        with open(args.d_feature.rstrip('/')+'/'+fname+'.pkl', 'wb') as f:
+            pickle.dump(a_feature, f, protocol=4)
+    elif stage == 'note':
+        a_note = conv_midi2note.midi2note(config, args.d_midi.rstrip('/')+'/'+fname+'.mid', verbose_flag=False)
+        conv_midi2note.note2file(a_note, args.d_note, fname)
+    elif stage == 'label':
+        a_label = conv_note2label.note2label(config, args.d_note.rstrip('/')+'/'+fname+'.json', args.offset_duration_tolerance)
+        conv_note2label.label2file(a_label, args.d_label, fname, args.label_format)
+    elif stage == 'ref':
+        conv_note2ref.note2ref(args.d_note.rstrip('/'), args.d_ref.rstrip('/'), fname)
+    return stage, fname, time_s, time.time()
+
+
+def job_files(stage, fname, args):
+    # return: [input files], [output files]
+    if stage == 'fe':
+        return [args.d_wav.rstrip('/')+'/'+fname+'.wav', args.config], \
+            [args.d_feature.rstrip('/')+'/'+fname+'.pkl']
+    elif stage == 'note':
+        return [args.d_midi.rstrip('/')+'/'+fname+'.mid', args.config], \
+            [args.d_note.rstrip('/')+'/'+fname+'.json', args.d_note.rstrip('/')+'/'+fname+'.txt']
+    elif stage == 'label':
+        return [args.d_note.rstrip('/')+'/'+fname+'.json', args.config], \
+            [args.d_label.rstrip('/')+'/'+fname+'.'+args.label_format]
+    else:
+        return [args.d_note.rstrip('/')+'/'+fname+'.txt'], \
+            [args.d_ref.rstrip('/')+'/'+fname+suffix+'.txt' for suffix in ['', '_velocity', '_mpe_16ms', '_mpe_10ms']]
+
+
+def up_to_date(a_input, a_output):
+    # all outputs exist and are not older than any input
+    if not all(os.path.exists(f) for f in a_input + a_output):
+        return False
+    return min(os.path.getmtime(f) for f in a_output) >= max(os.path.getmtime(f) for f in a_input)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d_list', help='corpus list directory')
+    parser.add_argument('-d_wav', help='wav file directory (input)')
+    parser.add_argument('-d_midi', help='midi file directory (input)')
+    parser.add_argument('-d_feature', help='feature file directory (output)')
+    parser.add_argument('-d_note', help='note file directory (output)')
+    parser.add_argument('-d_label', help='label file directory (output)')
+    parser.add_argument('-d_ref', help='reference file directory (output)')
+    parser.add_argument('-config', help='config file')
+    parser.add_argument('-split', help='corpus lists to process (train,valid,test)', default='train,valid,test')
+    parser.add_argument('-split_ref', help='corpus lists to make the reference of (valid,test)', default='valid,test')
+    parser.add_argument('-stage', help='stages to run (fe,note,label,ref)', default='fe,note,label,ref')
+    parser.add_argument('-offset_duration_tolerance', help='offset_duration_tolerance ON', action='store_true')
+    parser.add_argument('-label_format', help='label file format (npz|pkl)(npz)', default='npz')
+    parser.add_argument('-n_proc', help='number of worker processes(1)', type=int, default=1)
+    parser.add_argument('-n_thread', help='number of torch threads per worker (fe)(1)', type=int, default=1)
+    parser.add_argument('-force', help='run every job, even if its outputs are up to date', action='store_true')
+    parser.add_argument('-f_report', help='timing report file (json)', default=None)
+    args = parser.parse_args()
+
+    a_split = args.split.split(',')
+    a_split_ref = args.split_ref.split(',')
+    a_stage = args.stage.split(',')
+    for stage in a_stage:
+        if stage not in a_stage_all:
+            raise ValueError('unknown stage: '+str(stage))
+
+    print('** build_corpus: corpus preparation **')
+    print(' directory')
+    print('  corpus list       : '+str(args.d_list))
+    print('  wav      (input)  : '+str(args.d_wav))
+    print('  midi     (input)  : '+str(args.d_midi))
+    print('  feature  (output) : '+str(args.d_feature))
+    print('  note     (output) : '+str(args.d_note))
+    print('  label    (output) : '+str(args.d_label))
+    print('  reference(output) : '+str(args.d_ref))
+    print(' config file        : '+str(args.config))
+    print(' split              : '+str(a_split)+' (reference: '+str(a_split_ref)+')')
+    print(' stage              : '+str(a_stage))
+    print(' offset duration tolerance: '+str(args.offset_duration_tolerance))
+    print(' label format       : '+str(args.label_format))
+    print(' process            : '+str(args.n_proc))
+    print(' force              : '+str(args.force))
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    a_dir = {'fe': args.d_feature, 'note': args.d_note, 'label': args.d_label, 'ref': args.d_ref}
+    for stage in a_stage:
+        os.makedirs(a_dir[stage], exist_ok=True)
+
+    ## jobs
+    # (note first: label/ref of a file follow its note)
+    a_fname = []
+    for split in a_split:
+        with open(args.d_list.rstrip('/')+'/'+str(split)+'.list', 'r', encoding='utf-8') as f:
+            a_fname.extend([(split, fname.rstrip('\n')) for fname in f.readlines()])
+
+    def next_jobs(split, fname):
+        a_job = []
+        if 'label' in a_stage:
+            a_job.append(('label', split, fname))
+        if ('ref' in a_stage) and (split in a_split_ref):
+            a_job.append(('ref', split, fname))
+        return a_job
+
+    a_ready = collections.deque()
+    for split, fname in a_fname:
+        if 'note' in a_stage:
+            a_ready.append(('note', split, fname))
+        else:
+            a_ready.extend(next_jobs(split, fname))
+        if 'fe' in a_stage:
+            a_ready.append(('fe', split, fname))
+
+    a_report = {stage: {'total': 0, 'run': 0, 'skip': 0, 'failed': [], 'sec (jobs)': 0.0, 'time_s': None, 'time_e': None} for stage in a_stage}
+    for split, fname in a_fname:
+        for stage in a_stage:
+            if (stage != 'ref') or (split in a_split_ref):
+                a_report[stage]['total'] += 1
+
+    ## process pool
+    # (at most n_proc*2 jobs are queued, so that a label/ref ready later is not
+    #  stuck behind every remaining fe job)
+    time_start = time.time()
+    a_pending = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_proc) as executor:
+        while (len(a_ready) > 0) or (len(a_pending) > 0):
+            while (len(a_ready) > 0) and (len(a_pending) < args.n_proc * 2):
+                stage, split, fname = a_ready.popleft()
+                a_input, a_output = job_files(stage, fname, args)
+                if (args.force is False) and up_to_date(a_input, a_output):
+                    a_report[stage]['skip'] += 1
+                    if stage == 'note':
+                        a_ready.extendleft(reversed(next_jobs(split, fname)))
+                    continue
+                a_pending[executor.submit(run_job, stage, fname, config, args)] = (stage, split, fname)
+            if len(a_pending) == 0:
+                continue
+
+            a_done, _ = concurrent.futures.wait(a_pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in a_done:
+                stage, split, fname = a_pending.pop(future)
+                report = a_report[stage]
+                try:
+                    _, _, time_s, time_e = future.result()
+                except Exception as e:
+                    report['failed'].append(fname)
+                    print('('+stage+') failed: '+fname+' ('+split+'): '+type(e).__name__+': '+str(e))
+                    continue
+                report['run'] += 1
+                report['sec (jobs)'] += time_e - time_s
+                report['time_s'] = time_s if report['time_s'] is None else min(report['time_s'], time_s)
+                report['time_e'] = time_e if report['time_e'] is None else max(report['time_e'], time_e)
+                print('('+stage+') '+str(report['run']+report['skip']+len(report['failed']))+'/'+str(report['total'])+': '+fname+' ('+split+') sec: '+str(time_e - time_s))
+                if stage == 'note':
+                    a_ready.extendleft(reversed(next_jobs(split, fname)))
+    time_total = time.time() - time_start
+
+    ## timing report
+    # sec (jobs): sum of the job times, sec (wall): first start to last end of the stage
+    print('** report **')
+    for stage in a_stage:
+        report = a_report.pop(stage)
+        a_report[stage] = {'total': report['total'], 'run': report['run'], 'skip': report['skip'],
+                           'failed': len(report['failed']), 'failed (files)': report['failed'],
+                           'sec (jobs)': report['sec (jobs)'],
+                           'sec (wall)': 0.0 if report['time_s'] is None else report['time_e'] - report['time_s']}
+        print(' '+stage.ljust(6)+': run '+str(a_report[stage]['run'])+', skip '+str(a_report[stage]['skip'])+
+              ', failed '+str(a_report[stage]['failed'])+
+              ', sec (jobs) '+str(a_report[stage]['sec (jobs)'])+', sec (wall) '+str(a_report[stage]['sec (wall)']))
+    a_report['sec (total)'] = time_total
+    print(' sec (total): '+str(time_total))
+    if args.f_report is not None:
+        with open(args.f_report, 'w', encoding='utf-8') as f:
+            json.dump(a_report, f, ensure_ascii=False, indent=4, sort_keys=False)
+    num_failed = sum([a_report[stage]['failed'] for stage in a_stage])
+    if num_failed > 0:
+        print(' NG: '+str(num_failed)+' jobs failed')
+        sys.exit(1)
+    print('** done **')
@@ -0,0 +1,65 @@
+#! python
+
+import os
+import argparse
+import json
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conv_note2label import note2label, note2label_loop
+
+##
+## vectorized note2label() vs note2label_loop(): labels (exact match) and sec/file
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d_list', help='corpus list directory')
+    parser.add_argument('-d_note', help='note file directory (input)')
+    parser.add_argument('-config', help='config file')
+    parser.add_argument('-attribute', help='list to check (train|valid|test)(valid)', default='valid')
+    parser.add_argument('-n_file', help='number of files to check (0: all)(0)', type=int, default=0)
+    args = parser.parse_args()
+
+    print('** conv_note2label: note2label check **')
+    print(' note           : '+str(args.d_note))
+    print(' corpus list    : '+str(args.d_list)+' ('+str(args.attribute)+')')
+    print(' config file    : '+str(args.config))
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    with open(args.d_list.rstrip('/')+'/'+str(args.attribute)+'.list', 'r', encoding='utf-8') as f:
+        a_input = [fname.rstrip('\n') for fname in f.readlines()]
+    if args.n_file > 0:
+        a_input = a_input[:args.n_file]
+
+    flag_ok = True
+    a_time = {'loop': 0.0, 'vectorized': 0.0}
+    for fname in a_input:
+        f_note = args.d_note.rstrip('/')+'/'+fname+'.json'
+        with open(f_note, 'r', encoding='utf-8') as f:
+            num_note = len(json.load(f))
+        for offset_duration_tolerance_flag in [False, True]:
+            time_s = time.time()
+            a_label_loop = note2label_loop(config, f_note, offset_duration_tolerance_flag)
+            time_loop = time.time() - time_s
+            time_s = time.time()
+            a_label = note2label(config, f_note, offset_duration_tolerance_flag)
+            time_vec = time.time() - time_s
+            a_time['loop'] += time_loop
+            a_time['vectorized'] += time_vec
+
+            a_ng = [attr for attr in a_label if not np.array_equal(a_label[attr], a_label_loop[attr]) or a_label[attr].dtype != a_label_loop[attr].dtype]
+            flag_ok = flag_ok and (len(a_ng) == 0)
+            print(' '+fname+' (notes: '+str(num_note)+', offset duration tolerance: '+str(offset_duration_tolerance_flag)+')')
+            print('  sec          : '+str(time_loop)+' -> '+str(time_vec))
+            print('  mismatch     : '+str(a_ng))
+
+    print('** result ('+str(len(a_input))+' files) **')
+    print(' sec (loop)       : '+str(a_time['loop']))
+    print(' sec (vectorized) : '+str(a_time['vectorized']))
+    if flag_ok is False:
+        print(' NG')
+        sys.exit(1)
+    print(' OK')
+    print('** done **')
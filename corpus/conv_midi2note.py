@@ -196,6 +196,19 @@ def midi2note(config, f_midi, verbose_flag = False):
     return a_note_sort
 
 
+def note2file(a_note, d_note, fname):
+    # <d_note>/<fname>.json (conv_note2label.py), <d_note>/<fname>.txt (conv_note2ref.py)
+    with open(d_note.rstrip('/')+'/'+fname+'.json', 'w', encoding='utf-8') as f:
+        json.dump(a_note, f, ensure_ascii=False, indent=4, sort_keys=False)
+    with open(d_note.rstrip('/')+'/'+fname+'.txt', 'w', encoding='utf-8') as f:
+        f.write('OnsetTime\tOffsetTime\tVelocity\tMidiPitch\n')
+        for note in a_note:
+            f.write(str(note['onset'])+'\t')
+            f.write(str(note['offset'])+'\t')
+            f.write(str(note['velocity'])+'\t')
+            f.write(str(note['pitch'])+'\n')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d_list', help='corpus list directory')
@@ -243,14 +256,6 @@ if __name__ == '__main__':
                        (abs(a_note[j]['onset'] - a_note_pretty_midi[j]['onset']) > 0.01):
                         print('[error] fname: '+str(fname)+' note('+str(j)+') data mismatch')
             '''
-            with open(args.d_note.rstrip('/')+'/'+fname+'.json', 'w', encoding='utf-8') as f:
-                json.dump(a_note, f, ensure_ascii=False, indent=4, sort_keys=False)
-            with open(args.d_note.rstrip('/')+'/'+fname+'.txt', 'w', encoding='utf-8') as f:
-                f.write('OnsetTime\tOffsetTime\tVelocity\tMidiPitch\n')
-                for note in a_note:
-                    f.write(str(note['onset'])+'\t')
-                    f.write(str(note['offset'])+'\t')
-                    f.write(str(note['velocity'])+'\t')
-                    f.write(str(note['pitch'])+'\n')
+            note2file(a_note, args.d_note, fname)
 
     print('** done **')
@@ -5,7 +5,127 @@ import json
 import pickle
 import numpy as np
 
+def envelope(a_frame, a_ms, a_sharpness, hop_ms, nframe):
+    # triangular envelope of each note: frames a_frame-a_sharpness .. a_frame+a_sharpness
+    # return: note index, frame, value (float32), forward flag (frame >= a_frame) of each point in [0, nframe)
+    a_len = 2 * a_sharpness + 1
+    a_idx = np.repeat(np.arange(len(a_frame)), a_len)
+    a_j = np.arange(len(a_idx)) - np.repeat(np.cumsum(a_len) - a_len, a_len) - a_sharpness[a_idx]
+    a_f = a_frame[a_idx] + a_j
+    a_val = np.maximum(0.0, 1.0 - (np.abs(a_f * hop_ms - a_ms[a_idx]) / (a_sharpness[a_idx] * hop_ms)))
+    a_valid = (a_f >= 0) & (a_f < nframe)
+    return a_idx[a_valid], a_f[a_valid], a_val[a_valid].astype(np.float32), (a_j >= 0)[a_valid]
+
+
 def note2label(config, f_note, offset_duration_tolerance_flag):
+    # vectorized note2label_loop() (same labels; see check_note2label.py)
+    # (0) settings
+    # tolerance: 50[ms]
+    hop_ms = 1000 * config['feature']['hop_sample'] / config['feature']['sr']
+    onset_tolerance = int(50.0 / hop_ms + 0.5)
+    offset_tolerance = int(50.0 / hop_ms + 0.5)
+    num_note = config['midi']['num_note']
+
+    with open(f_note, 'r', encoding='utf-8') as f:
+        a_note = json.load(f)
+
+    # 62.5 (hop=256, fs=16000)
+    nframe_in_sec = config['feature']['sr'] / config['feature']['hop_sample']
+
+    max_offset = max([0] + [note['offset'] for note in a_note])
+    nframe = int(max_offset * nframe_in_sec + 0.5) + 1
+    a_mpe = np.zeros((nframe, num_note), dtype=bool)
+    a_onset = np.zeros((nframe, num_note), dtype=np.float32)
+    a_offset = np.zeros((nframe, num_note), dtype=np.float32)
+    a_velocity = np.zeros((nframe, num_note), dtype=np.int8)
+
+    # notes [N]
+    a_pitch = np.array([note['pitch'] for note in a_note], dtype=np.int64) - config['midi']['note_min']
+    a_onset_sec = np.array([note['onset'] for note in a_note], dtype=np.float64)
+    a_offset_sec = np.array([note['offset'] for note in a_note], dtype=np.float64)
+    a_note_velocity = np.array([note['velocity'] for note in a_note], dtype=np.int64)
+
+    a_onset_frame = (a_onset_sec * nframe_in_sec + 0.5).astype(np.int64)
+    a_onset_ms = a_onset_sec * 1000.0
+    a_onset_sharpness = np.full(len(a_note), onset_tolerance, dtype=np.int64)
+    a_offset_frame = (a_offset_sec * nframe_in_sec + 0.5).astype(np.int64)
+    a_offset_ms = a_offset_sec * 1000.0
+    a_offset_sharpness = np.full(len(a_note), offset_tolerance, dtype=np.int64)
+    if offset_duration_tolerance_flag is True:
+        a_offset_duration_tolerance = ((a_offset_ms - a_onset_ms) * 0.2 / hop_ms + 0.5).astype(np.int64)
+        a_offset_sharpness = np.maximum(a_offset_sharpness, a_offset_duration_tolerance)
+
+    # onset
+    a_idx, a_f, a_val, a_forward = envelope(a_onset_frame, a_onset_ms, a_onset_sharpness, hop_ms, nframe)
+    np.maximum.at(a_onset, (a_f, a_pitch[a_idx]), a_val)
+
+    # velocity
+    # (note2label_loop() visits the notes in order: after each onset update of a cell,
+    #  a point at/after the onset frame sets the velocity if the cell's onset is >= 0.5,
+    #  a point before the onset frame only if the velocity is still 0)
+    a_cell = a_f * num_note + a_pitch[a_idx]
+    a_order = np.lexsort((a_idx, a_cell))
+    a_cell = a_cell[a_order]
+    a_forward = a_forward[a_order]
+    a_vel = a_note_velocity[a_idx[a_order]]
+    a_pos = np.arange(len(a_cell))
+    a_start = np.ones(len(a_cell), dtype=bool)
+    a_start[1:] = a_cell[1:] != a_cell[:-1]
+    a_group = np.cumsum(a_start) - 1
+    a_first = np.flatnonzero(a_start)
+    # onset >= 0.5 so far (within the cell)
+    a_half = a_val[a_order] >= 0.5
+    a_count = np.cumsum(a_half)
+    a_on = (a_count - (a_count - a_half)[a_first][a_group]) > 0
+    # last point at/after the onset frame, then the first later nonzero point before the onset frame
+    a_set = a_on & a_forward
+    a_last = np.full(len(a_first), -1, dtype=np.int64)
+    np.maximum.at(a_last, a_group[a_set], a_pos[a_set])
+    a_fill = a_on & (~a_forward) & (a_vel != 0) & (a_pos > a_last[a_group])
+    a_fill_first = np.full(len(a_first), len(a_cell), dtype=np.int64)
+    np.minimum.at(a_fill_first, a_group[a_fill], a_pos[a_fill])
+    a_vel_last = np.where(a_last >= 0, a_vel[np.maximum(a_last, 0)], 0)
+    a_vel_fill = np.where(a_fill_first < len(a_cell), a_vel[np.minimum(a_fill_first, len(a_cell) - 1)], 0)
+    a_velocity.reshape(-1)[a_cell[a_first]] = np.where(a_vel_last != 0, a_vel_last, a_vel_fill)
+
+    # mpe
+    a_valid = a_onset_frame <= a_offset_frame
+    a_mpe_count = np.zeros((nframe+1, num_note), dtype=np.int32)
+    np.add.at(a_mpe_count, (a_onset_frame[a_valid], a_pitch[a_valid]), 1)
+    np.add.at(a_mpe_count, (a_offset_frame[a_valid]+1, a_pitch[a_valid]), -1)
+    a_mpe[:] = np.cumsum(a_mpe_count, axis=0)[:nframe] > 0
+
+    # offset
+    # (no offset for a note whose offset is the onset of a note of the same pitch)
+    a_offset_flag = np.ones(len(a_note), dtype=bool)
+    for pitch in np.unique(a_pitch):
+        a_note_pitch = np.flatnonzero(a_pitch == pitch)
+        a_onset_pitch = np.sort(a_onset_sec[a_note_pitch])
+        a_search = np.minimum(np.searchsorted(a_onset_pitch, a_offset_sec[a_note_pitch]), len(a_onset_pitch) - 1)
+        a_offset_flag[a_note_pitch] = a_onset_pitch[a_search] != a_offset_sec[a_note_pitch]
+
+    a_note_offset = np.flatnonzero(a_offset_flag)
+    a_idx, a_f, a_val, _ = envelope(a_offset_frame[a_note_offset], a_offset_ms[a_note_offset], a_offset_sharpness[a_note_offset], hop_ms, nframe)
+    np.maximum.at(a_offset, (a_f, a_pitch[a_note_offset][a_idx]), a_val)
+
+    # (5-2) output label file
+    # mpe        : 0 or 1 (bool)
+    # onset      : 0.0-1.0 (float32)
+    # offset     : 0.0-1.0 (float32)
+    # velocity   : 0 - 127 (int8)
+    # [nframe, num_note] arrays (older label files hold nested lists, see make_dataset.py load_label())
+    a_label = {
+        'mpe': a_mpe,
+        'onset': a_onset,
+        'offset': a_offset,
+        'velocity': a_velocity
+    }
+
+    return a_label
+
+
+def note2label_loop(config, f_note, offset_duration_tolerance_flag):
+    # per-note/per-frame loops (reference of note2label())
     # (0) settings
     # tolerance: 50[ms]
     hop_ms = 1000 * config['feature']['hop_sample'] / config['feature']['sr']
@@ -96,19 +216,29 @@ def note2label(config, f_note, offset_duration_tolerance_flag):
                     a_offset[offset_frame-j][pitch] = max(a_offset[offset_frame-j][pitch],  offset_val)
                     
     # (5-2) output label file
-    # mpe        : 0 or 1
-    # onset      : 0.0-1.0
-    # offset     : 0.0-1.0
-    # velocity   : 0 - 127
+    # mpe        : 0 or 1 (bool)
+    # onset      : 0.0-1.0 (float32)
+    # offset     : 0.0-1.0 (float32)
+    # velocity   : 0 - 127 (int8)
+    # [nframe, num_note] arrays (older label files hold nested lists, see make_dataset.py load_label())
     a_label = {
-        'mpe': a_mpe.tolist(),
-        'onset': a_onset.tolist(),
-        'offset': a_offset.tolist(),
-        'velocity': a_velocity.tolist()
+        'mpe': a_mpe,
+        'onset': a_onset,
+        'offset': a_offset,
+        'velocity': a_velocity
     }
 
     return a_label
 
+
+def label2file(a_label, d_label, fname, fmt='npz'):
+    # <d_label>/<fname>.npz (npz: compressed arrays) | <d_label>/<fname>.pkl (pkl: pickled arrays)
+    if fmt == 'npz':
+        np.savez_compressed(d_label.rstrip('/')+'/'+fname+'.npz', **a_label)
+    else:
+        with open(d_label.rstrip('/')+'/'+fname+'.pkl', 'wb') as f:
+            pickle.dump(a_label, f, protocol=4)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d_list', help='corpus list directory')
@@ -116,6 +246,7 @@ if __name__ == '__main__':
     parser.add_argument('-d_label', help='label file directory (output)')
     parser.add_argument('-config', help='config file')
     parser.add_argument('-offset_duration_tolerance', help='offset_duration_tolerance ON', action='store_true')
+    parser.add_argument('-format', help='label file format (npz: compressed arrays|pkl: pickled arrays)(npz)', default='npz')
     args = parser.parse_args()
 
     print('** conv_note2label: convert note to label **')
@@ -125,6 +256,7 @@ if __name__ == '__main__':
     print('  corpus list   : '+str(args.d_list))
     print(' config file    : '+str(args.config))
     print(' offset duration tolerance: '+str(args.offset_duration_tolerance))
+    print(' format         : '+str(args.format))
 
     # read config file
     with open(args.config, 'r', encoding='utf-8') as f:
@@ -147,7 +279,6 @@ if __name__ == '__main__':
             # convert note to label
             a_label = note2label(config, args.d_note.rstrip('/')+'/'+fname+'.json', args.offset_duration_tolerance)
 
-            with open(args.d_label.rstrip('/')+'/'+fname+'.pkl', 'wb') as f:
-                pickle.dump(a_label, f, protocol=4)
+            label2file(a_label, args.d_label, fname, args.format)
 
     print('** done **')
@@ -7,6 +7,7 @@ import sys
 import os
 sys.path.append(os.getcwd())
 from model import amt
+from model import feature_cache
 
 
 if __name__ == '__main__':
@@ -16,6 +17,10 @@ if __name__ == '__main__':
     parser.add_argument('-d_wav', help='wav file directory (input)')
     parser.add_argument('-d_feature', help='feature file directory (output)')
     parser.add_argument('-config', help='config file')
+    parser.add_argument('-d_cache', help='feature cache directory (no cache if not set)', default=None)
+    parser.add_argument('-cache_size', help='maximum size of the feature cache in GB (no limit if not set)', type=float, default=None)
+    parser.add_argument('-cache_dtype', help='dtype of the cached feature (float32|float16)', default='float32')
+    parser.add_argument('-batch', help='number of files converted in one call(1)', type=int, default=1)
     args = parser.parse_args()
 
     print('** conv_wav2fe: convert wav to feature **')
@@ -24,13 +29,22 @@ if __name__ == '__main__':
     print('  feature (output): '+str(args.d_feature))
     print('  corpus list     : '+str(args.d_list))
     print(' config file      : '+str(args.config))
+    print(' feature cache    : '+str(args.d_cache))
+    print(' batch            : '+str(args.batch))
 
     # read config file
     with open(args.config, 'r', encoding='utf-8') as f:
         config = json.load(f)
 
+    # feature cache
+    if args.d_cache is not None:
+        cache_size = None if args.cache_size is None else int(args.cache_size * (1 << 30))
+        cache = feature_cache.Feature_Cache(args.d_cache, config, max_size=cache_size, dtype=args.cache_dtype)
+    else:
+        cache = None
+
     # AMT class
-    AMT = amt.AMT(config, None, None)
+    AMT = amt.AMT(config, None, None, feature_cache=cache)
 
     a_attribute = [
         # 'train',
@@ -42,15 +56,21 @@ if __name__ == '__main__':
         with open(args.d_list.rstrip('/') + '/' + str(attribute) + '.list', 'r', encoding='utf-8') as f:
             a_input = f.readlines()
 
-        for i in range(len(a_input)):
+        for i in range(0, len(a_input), args.batch):
             # try:
-            fname = a_input[i].rstrip('\n')
-            print(fname)
+            a_fname = [fname.rstrip('\n') for fname in a_input[i:i+args.batch]]
+            for fname in a_fname:
+                print(fname)
 
             # convert wav to feature
-            a_feature = AMT.wav2feature(args.d_wav.rstrip('/') + '/' + fname + '.wav')
-            with open(args.d_feature.rstrip('/') + '/' + fname + '.pkl', 'wb') as f:
-                pickle.dump(a_feature, f, protocol=4)
+            # (files of the same sample rate share one mel spectrogram call)
+            if args.batch > 1:
+                a_feature_batch = AMT.wav2feature_batch([args.d_wav.rstrip('/') + '/' + fname + '.wav' for fname in a_fname])
+            else:
+                a_feature_batch = [AMT.wav2feature(args.d_wav.rstrip('/') + '/' + a_fname[0] + '.wav')]
+            for fname, a_feature in zip(a_fname, a_feature_batch):
+                with open(args.d_feature.rstrip('/') + '/' + fname + '.pkl', 'wb') as f:
+                    pickle.dump(a_feature, f, protocol=4)
             # except RuntimeError as e:
             #     print('RuntimeError: ' + str(e))
             #     pass
@@ -6,237 +6,220 @@ import argparse
 import numpy as np
 import json
 import pickle
-
-def make_dataset(filelist, attribute, d_feature, d_label, d_dataset, config, n_div):
+from multiprocessing import Pool
+
+##
+## output arrays (one set per division)
+##  idx           : [total_num_idx] first frame of each window
+##  feature       : [total_num_frame, mel_bins]
+##  label_mpe     : [total_num_frame, num_note] (bool)
+##  label_onset   : [total_num_frame, num_note]
+##  label_offset  : [total_num_frame, num_note]
+##  label_velocity: [total_num_frame, num_note] (int8)
+## the files are concatenated after margin_b frames, each followed by
+## margin_f+num_frame-1 padding frames
+##
+## fmt
+##  pkl: pickled numpy array (loaded as a whole by training/dataset.py)
+##  npy: .npy file (memory-mapped by training/dataset.py)
+## <d_dataset>/<attribute>.json (format and layout) is written last, so that
+## training/dataset.py never reads the files of an interrupted run
+##
+class Npy_Writer():
+    # .npy file written block by block, without holding the array in memory
+    # (the header is written again with the number of rows at close())
+    def __init__(self, f_out, dtype, shape_row):
+        self.f_out = f_out
+        self.dtype = np.dtype(dtype)
+        self.shape_row = tuple(shape_row)
+        self.n_row = 0
+        self.f = open(f_out, 'wb')
+        # (an upper bound of the shape reserves the length of the header)
+        self.len_header = self.write_header(10**12)
+
+    def write_header(self, n_row):
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False,
+                       'shape': (n_row,) + self.shape_row})
+        header = header.ljust(128 - len(np.lib.format.MAGIC_PREFIX) - 4 - 1) + '\n'
+        self.f.write(np.lib.format.magic(1, 0) + np.array(len(header), dtype='<u2').tobytes() + header.encode('latin1'))
+        return self.f.tell()
+
+    def write(self, a_block):
+        a_block = np.ascontiguousarray(a_block, dtype=self.dtype)
+        assert a_block.shape[1:] == self.shape_row
+        self.f.write(a_block.tobytes())
+        self.n_row += a_block.shape[0]
+
+    def close(self):
+        self.f.seek(0)
+        assert self.write_header(self.n_row) == self.len_header
+        self.f.close()
+
+
+class Dataset_Writer():
+    # arrays of one division (<attribute> or <attribute>_<div>), written file by file
+    def __init__(self, d_dataset, name, config, fmt):
+        self.d_dataset = d_dataset
+        self.name = name
+        self.config = config
+        self.fmt = fmt
+        if os.path.exists(d_dataset+'/'+name+'.json'):
+            os.remove(d_dataset+'/'+name+'.json')
+        if config['feature']['log_offset'] > 0.0:
+            zero_value = np.log(config['feature']['log_offset'])
+        else:
+            zero_value = config['feature']['log_offset']
+        # (normalized features are padded with 0)
+        self.pad_feature = 0.0 if config['input']['max_value'] > 0.0 else zero_value
+        self.n_pad = config['input']['margin_f'] + config['input']['num_frame'] - 1
+
+        n_note = config['midi']['num_note']
+        self.a_writer = {
+            'idx': Npy_Writer(d_dataset+'/idx/'+name+'.npy', np.int32, []),
+            'feature': Npy_Writer(d_dataset+'/feature/'+name+'.npy', np.float32, [config['feature']['mel_bins']]),
+            'label_mpe': Npy_Writer(d_dataset+'/label_mpe/'+name+'.npy', bool, [n_note]),
+            'label_onset': Npy_Writer(d_dataset+'/label_onset/'+name+'.npy', np.float32, [n_note]),
+            'label_offset': Npy_Writer(d_dataset+'/label_offset/'+name+'.npy', np.float32, [n_note]),
+            'label_velocity': Npy_Writer(d_dataset+'/label_velocity/'+name+'.npy', np.int8, [n_note])
+        }
+        self.a_file = []
+        self.write_pad(config['input']['margin_b'])
+
+    def write_pad(self, n_frame):
+        self.a_writer['feature'].write(np.full([n_frame, self.config['feature']['mel_bins']], self.pad_feature, dtype=np.float32))
+        for attr in ['label_mpe', 'label_onset', 'label_offset', 'label_velocity']:
+            self.a_writer[attr].write(np.zeros([n_frame, self.config['midi']['num_note']], dtype=self.a_writer[attr].dtype))
+
+    def add(self, fname, num_frame, a_feature, a_label):
+        # a_feature: [num_frame_feature, mel_bins] (normalized), a_label: {'mpe', 'onset', 'offset', 'velocity'}
+        loc_d = self.a_writer['feature'].n_row
+        self.a_file.append({'fname': fname, 'loc': loc_d, 'num_frame': num_frame})
+        self.a_writer['idx'].write(np.arange(loc_d, loc_d + num_frame))
+
+        a_block = np.full([num_frame, self.config['feature']['mel_bins']], self.pad_feature, dtype=np.float32)
+        a_block[:len(a_feature)] = a_feature
+        self.a_writer['feature'].write(a_block)
+        for attr in ['mpe', 'onset', 'offset', 'velocity']:
+            a_block = np.zeros([num_frame, self.config['midi']['num_note']], dtype=self.a_writer['label_'+attr].dtype)
+            a_block[:len(a_label[attr])] = a_label[attr]
+            self.a_writer['label_'+attr].write(a_block)
+        self.write_pad(self.n_pad)
+
+    def close(self):
+        for attr in self.a_writer:
+            self.a_writer[attr].close()
+        print(' '+self.name+': total_num_frame '+str(self.a_writer['feature'].n_row)+', files '+str(len(self.a_file)))
+
+        if self.fmt != 'npy':
+            # (one array in memory at a time)
+            for attr in self.a_writer:
+                f_npy = self.a_writer[attr].f_out
+                with open(os.path.splitext(f_npy)[0]+'.pkl', 'wb') as f:
+                    pickle.dump(np.load(f_npy), f, protocol=4)
+                os.remove(f_npy)
+
+        a_header = {
+            'format': self.fmt,
+            'margin_b': self.config['input']['margin_b'],
+            'margin_f': self.config['input']['margin_f'],
+            'num_frame': self.config['input']['num_frame'],
+            'total_num_frame': self.a_writer['feature'].n_row,
+            'total_num_idx': self.a_writer['idx'].n_row,
+            'file': self.a_file
+        }
+        with open(self.d_dataset+'/'+self.name+'.json', 'w', encoding='utf-8') as f:
+            json.dump(a_header, f, ensure_ascii=False, indent=4, sort_keys=False)
+
+
+def load_label(d_label, fname):
+    # <fname>.npz (conv_note2label.py) | <fname>.pkl (pickled arrays, or nested lists of older label files)
+    # return: {'mpe': bool, 'onset': float32, 'offset': float32, 'velocity': int8} [num_frame_label, num_note]
+    a_dtype = {'mpe': bool, 'onset': np.float32, 'offset': np.float32, 'velocity': np.int8}
+    f_npz = d_label + '/' + fname + '.npz'
+    if os.path.exists(f_npz):
+        with np.load(f_npz) as label_tmp:
+            return {attr: label_tmp[attr].astype(a_dtype[attr], copy=False) for attr in a_dtype}
+    with open(d_label + '/' + fname + '.pkl', 'rb') as f:
+        label_tmp = pickle.load(f)
+    return {attr: np.asarray(label_tmp[attr], dtype=a_dtype[attr]) for attr in a_dtype}
+
+
+def load_file(job):
+    # job: (fname, d_feature, d_label, config)
+    # return: (fname, num_frame, a_feature, a_label) | (fname, None, None, None) without the feature file
+    fname, d_feature, d_label, config = job
+    feature_fname = d_feature + '/' + fname + '.pkl'
+    if not os.path.exists(feature_fname):
+        return fname, None, None, None
+    with open(feature_fname, 'rb') as f:
+        a_feature = pickle.load(f)
+    # (torch.Tensor from AMT.wav2feature(), as written by conv_wav2fe.py)
+    if hasattr(a_feature, 'numpy'):
+        a_feature = a_feature.numpy()
+    a_feature = np.asarray(a_feature, dtype=np.float32)
+    a_label = load_label(d_label, fname)
+
+    num_frame_feature = a_feature.shape[0]
+    num_frame_label = len(a_label['mpe'])
+    if num_frame_feature < num_frame_label:
+        print('(warning) ' + str(fname) + ': num_frame_feature(' + str(num_frame_feature) + ') < num_frame_label(' + str(num_frame_label) + ')')
+    num_frame = max(num_frame_feature, num_frame_label)
+
+    if config['input']['max_value'] > 0.0:
+        a_feature = (a_feature - config['input']['min_value']) / (config['input']['max_value'] - config['input']['min_value'])
+    return fname, num_frame, a_feature, a_label
+
+
+def make_dataset(filelist, attribute, d_feature, d_label, d_dataset, config, n_div, fmt='pkl', n_proc=1):
+    # single pass: each feature/label file is read once (n_proc processes, in list order)
+    # and appended to the arrays of its division
     print('-'+str(attribute)+'-')
     div_flag = False
     if n_div > 1:
         div_flag = True
 
-    # make fname list
-    a_fname = []
-    a_num_frame = []
-    a_total_num_frame = []
-    a_total_num_frame_idx = []
-    for div in range(n_div):
-        a_fname.append([])
-        a_num_frame.append([])
-        a_total_num_frame.append(config['input']['margin_b'])
-        a_total_num_frame_idx.append(0)
-
+    # (the division of a file is decided by its line number, comment lines included)
+    a_job = []
+    a_div = []
     with open(filelist, 'r', encoding='utf-8') as f:
         a_fname_all = f.readlines()
     for i in range(len(a_fname_all)):
         fname = a_fname_all[i].rstrip('\n')
         if fname.startswith('#'):
             continue
-        div = 0
-        if div_flag is True:
-            div = i % n_div
-        a_fname[div].append(fname)
-
-        # num frame
-        feature_fname = d_feature + '/' + fname + '.pkl'
-        if os.path.exists(feature_fname):
-            with open(feature_fname, 'rb') as f:
-                feature_tmp = pickle.load(f)
-            num_frame_feature = feature_tmp.shape[0]
-            del feature_tmp
-            with open(d_label + '/' + fname + '.pkl', 'rb') as f:
-                label_tmp = pickle.load(f)
-            num_frame_label = len(label_tmp['mpe'])
-            del label_tmp
-
-            if num_frame_feature < num_frame_label:
-                print('(warning) ' + str(fname) + ': num_frame_feature(' + str(num_frame_feature) + ') < num_frame_label(' + str(num_frame_label) + ')')
-            num_frame = max(num_frame_feature, num_frame_label)
-
-            a_num_frame[div].append(num_frame)
-            a_total_num_frame[div] += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-            a_total_num_frame_idx[div] += num_frame
-
+        a_job.append((fname, d_feature, d_label, config))
+        a_div.append(i % n_div if div_flag is True else 0)
     del a_fname_all
 
-    if div_flag is True:
-        for div in range(n_div):
-            print('total_num_frame['+str(div).zfill(3)+']: '+str(a_total_num_frame[div]))
-            print(a_fname[div])
-    else:
-        print('total_num_frame     : '+str(a_total_num_frame[0]))
-        print(a_fname[0])
-
-    ## idx
-    print('** idx **')
+    a_dataset = []
     for div in range(n_div):
-        print('div: '+str(div)+'/'+str(n_div))
-        a_dataset_idx = np.zeros(a_total_num_frame_idx[div], dtype=np.int32)
-
-        loc_i = 0
-        loc_d = config['input']['margin_b']
-        for i in range(len(a_fname[div])):
-            print('(idx) ' + str(i) + '/' + str(len(a_fname[div])) + ': ' + str(a_fname[div][i]))
-
-            num_frame = a_num_frame[div][i]
-            a_dataset_idx[loc_i:loc_i + num_frame] = np.arange(loc_d, loc_d + num_frame)
-            loc_i += num_frame
-            loc_d += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-
         if div_flag is True:
-            fi = open(d_dataset + '/idx/' + attribute + '_' + str(div).zfill(3) + '.pkl', 'wb')
+            a_dataset.append(Dataset_Writer(d_dataset, attribute + '_' + str(div).zfill(3), config, fmt))
         else:
-            fi = open(d_dataset + '/idx/' + attribute + '.pkl', 'wb')
-
-        pickle.dump(a_dataset_idx, fi, protocol=4)
-        fi.close()
-        del a_dataset_idx
-
-    ## feature
-    print('** feature **')
-    if config['feature']['log_offset'] > 0.0:
-        zero_value = np.log(config['feature']['log_offset'])
+            a_dataset.append(Dataset_Writer(d_dataset, attribute, config, fmt))
+
+    def add_file(k, result):
+        fname, num_frame, a_feature, a_label = result
+        if num_frame is None:
+            print('(skip) ' + str(k) + '/' + str(len(a_job)) + ': ' + str(fname) + ' (no feature file)')
+            return
+        print('(dataset) ' + str(k) + '/' + str(len(a_job)) + ': ' + str(fname) + ' div: ' + str(a_div[k]) + ' num_frame: ' + str(num_frame))
+        a_dataset[a_div[k]].add(fname, num_frame, a_feature, a_label)
+
+    if n_proc > 1:
+        with Pool(n_proc) as pool:
+            # (a few files ahead of the writer at most)
+            n_ahead = n_proc * 2
+            for k_s in range(0, len(a_job), n_ahead):
+                for k, result in enumerate(pool.imap(load_file, a_job[k_s:k_s + n_ahead]), k_s):
+                    add_file(k, result)
     else:
-        zero_value = config['feature']['log_offset']
-    for div in range(n_div):
-        print('div: ' + str(div) + '/' + str(n_div))
-        if config['input']['max_value'] > 0.0:
-            a_dataset_feature = np.zeros([a_total_num_frame[div], config['feature']['mel_bins']], dtype=np.float32)
-        else:
-            a_dataset_feature = np.full([a_total_num_frame[div], config['feature']['mel_bins']], zero_value, dtype=np.float32)
-
-        loc_d = config['input']['margin_b']
-        for i in range(len(a_fname[div])):
-            print('(feature) '+str(i)+'/'+str(len(a_fname[div]))+': '+str(a_fname[div][i]))
-
-            num_frame = a_num_frame[div][i]
-            with open(d_feature+'/' + a_fname[div][i] + '.pkl', 'rb') as f:
-                feature_tmp = pickle.load(f)
-            num_frame_feature = feature_tmp.shape[0]
-            if config['input']['max_value'] > 0.0:
-                a_dataset_feature[loc_d:loc_d+num_frame_feature] = (feature_tmp - config['input']['min_value']) / (config['input']['max_value'] - config['input']['min_value'])
-            else:
-                a_dataset_feature[loc_d:loc_d+num_frame_feature] = feature_tmp
-            del feature_tmp
-
-            loc_d += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-
-        if div_flag is True:
-            ff = open(d_dataset + '/feature/' + attribute + '_' + str(div).zfill(3) + '.pkl', 'wb')
-        else:
-            ff = open(d_dataset + '/feature/' + attribute + '.pkl', 'wb')
-
-        pickle.dump(a_dataset_feature, ff, protocol=4)
-        ff.close()
-        del a_dataset_feature
-
-    ## label
-    print('** label(mpe) **')
-    for div in range(n_div):
-        print('div: '+str(div)+'/'+str(n_div))
-        a_dataset_label_mpe = np.zeros([a_total_num_frame[div], config['midi']['num_note']], dtype=bool)
-
-        loc_d = config['input']['margin_b']
-        for i in range(len(a_fname[div])):
-            print('(label(mpe)) '+str(i)+'/'+str(len(a_fname[div]))+': '+str(a_fname[div][i]))
-            num_frame = a_num_frame[div][i]
-
-            with open(d_label+'/'+a_fname[div][i]+'.pkl', 'rb') as f:
-                label_tmp = pickle.load(f)
-            num_frame_label = len(label_tmp['mpe'])
-            a_dataset_label_mpe[loc_d:loc_d+num_frame_label] = label_tmp['mpe'][:]
-            del label_tmp
-
-            loc_d += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-
-        if div_flag is True:
-            fl_mpe = open(d_dataset+'/label_mpe/'+attribute+'_'+str(div).zfill(3)+'.pkl', 'wb')
-        else:
-            fl_mpe = open(d_dataset+'/label_mpe/'+attribute+'.pkl', 'wb')
-
-        pickle.dump(a_dataset_label_mpe, fl_mpe, protocol=4)
-        fl_mpe.close()
-        del a_dataset_label_mpe
-
-    print('** label(onset) **')
-    for div in range(n_div):
-        print('div: '+str(div)+'/'+str(n_div))
-        a_dataset_label_onset = np.zeros([a_total_num_frame[div], config['midi']['num_note']], dtype=np.float32)
-
-        loc_d = config['input']['margin_b']
-        for i in range(len(a_fname[div])):
-            print('(label(onset)) '+str(i)+'/'+str(len(a_fname[div]))+': '+str(a_fname[div][i]))
-            num_frame = a_num_frame[div][i]
-
-            with open(d_label+'/'+a_fname[div][i]+'.pkl', 'rb') as f:
-                label_tmp = pickle.load(f)
-            num_frame_label = len(label_tmp['mpe'])
-            a_dataset_label_onset[loc_d:loc_d+num_frame_label] = label_tmp['onset'][:]
-            del label_tmp
-
-            loc_d += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-
-        if div_flag is True:
-            fl_onset = open(d_dataset+'/label_onset/'+attribute+'_'+str(div).zfill(3)+'.pkl', 'wb')
-        else:
-            fl_onset = open(d_dataset+'/label_onset/'+attribute+'.pkl', 'wb')
-
-        pickle.dump(a_dataset_label_onset, fl_onset, protocol=4)
-        fl_onset.close()
-        del a_dataset_label_onset
-
-    print('** label(offset) **')
-    for div in range(n_div):
-        print('div: ' + str(div) + '/' + str(n_div))
-        a_dataset_label_offset = np.zeros([a_total_num_frame[div], config['midi']['num_note']], dtype=np.float32)
-
-        loc_d = config['input']['margin_b']
-        for i in range(len(a_fname[div])):
-            print('(label(offset)) ' + str(i) + '/' + str(len(a_fname[div])) + ': ' + str(a_fname[div][i]))
-            num_frame = a_num_frame[div][i]
-
-            with open(d_label + '/' + a_fname[div][i]+'.pkl', 'rb') as f:
-                label_tmp = pickle.load(f)
-            num_frame_label = len(label_tmp['mpe'])
-            a_dataset_label_offset[loc_d:loc_d + num_frame_label] = label_tmp['offset'][:]
-            del label_tmp
-
-            loc_d += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-
-        if div_flag is True:
-            fl_offset = open(d_dataset + '/label_offset/' + attribute + '_' + str(div).zfill(3) + '.pkl', 'wb')
-        else:
-            fl_offset = open(d_dataset + '/label_offset/' + attribute + '.pkl', 'wb')
-
-        pickle.dump(a_dataset_label_offset, fl_offset, protocol=4)
-        fl_offset.close()
-        del a_dataset_label_offset
-
-    print('** label(velocity) **')
-    for div in range(n_div):
-        print('div: ' + str(div) + '/' + str(n_div))
-        a_dataset_label_velocity = np.zeros([a_total_num_frame[div], config['midi']['num_note']], dtype=np.int8)
-
-        loc_d = config['input']['margin_b']
-        for i in range(len(a_fname[div])):
-            print('(label(velocity)) ' + str(i) + '/' + str(len(a_fname[div])) + ': ' + str(a_fname[div][i]))
-            num_frame = a_num_frame[div][i]
-
-            with open(d_label + '/' + a_fname[div][i] + '.pkl', 'rb') as f:
-                label_tmp = pickle.load(f)
-            num_frame_label = len(label_tmp['mpe'])
-            a_dataset_label_velocity[loc_d:loc_d + num_frame_label] = label_tmp['velocity'][:]
-            del label_tmp
-
-            loc_d += num_frame + config['input']['margin_f'] + config['input']['num_frame'] - 1
-
-        if div_flag is True:
-            fl_velocity = open(d_dataset + '/label_velocity/' + attribute + '_' + str(div).zfill(3) + '.pkl', 'wb')
-        else:
-            fl_velocity = open(d_dataset + '/label_velocity/' + attribute + '.pkl', 'wb')
-
-        pickle.dump(a_dataset_label_velocity, fl_velocity, protocol=4)
-        fl_velocity.close()
-        del a_dataset_label_velocity
+        for k, job in enumerate(a_job):
+            add_file(k, load_file(job))
 
+    for dataset in a_dataset:
+        dataset.close()
     return
 
 
@@ -252,6 +235,8 @@ if __name__ == '__main__':
     parser.add_argument('-n_div_valid', help='number of dataset division (valid)', type=int, default=1)
     parser.add_argument('-n_div_test', help='number of dataset division (test)', type=int, default=1)
     parser.add_argument('-max_value', help='max feature value', type=float, default=0.0)
+    parser.add_argument('-format', help='dataset file format (pkl|npy: memory-mapped by training)(pkl)', default='pkl')
+    parser.add_argument('-n_proc', help='number of processes reading the feature/label files(1)', type=int, default=1)
 
     args = parser.parse_args()
     print('** make_dataset **')
@@ -267,6 +252,8 @@ if __name__ == '__main__':
     print('  train             : '+str(args.n_div_train))
     print('  valid             : '+str(args.n_div_valid))
     print('  test              : '+str(args.n_div_test))
+    print(' format             : '+str(args.format))
+    print(' processes          : '+str(args.n_proc))
 
     # read config file
     with open(args.f_config_in, 'r', encoding='utf-8') as f:
@@ -298,9 +285,9 @@ if __name__ == '__main__':
     if not os.path.isdir(d_dataset + '/label_velocity'):
         os.makedirs(d_dataset + '/label_velocity')
 
-    # make_dataset(d_list + '/train.list', 'train', d_feature, d_label, d_dataset, config, args.n_div_train)
-    make_dataset(d_list + '/valid.list', 'valid', d_feature, d_label, d_dataset, config, args.n_div_valid)
-    make_dataset(d_list + '/test.list',  'test',  d_feature, d_label, d_dataset, config, args.n_div_test)
+    # make_dataset(d_list + '/train.list', 'train', d_feature, d_label, d_dataset, config, args.n_div_train, fmt=args.format, n_proc=args.n_proc)
+    make_dataset(d_list + '/valid.list', 'valid', d_feature, d_label, d_dataset, config, args.n_div_valid, fmt=args.format, n_proc=args.n_proc)
+    make_dataset(d_list + '/test.list',  'test',  d_feature, d_label, d_dataset, config, args.n_div_test, fmt=args.format, n_proc=args.n_proc)
 
     # write config file
     config['input']['min_value'] = float(config['input']['min_value'])
@@ -0,0 +1,66 @@
+#! python
+
+import os
+import argparse
+import json
+import sys
+sys.path.append(os.getcwd())
+from model import amt
+from quantize_model import read_list, evaluate_model
+
+##
+## mixed precision inference: note-level scores and frames/sec, float32 vs amp
+## (see training/check_amp.py for the loss curves of mixed precision training)
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-model_file', help='input model file (pickle)', default='best_model.pkl')
+    parser.add_argument('-amp', help='mixed precision (fp16|bf16)(fp16 on cuda, bf16 on cpu)', default=None)
+    parser.add_argument('-f_list', help='file list', default='../corpus/MAESTRO-V3/list/test.list')
+    parser.add_argument('-d_fe', help='corpus feature directory', default='../corpus/MAESTRO-V3/feature')
+    parser.add_argument('-d_ref', help='reference directory', default='../corpus/MAESTRO-V3/reference')
+    parser.add_argument('-f_report', help='report file (json)', default=None)
+    parser.add_argument('-mode', help='mode to transcript (combination|single)', default='combination')
+    parser.add_argument('-output', help='output_1st(1st)|output_2nd(2nd)', default='2nd')
+    parser.add_argument('-thred_mpe', help='threshold value for mpe detection', type=float, default=0.5)
+    parser.add_argument('-thred_onset', help='threshold value for onset detection', type=float, default=0.5)
+    parser.add_argument('-thred_offset', help='threshold value for offset detection', type=float, default=0.5)
+    parser.add_argument('-n_stride', help='number of samples for offset', type=int, default=0)
+    parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-batch', help='number of windows per forward pass(8)', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.mode != 'combination':
+        args.output = None
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    AMT_fp32 = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+    if args.amp is None:
+        args.amp = 'fp16' if AMT_fp32.device == 'cuda' else 'bf16'
+    AMT_amp = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False, amp=args.amp)
+
+    print('** AMT: mixed precision inference check **')
+    print(' config file    : '+str(args.f_config))
+    print(' model file     : '+str(args.model_file))
+    print(' device         : '+str(AMT_fp32.device))
+    print(' amp            : '+str(args.amp))
+    print(' file list      : '+str(args.f_list))
+    print(' batch          : '+str(args.batch))
+
+    a_list = read_list(args.f_list)
+    a_report = {}
+    for name, AMT in [('float32', AMT_fp32), (args.amp, AMT_amp)]:
+        result, fps = evaluate_model(AMT, a_list, args)
+        a_report[name] = {'frames/sec': fps, 'score': result}
+
+    print('** report ('+str(len(a_list))+' files) **')
+    for attr in ['Precision', 'Recall', 'F-measure', 'F-measure_no_offset']:
+        print(' '+attr.ljust(20)+': '+str(a_report['float32']['score'].get(attr))+' -> '+str(a_report[args.amp]['score'].get(attr)))
+    print(' '+'frames/sec'.ljust(20)+': '+str(a_report['float32']['frames/sec'])+' -> '+str(a_report[args.amp]['frames/sec']))
+    if args.f_report is not None:
+        with open(args.f_report, 'w', encoding='utf-8') as f:
+            json.dump(a_report, f, ensure_ascii=False, indent=4, sort_keys=False)
+    print('** done **')
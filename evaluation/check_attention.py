@@ -0,0 +1,109 @@
+#! python
+
+import os
+import argparse
+import json
+import sys
+import time
+import resource
+import tempfile
+import numpy as np
+import torch
+sys.path.append(os.getcwd())
+from model import amt
+from model import model_spec2midi
+from model import amt_backend
+
+##
+## fused attention (scaled_dot_product_attention) vs the explicit path
+## (outputs, latency and peak memory of a forward pass)
+## and the ONNX export (amt_backend.export_model(), default opset) against the eager outputs
+##
+def run_forward(model, input_spec, output_stage, n_run, device):
+    # return: outputs, sec/forward, peak memory (bytes; cuda: allocated, cpu: max RSS)
+    with torch.no_grad():
+        a_output = model(input_spec, output_stage=output_stage)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        time_s = time.time()
+        for _ in range(n_run):
+            model(input_spec, output_stage=output_stage)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        time_run = (time.time() - time_s) / n_run
+    if device == 'cuda':
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        # (max RSS of the process never decreases: run the fused path first)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return [output.to('cpu') for output in a_output if output is not None], time_run, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-model_file', help='input model file (pickle)', default='best_model.pkl')
+    parser.add_argument('-output_stage', help='outputs to compute (all|1st|2nd)', default='2nd')
+    parser.add_argument('-batch', help='batch size(8)', type=int, default=8)
+    parser.add_argument('-n_run', help='number of forward passes to time(5)', type=int, default=5)
+    parser.add_argument('-atol', help='tolerance of the output difference(1e-4)', type=float, default=1e-4)
+    parser.add_argument('-no_export', help='skip the ONNX export check', action='store_true')
+    args = parser.parse_args()
+
+    output_stage = None if args.output_stage == 'all' else args.output_stage
+
+    print('** attention check **')
+    print(' config file    : '+str(args.f_config))
+    print(' model file     : '+str(args.model_file))
+    print(' output stage   : '+str(args.output_stage))
+    print(' batch          : '+str(args.batch))
+    print(' fused kernel   : '+str(model_spec2midi.flag_fused_attention))
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    AMT = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+    model = AMT.model.eval()
+
+    len_input = config['input']['margin_b'] + config['input']['num_frame'] + config['input']['margin_f']
+    rng = np.random.RandomState(0)
+    input_spec = torch.from_numpy((rng.randn(args.batch, config['feature']['n_bins'], len_input) + config['input']['min_value'] / 2).astype(np.float32)).to(AMT.device)
+
+    a_result = {}
+    flag_fused = model_spec2midi.flag_fused_attention
+    for name, flag in [('fused', flag_fused), ('explicit', False)]:
+        model_spec2midi.flag_fused_attention = flag
+        a_result[name] = run_forward(model, input_spec, output_stage, args.n_run, AMT.device)
+    model_spec2midi.flag_fused_attention = flag_fused
+
+    print('** result **')
+    diff = 0.0
+    for output_fused, output_explicit in zip(a_result['fused'][0], a_result['explicit'][0]):
+        diff = max(diff, float(torch.max(torch.abs(output_fused.float() - output_explicit.float()))))
+    print(' max diff       : '+str(diff))
+    for name in ['explicit', 'fused']:
+        print(' '+(name+' (sec)').ljust(15)+': '+str(a_result[name][1]))
+        print(' '+(name+' (MB)').ljust(15)+': '+str(a_result[name][2] / 1024 / 1024))
+
+    if args.no_export is False:
+        # (onnx/onnxruntime are needed)
+        model_cpu = AMT.model.to('cpu').eval()
+        AMT.device = 'cpu'
+        with tempfile.TemporaryDirectory() as d_tmp:
+            f_onnx = d_tmp + '/model.onnx'
+            amt_backend.export_model(model_cpu, f_onnx, config, output_stage=output_stage, fmt='onnx')
+            AMT_onnx = amt.AMT(config, f_onnx, batch_size=args.batch, verbose_flag=False)
+            a_output_onnx = AMT_onnx.run_model(input_spec.to('cpu'), output_stage=output_stage)
+        a_output_eager = AMT.run_model(input_spec.to('cpu'), output_stage=output_stage)
+        diff_export = 0.0
+        for name, output_eager, output_onnx in zip(amt_backend.output_name(output_stage), a_output_eager, a_output_onnx):
+            if not name.startswith('velocity'):
+                diff_export = max(diff_export, float(np.max(np.abs(output_eager - output_onnx))))
+        print(' export (onnx)  : max diff '+str(diff_export)+' (fused kernel after export: '+str(model_spec2midi.flag_fused_attention)+')')
+        diff = max(diff, diff_export)
+    if diff > args.atol:
+        print(' NG')
+        sys.exit(1)
+    print(' OK')
+    print('** done **')
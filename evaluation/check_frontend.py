@@ -0,0 +1,100 @@
+#! python
+
+import os
+import argparse
+import json
+import sys
+import time
+import resource
+import subprocess
+import numpy as np
+import torch
+sys.path.append(os.getcwd())
+from model import amt
+
+##
+## encoder front end: conv over time (frontend_conv) vs unfold (frontend_unfold)
+##  inference: forward under no_grad
+##  training : forward + backward, and the size of the tensors saved for backward
+## (each measurement runs in its own process, so that max RSS is not shared)
+##
+def measure(args, config, frontend, train):
+    # return: {'sec': sec/pass, 'rss_base': max RSS before the passes, 'rss': max RSS (bytes), 'saved': bytes saved for backward}
+    AMT = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+    encoder = AMT.model.encoder_spec2midi.to('cpu')
+    encoder.train(train)
+    a_frontend = {'conv': encoder.frontend_conv, 'unfold': encoder.frontend_unfold}
+
+    len_input = config['input']['margin_b'] + config['input']['num_frame'] + config['input']['margin_f']
+    rng = np.random.RandomState(0)
+    input_spec = torch.from_numpy((rng.randn(args.batch, config['feature']['n_bins'], len_input) + config['input']['min_value'] / 2).astype(np.float32))
+
+    a_saved = [0]
+    def pack(tensor):
+        a_saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    rss_s = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    time_s = time.time()
+    for _ in range(args.n_run):
+        a_saved[0] = 0
+        if train is True:
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                output = a_frontend[frontend](input_spec)
+            output.sum().backward()
+        else:
+            with torch.no_grad():
+                output = a_frontend[frontend](input_spec)
+        del output
+    time_run = (time.time() - time_s) / args.n_run
+    rss_e = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'sec': time_run, 'rss_base': rss_s, 'rss': rss_e, 'saved': a_saved[0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-model_file', help='input model file (pickle)', default='best_model.pkl')
+    parser.add_argument('-batch', help='batch size(8)', type=int, default=8)
+    parser.add_argument('-n_run', help='number of passes to time(3)', type=int, default=3)
+    parser.add_argument('-run', help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    if args.run is not None:
+        # (child process) -run <frontend>,<inference|training>
+        frontend, phase = args.run.split(',')
+        print(json.dumps(measure(args, config, frontend, phase == 'training')))
+        sys.exit(0)
+
+    print('** encoder front end check **')
+    print(' config file    : '+str(args.f_config))
+    print(' model file     : '+str(args.model_file))
+    print(' batch          : '+str(args.batch))
+
+    # outputs of the two front ends
+    AMT = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+    encoder = AMT.model.encoder_spec2midi.to('cpu').eval()
+    len_input = config['input']['margin_b'] + config['input']['num_frame'] + config['input']['margin_f']
+    rng = np.random.RandomState(0)
+    input_spec = torch.from_numpy((rng.randn(1, config['feature']['n_bins'], len_input) + config['input']['min_value'] / 2).astype(np.float32))
+    with torch.no_grad():
+        output_conv = encoder.frontend_conv(input_spec)
+        output_unfold = encoder.frontend_unfold(input_spec)
+    diff = float(torch.max(torch.abs(output_conv - output_unfold)))
+    print(' max diff       : '+str(diff)+' (max abs '+str(float(torch.max(torch.abs(output_unfold))))+')')
+
+    for phase in ['inference', 'training']:
+        print('** '+phase+' **')
+        for frontend in ['unfold', 'conv']:
+            proc = subprocess.run([sys.executable, __file__, '-f_config', args.f_config, '-model_file', args.model_file,
+                                   '-batch', str(args.batch), '-n_run', str(args.n_run), '-run', frontend+','+phase],
+                                  stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(' '+(frontend+' (sec)').ljust(15)+': '+str(result['sec']))
+            print(' '+(frontend+' (MB)').ljust(15)+': '+str(result['rss'] / 1024 / 1024)+' (max RSS, '+str(result['rss_base'] / 1024 / 1024)+' before)')
+            if phase == 'training':
+                print(' '+(frontend+' (saved)').ljust(15)+': '+str(result['saved'] / 1024 / 1024)+' MB')
+    print('** done **')
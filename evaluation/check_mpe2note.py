@@ -0,0 +1,70 @@
+#! python
+
+import os
+import argparse
+import pickle
+import json
+import sys
+import time
+sys.path.append(os.getcwd())
+from model import amt
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-f_list', help='file list', default='../corpus/MAESTRO-V3/list/test.list')
+    parser.add_argument('-d_mpe', help='directory of saved posteriors (.onset/.offset/.mpe/.velocity)', default='result/mpe')
+    parser.add_argument('-output', help='output_1st(1st)|output_2nd(2nd)', default='2nd')
+    parser.add_argument('-thred', help='threshold values to check (onset/offset/mpe)', type=float, nargs='+', default=[0.5])
+    parser.add_argument('-mode_offset', help='mode_offset values to check', nargs='+', default=['shorter', 'longer', 'offset'])
+    args = parser.parse_args()
+
+    print('** mpe2note: check vectorized version with mpe2note_loop **')
+    print(' file list     : '+str(args.f_list))
+    print(' config file   : '+str(args.f_config))
+    print(' posteriors    : '+str(args.d_mpe))
+    print(' output        : '+str(args.output))
+    print(' threshold     : '+str(args.thred))
+    print(' mode_offset   : '+str(args.mode_offset))
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    AMT = amt.AMT(config, None)
+
+    a_list = []
+    with open(args.f_list, 'r', encoding='utf-8') as f:
+        for fname in f.readlines():
+            a_list.append(fname.rstrip('\n'))
+
+    d_mpe = args.d_mpe.rstrip('/')
+    time_vec = 0.0
+    time_loop = 0.0
+    num_mismatch = 0
+    for fname in a_list:
+        a_output = {}
+        for attr in ['onset', 'offset', 'mpe', 'velocity']:
+            with open(d_mpe+'/'+fname+'_'+str(args.output)+'.'+attr, 'rb') as f:
+                a_output[attr] = pickle.load(f)
+
+        for thred in args.thred:
+            for mode_offset in args.mode_offset:
+                t0 = time.time()
+                a_note_vec = AMT.mpe2note(a_onset=a_output['onset'], a_offset=a_output['offset'], a_mpe=a_output['mpe'], a_velocity=a_output['velocity'],
+                                          thred_onset=thred, thred_offset=thred, thred_mpe=thred, mode_offset=mode_offset)
+                t1 = time.time()
+                a_note_loop = AMT.mpe2note_loop(a_onset=a_output['onset'], a_offset=a_output['offset'], a_mpe=a_output['mpe'], a_velocity=a_output['velocity'],
+                                                thred_onset=thred, thred_offset=thred, thred_mpe=thred, mode_offset=mode_offset)
+                t2 = time.time()
+                time_vec += t1 - t0
+                time_loop += t2 - t1
+
+                if a_note_vec != a_note_loop:
+                    num_mismatch += 1
+                    print('(mismatch) '+str(fname)+' thred: '+str(thred)+' mode_offset: '+str(mode_offset)+
+                          ' notes: '+str(len(a_note_vec))+'/'+str(len(a_note_loop)))
+        print('['+str(fname)+'] done')
+
+    print(' mismatch      : '+str(num_mismatch))
+    print(' time (vec)    : '+str(time_vec))
+    print(' time (loop)   : '+str(time_loop))
+    print('** done **')
@@ -0,0 +1,74 @@
+#! python
+
+import os
+import argparse
+import sys
+import time
+import subprocess
+
+##
+## startup time of transcribe_new_files.py, and modules it imports
+## (a plain run should not import the optional stages, e.g. speechbrain)
+##
+def run_startup(f_script, a_arg):
+    # return: elapsed time (sec), {top-level module: cumulative import time (us)}, [every imported module]
+    time_s = time.time()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', f_script] + a_arg,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    time_e = time.time()
+    a_module = {}
+    a_imported = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        a_col = line[len('import time:'):].split('|')
+        if (len(a_col) != 3) or (not a_col[1].strip().isdigit()):
+            continue
+        name = a_col[2].rstrip()
+        # (nested imports are indented: every module is kept for the forbidden
+        #  check, only the top-level ones for the timing)
+        a_imported.append(name.strip())
+        if name.startswith(' ' * 3):
+            continue
+        a_module[name.strip()] = int(a_col[1])
+    return time_e - time_s, a_module, a_imported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_script', help='script to check', default='evaluation/transcribe_new_files.py')
+    parser.add_argument('-n_run', help='number of runs(5)', type=int, default=5)
+    parser.add_argument('-n_top', help='number of slowest imports to print(10)', type=int, default=10)
+    parser.add_argument('-forbidden', help='modules a plain run must not import', nargs='+',
+                        default=['speechbrain', 'pydub', 'mir_eval', 'huggingface_hub'])
+    args = parser.parse_args()
+
+    print('** startup check **')
+    print(' script         : '+str(args.f_script))
+    print(' runs           : '+str(args.n_run))
+
+    # '-h': imports, argument parsing, exit
+    a_time = []
+    a_all = {}
+    a_imported = set()
+    for _ in range(args.n_run):
+        time_run, a_module, a_name = run_startup(args.f_script, ['-h'])
+        a_time.append(time_run)
+        a_imported.update(a_name)
+        for name in a_module:
+            a_all[name] = min(a_all.get(name, a_module[name]), a_module[name])
+    a_time = sorted(a_time)
+
+    print(' time (median)  : '+str(a_time[len(a_time)//2]))
+    print(' time (min)     : '+str(a_time[0]))
+    print(' imports (us, cumulative)')
+    for name in sorted(a_all, key=lambda x: -a_all[x])[:args.n_top]:
+        print('  '+name+' : '+str(a_all[name]))
+
+    a_found = [name for name in a_imported if name.split('.')[0] in args.forbidden]
+    if len(a_found) > 0:
+        print(' NG: imported at startup: '+str(sorted(a_found)))
+        sys.exit(1)
+    print(' OK')
+    print('** done **')
@@ -0,0 +1,83 @@
+#! python
+
+import os
+import argparse
+import json
+import sys
+import time
+import numpy as np
+import torch
+sys.path.append(os.getcwd())
+from model import amt
+from model import amt_backend
+
+##
+## export a pickled model to TorchScript (.pt) / ONNX (.onnx)
+## (AMT loads the exported file with amt_backend.Model_Runtime)
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-model_file', help='input model file (pickle)', default='best_model.pkl')
+    parser.add_argument('-f_out', help='output file (.pt: TorchScript, .onnx: ONNX)', default='best_model.onnx')
+    parser.add_argument('-mode', help='mode to transcript (combination|single)', default='combination')
+    parser.add_argument('-output_stage', help='outputs in the graph (all|1st|2nd)', default='2nd')
+    parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-opset', help='ONNX opset version(13)', type=int, default=13)
+    parser.add_argument('-batch', help='batch size to check the exported model(4)', type=int, default=4)
+    parser.add_argument('-n_run', help='number of forward passes to time(5)', type=int, default=5)
+    args = parser.parse_args()
+
+    fmt = 'onnx' if args.f_out.endswith('.onnx') else 'torchscript'
+    output_stage = None if args.output_stage == 'all' else args.output_stage
+
+    print('** export model **')
+    print(' config file    : '+str(args.f_config))
+    print(' model file     : '+str(args.model_file))
+    print(' output file    : '+str(args.f_out))
+    print(' format         : '+str(fmt))
+    print(' mode           : '+str(args.mode))
+    print(' output stage   : '+str(args.output_stage))
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    # export (on cpu)
+    time_s = time.time()
+    AMT_pickle = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+    time_load_pickle = time.time() - time_s
+    model = AMT_pickle.model.to('cpu').eval()
+    amt_backend.export_model(model, args.f_out, config, fmt=fmt, output_stage=output_stage, mode=args.mode,
+                             ablation_flag=args.ablation, opset=args.opset)
+    print(' exported       : '+str(os.path.getsize(args.f_out))+' bytes')
+
+    # check: same outputs as the pickled model, with a batch size different from the export
+    time_s = time.time()
+    AMT_runtime = amt.AMT(config, args.f_out, batch_size=args.batch, verbose_flag=False)
+    time_load_runtime = time.time() - time_s
+    AMT_pickle.device = 'cpu'
+
+    len_input = config['input']['margin_b'] + config['input']['num_frame'] + config['input']['margin_f']
+    rng = np.random.RandomState(0)
+    input_spec = torch.from_numpy((rng.randn(args.batch, config['feature']['n_bins'], len_input) + config['input']['min_value'] / 2).astype(np.float32))
+
+    a_time = {}
+    a_output = {}
+    for name, AMT in [('pickle', AMT_pickle), ('runtime', AMT_runtime)]:
+        a_output[name] = AMT.run_model(input_spec, mode=args.mode, ablation_flag=args.ablation, output_stage=output_stage)
+        time_s = time.time()
+        for _ in range(args.n_run):
+            AMT.run_model(input_spec, mode=args.mode, ablation_flag=args.ablation, output_stage=output_stage)
+        a_time[name] = (time.time() - time_s) / args.n_run
+
+    print('** check (batch '+str(args.batch)+') **')
+    for name, output_pickle, output_runtime in zip(amt_backend.output_name(output_stage, args.mode), a_output['pickle'], a_output['runtime']):
+        if name.startswith('velocity'):
+            print(' '+name.ljust(14)+' : mismatch '+str(float(np.mean(output_pickle != output_runtime))))
+        else:
+            print(' '+name.ljust(14)+' : max diff '+str(float(np.max(np.abs(output_pickle - output_runtime)))))
+    print(' load (pickle)  : '+str(time_load_pickle))
+    print(' load (runtime) : '+str(time_load_runtime))
+    print(' batch (pickle) : '+str(a_time['pickle']))
+    print(' batch (runtime): '+str(a_time['runtime']))
+    print('** done **')
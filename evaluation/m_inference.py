@@ -7,6 +7,7 @@ import json
 import sys
 sys.path.append(os.getcwd())
 from model import amt
+from model import feature_cache
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -26,6 +27,12 @@ if __name__ == '__main__':
     parser.add_argument('-calc_transcript', help='flag to calculate transcript data', action='store_true')
     parser.add_argument('-n_stride', help='number of samples for offset', type=int, default=0)
     parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-batch', help='number of windows per forward pass(8)', type=int, default=8)
+    parser.add_argument('-quantize', help='int8 dynamic quantization of the Linear layers (CPU)', action='store_true')
+    parser.add_argument('-amp', help='mixed precision inference (none|fp16|bf16)(none)', default='none')
+    parser.add_argument('-d_cache', help='feature cache directory (no cache if not set)', default=None)
+    parser.add_argument('-cache_size', help='maximum size of the feature cache in GB (no limit if not set)', type=float, default=None)
+    parser.add_argument('-cache_dtype', help='dtype of the cached feature (float32|float16)', default='float32')
     args = parser.parse_args()
 
     print('** AMT: inference for evaluation **')
@@ -48,6 +55,10 @@ if __name__ == '__main__':
     print('  transcript    : '+str(args.calc_transcript))
     print(' stride         : '+str(args.n_stride))
     print(' ablation mode  : '+str(args.ablation))
+    print(' batch          : '+str(args.batch))
+    print(' feature cache  : '+str(args.d_cache))
+    print(' quantize       : '+str(args.quantize))
+    print(' amp            : '+str(args.amp))
 
     # parameters
     with open(args.d_cp.rstrip('/') + '/parameter.json', 'r', encoding='utf-8') as f:
@@ -67,8 +78,16 @@ if __name__ == '__main__':
     with open(args.f_config, 'r', encoding='utf-8') as f:
         config = json.load(f)
 
+    # feature cache
+    if args.d_cache is not None:
+        cache_size = None if args.cache_size is None else int(args.cache_size * (1 << 30))
+        cache = feature_cache.Feature_Cache(args.d_cache, config, max_size=cache_size, dtype=args.cache_dtype)
+    else:
+        cache = None
+
     # AMT class
-    AMT = amt.AMT(config, args.d_cp.rstrip('/') + '/' + args.m, verbose_flag = False)
+    AMT = amt.AMT(config, args.d_cp.rstrip('/') + '/' + args.m, batch_size=args.batch, verbose_flag = False, feature_cache=cache,
+                  quantize='dynamic' if args.quantize is True else None, amp=None if args.amp == 'none' else args.amp)
 
     # inference
     out_dir_mpe = args.d_mpe.rstrip('/')
@@ -0,0 +1,256 @@
+#! python
+
+import os
+import argparse
+import pickle
+import json
+import sys
+import time
+import itertools
+from multiprocessing import Pool
+import numpy as np
+import mir_eval
+sys.path.append(os.getcwd())
+from model import amt
+from model import feature_cache
+
+##
+## threshold sweep: transcript once per file, then evaluate the grid of
+## (thred_onset, thred_offset, thred_mpe, mode_offset) on the saved posteriors
+##
+def fname_posterior(d_post, fname, output):
+    return d_post.rstrip('/')+'/'+fname+'_'+str(output)+'.npz'
+
+
+def fname_feature(args, fname):
+    # wav file (-calc_feature) or feature file the posteriors are computed from
+    if args.calc_feature:
+        return args.d_wav.rstrip('/') + '/' + fname + '.wav'
+    return args.d_fe.rstrip('/') + '/' + fname + '.pkl'
+
+
+def posterior_param(args, config, fname):
+    # parameters the posteriors of fname depend on
+    # (checkpoint and feature source: path, mtime and size; feature config if computed here)
+    f_model = os.path.abspath(args.d_cp.rstrip('/') + '/' + args.m)
+    f_feature = os.path.abspath(fname_feature(args, fname))
+    return {'model': f_model,
+            'model_mtime': os.path.getmtime(f_model) if os.path.exists(f_model) else None,
+            'model_size': os.path.getsize(f_model) if os.path.exists(f_model) else None,
+            'feature': f_feature,
+            'feature_mtime': os.path.getmtime(f_feature) if os.path.exists(f_feature) else None,
+            'feature_size': os.path.getsize(f_feature) if os.path.exists(f_feature) else None,
+            'feature_config': config['feature'] if args.calc_feature else None,
+            'mode': args.mode, 'ablation': args.ablation, 'n_stride': args.n_stride}
+
+
+def check_posterior(f_post, thred_velocity, param):
+    # posteriors are reused if they were computed with the same param (posterior_param())
+    # and velocity was evaluated at all the onsets of the grid
+    if not os.path.exists(f_post):
+        return False
+    with np.load(f_post) as a_post:
+        if ('param' not in a_post.files) or (json.loads(str(a_post['param'])) != param):
+            return False
+        thred_saved = float(a_post['thred_velocity'])
+    return (thred_saved < 0.0) or (thred_saved <= thred_velocity)
+
+
+def load_transcription_velocity(filename):
+    """Loader for data in the format start, end, pitch, velocity."""
+    starts, ends, pitches, velocities = mir_eval.io.load_delimited(
+        filename, [float, float, int, int])
+    intervals = np.array([starts, ends]).T
+    pitches = np.array(pitches)
+    velocities = np.array(velocities)
+    return intervals, pitches, velocities
+
+
+def evaluate_file(job):
+    # job: (fname, f_post, d_ref, config, a_grid, flag_velocity)
+    # return: scores of each point of a_grid (same order)
+    fname, f_post, d_ref, config, a_grid, flag_velocity = job
+    hop_sec = float(config['feature']['hop_sample'] / config['feature']['sr'])
+
+    with np.load(f_post) as a_post:
+        a_onset = a_post['onset']
+        a_offset = a_post['offset']
+        a_mpe = a_post['mpe']
+        a_velocity = a_post['velocity']
+    n_frame = len(a_mpe)
+
+    ref_int, ref_pitch = mir_eval.io.load_valued_intervals(d_ref.rstrip('/')+'/'+fname+'.txt')
+    if flag_velocity is True:
+        ref_int_v, ref_pitch_v, ref_vel_v = load_transcription_velocity(d_ref.rstrip('/')+'/'+fname+'_velocity.txt')
+
+    # peaks/mpe drops are shared by the grid points with the same threshold
+    a_onset_peak = {}
+    a_offset_peak = {}
+    a_mpe_drop = {}
+    a_score = []
+    for thred_onset, thred_offset, thred_mpe, mode_offset in a_grid:
+        if thred_onset not in a_onset_peak:
+            a_onset_peak[thred_onset] = amt.detect_peak(a_onset, thred_onset, hop_sec)
+        if thred_offset not in a_offset_peak:
+            a_offset_peak[thred_offset] = amt.detect_peak(a_offset, thred_offset, hop_sec)
+        if thred_mpe not in a_mpe_drop:
+            a_mpe_drop[thred_mpe] = amt.find_drop(a_mpe, thred_mpe)
+
+        # same notes as AMT.mpe2note(mode_velocity='ignore_zero')
+        a_note = amt.assemble_note(a_onset_peak[thred_onset], a_offset_peak[thred_offset], a_mpe_drop[thred_mpe],
+                                   a_velocity, n_frame, hop_sec, config['midi']['note_min'], mode_offset=mode_offset)
+        a_pitch_value = np.array([note['pitch'] for note in a_note], dtype=np.int64)
+        a_onset_value = np.array([note['onset'] for note in a_note], dtype=np.float64)
+        a_offset_value = np.array([note['offset'] for note in a_note], dtype=np.float64)
+        a_velocity_value = np.array([note['velocity'] for note in a_note], dtype=np.int64)
+
+        # (same conversion as m_transcription.py)
+        flag_valid = (a_offset_value - a_onset_value) > 0.0
+        est_int = np.array([a_onset_value[flag_valid], a_offset_value[flag_valid]]).T.reshape(-1, 2)
+        est_pitch = 440.0 * np.power(2.0, (a_pitch_value[flag_valid] - 69) / 12)
+        scores = dict(mir_eval.transcription.evaluate(ref_int, ref_pitch, est_int, est_pitch))
+        if flag_velocity is True:
+            scores_v = mir_eval.transcription_velocity.evaluate(
+                ref_int_v, ref_pitch_v, ref_vel_v, est_int, a_pitch_value[flag_valid], a_velocity_value[flag_valid]
+            )
+            for attr in scores_v:
+                scores['Velocity_'+attr] = scores_v[attr]
+        a_score.append(scores)
+
+    return a_score
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-f_list', help='file list', default='../corpus/MAESTRO-V3/list/test.list')
+    parser.add_argument('-d_cp', help='checkpoint directory', default='../checkpoint')
+    parser.add_argument('-m', help='input model file', default='best_model.pkl')
+    parser.add_argument('-mode', help='mode to transcript (combination|single)', default='combination')
+    parser.add_argument('-output', help='output_1st(1st)|output_2nd(2nd)', default='2nd')
+    parser.add_argument('-d_wav', help='corpus wav directory', default='../corpus/MAESTRO-V3/wav')
+    parser.add_argument('-d_fe', help='corpus feature directory', default='../corpus/MAESTRO-V3/feature')
+    parser.add_argument('-d_ref', help='reference directory', default='../corpus/MAESTRO-V3/reference')
+    parser.add_argument('-d_post', help='directory for the posteriors (.npz)', default='result/posterior')
+    parser.add_argument('-f_out', help='summary table (tsv)', default='result/sweep.tsv')
+    parser.add_argument('-thred_onset', help='threshold values for onset detection', type=float, nargs='+', default=[0.5])
+    parser.add_argument('-thred_offset', help='threshold values for offset detection', type=float, nargs='+', default=[0.5])
+    parser.add_argument('-thred_mpe', help='threshold values for mpe detection', type=float, nargs='+', default=[0.5])
+    parser.add_argument('-mode_offset', help='mode_offset values (shorter|longer|offset)', nargs='+', default=['shorter'])
+    parser.add_argument('-velocity', help='evaluate w/ velocity as well', action='store_true')
+    parser.add_argument('-calc_feature', help='flag to calculate feature data', action='store_true')
+    parser.add_argument('-calc_transcript', help='flag to recalculate the saved posteriors', action='store_true')
+    parser.add_argument('-n_stride', help='number of samples for offset', type=int, default=0)
+    parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-batch', help='number of windows per forward pass(8)', type=int, default=8)
+    parser.add_argument('-n_proc', help='number of processes for evaluation', type=int, default=os.cpu_count())
+    parser.add_argument('-d_cache', help='feature cache directory (no cache if not set)', default=None)
+    args = parser.parse_args()
+
+    if args.mode != 'combination':
+        args.output = '1st'
+    a_grid = list(itertools.product(args.thred_onset, args.thred_offset, args.thred_mpe, args.mode_offset))
+    # velocity is only evaluated at onset >= the lowest thred_onset of the grid
+    thred_velocity = min(args.thred_onset)
+
+    print('** AMT: threshold sweep **')
+    print(' file list      : '+str(args.f_list))
+    print(' config file    : '+str(args.f_config))
+    print(' checkpoint')
+    print('  directory     : '+str(args.d_cp))
+    print('  model file    : '+str(args.m))
+    print(' directories')
+    print('  wav           : '+str(args.d_wav))
+    print('  feature       : '+str(args.d_fe))
+    print('  reference     : '+str(args.d_ref))
+    print('  posterior     : '+str(args.d_post))
+    print(' summary table  : '+str(args.f_out))
+    print(' output         : '+str(args.output))
+    print(' grid')
+    print('  onset         : '+str(args.thred_onset))
+    print('  offset        : '+str(args.thred_offset))
+    print('  mpe           : '+str(args.thred_mpe))
+    print('  mode_offset   : '+str(args.mode_offset))
+    print('  points        : '+str(len(a_grid)))
+    print(' with velocity  : '+str(args.velocity))
+    print(' processes      : '+str(args.n_proc))
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    a_list = []
+    with open(args.f_list, 'r', encoding='utf-8') as f:
+        for fname in f.readlines():
+            a_list.append(fname.rstrip('\n'))
+
+    ## (1) posteriors (model inference only for the files without them)
+    os.makedirs(args.d_post, exist_ok=True)
+    a_param = {fname: posterior_param(args, config, fname) for fname in a_list}
+    a_list_calc = [fname for fname in a_list
+                   if (args.calc_transcript is True) or (check_posterior(fname_posterior(args.d_post, fname, args.output), thred_velocity, a_param[fname]) is False)]
+    print('** posterior: '+str(len(a_list_calc))+'/'+str(len(a_list))+' files to transcript **')
+    time_s = time.time()
+    if len(a_list_calc) > 0:
+        cache = None
+        if args.d_cache is not None:
+            cache = feature_cache.Feature_Cache(args.d_cache, config)
+        AMT = amt.AMT(config, args.d_cp.rstrip('/') + '/' + args.m, batch_size=args.batch, verbose_flag=False, feature_cache=cache)
+        for fname in a_list_calc:
+            print('['+str(fname)+']')
+            if args.calc_feature:
+                a_feature = AMT.wav2feature(fname_feature(args, fname))
+            else:
+                with open(fname_feature(args, fname), 'rb') as f:
+                    a_feature = pickle.load(f)
+
+            output_stage = args.output if args.mode == 'combination' else None
+            if args.n_stride > 0:
+                output = AMT.transcript_stride(a_feature, args.n_stride, mode=args.mode, ablation_flag=args.ablation,
+                                               output_stage=output_stage, thred_onset=thred_velocity)
+            else:
+                output = AMT.transcript(a_feature, mode=args.mode, ablation_flag=args.ablation,
+                                        output_stage=output_stage, thred_onset=thred_velocity)
+            # ('single' mode computes velocity everywhere)
+            thred_saved = thred_velocity if args.mode == 'combination' else -1.0
+            np.savez_compressed(fname_posterior(args.d_post, fname, args.output),
+                                onset=output[0], offset=output[1], mpe=output[2], velocity=output[3],
+                                thred_velocity=thred_saved, param=json.dumps(a_param[fname]))
+    time_post = time.time() - time_s
+
+    ## (2) evaluation of the grid (parallel over the files)
+    print('** evaluation **')
+    time_s = time.time()
+    a_job = [(fname, fname_posterior(args.d_post, fname, args.output), args.d_ref, config, a_grid, args.velocity) for fname in a_list]
+    a_result = [{} for _ in a_grid]
+    count = 0
+    with Pool(args.n_proc) as pool:
+        for fname, a_score in zip(a_list, pool.imap(evaluate_file, a_job)):
+            print('['+str(fname)+'] done')
+            for result, scores in zip(a_result, a_score):
+                for attr in scores:
+                    result[attr] = result.get(attr, 0.0) + scores[attr]
+            count += 1
+    for result in a_result:
+        for attr in result:
+            result[attr] /= count
+    time_eval = time.time() - time_s
+
+    ## (3) summary table
+    a_attr = list(a_result[0].keys()) if len(a_result) > 0 else []
+    with open(args.f_out, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(['thred_onset', 'thred_offset', 'thred_mpe', 'mode_offset'] + a_attr)+'\n')
+        for (thred_onset, thred_offset, thred_mpe, mode_offset), result in zip(a_grid, a_result):
+            f.write('\t'.join([str(thred_onset), str(thred_offset), str(thred_mpe), mode_offset] + [str(result[attr]) for attr in a_attr])+'\n')
+
+    if len(a_result) > 0:
+        best = max(range(len(a_grid)), key=lambda i: a_result[i]['F-measure'])
+        print(' best (F-measure)')
+        print('  onset         : '+str(a_grid[best][0]))
+        print('  offset        : '+str(a_grid[best][1]))
+        print('  mpe           : '+str(a_grid[best][2]))
+        print('  mode_offset   : '+str(a_grid[best][3]))
+        print('  F-measure     : '+str(a_result[best]['F-measure']))
+        print('  (no offset)   : '+str(a_result[best]['F-measure_no_offset']))
+    print(' time (posterior) : '+str(time_post))
+    print(' time (evaluation): '+str(time_eval))
+    print('** done **')
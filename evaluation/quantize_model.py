@@ -0,0 +1,148 @@
+#! python
+
+import os
+import argparse
+import pickle
+import json
+import sys
+import time
+import numpy as np
+import mir_eval
+sys.path.append(os.getcwd())
+from model import amt
+from model import amt_quantize
+
+##
+## int8 quantization of a pickled model, and a report against float32
+## (note-level scores computed as m_transcription.py, frames/sec of transcript())
+##
+def read_list(f_list):
+    a_list = []
+    with open(f_list, 'r', encoding='utf-8') as f:
+        for fname in f.readlines():
+            a_list.append(fname.rstrip('\n'))
+    return a_list
+
+
+def read_feature(d_fe, fname):
+    with open(d_fe.rstrip('/') + '/' + fname + '.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+def evaluate_model(AMT, a_list, args):
+    # return: mean scores over a_list, frames/sec
+    result = {}
+    n_frame = 0
+    time_model = 0.0
+    for fname in a_list:
+        a_feature = read_feature(args.d_fe, fname)
+        time_s = time.time()
+        if args.n_stride > 0:
+            output = AMT.transcript_stride(a_feature, args.n_stride, mode=args.mode, ablation_flag=args.ablation,
+                                           output_stage=args.output, thred_onset=args.thred_onset)
+        else:
+            output = AMT.transcript(a_feature, mode=args.mode, ablation_flag=args.ablation,
+                                    output_stage=args.output, thred_onset=args.thred_onset)
+        time_model += time.time() - time_s
+        n_frame += len(a_feature)
+
+        a_note = AMT.mpe2note(a_onset=output[0], a_offset=output[1], a_mpe=output[2], a_velocity=output[3],
+                              thred_onset=args.thred_onset, thred_offset=args.thred_offset, thred_mpe=args.thred_mpe,
+                              mode_velocity='ignore_zero', mode_offset='shorter')
+        # (same conversion as m_transcription.py)
+        a_note = [note for note in a_note if note['offset'] - note['onset'] > 0.0]
+        est_int = np.array([[note['onset'], note['offset']] for note in a_note]).reshape(-1, 2)
+        est_pitch = np.array([440.0*pow(2.0, (int(note['pitch']) - 69)/12) for note in a_note])
+        ref_int, ref_pitch = mir_eval.io.load_valued_intervals(args.d_ref.rstrip('/')+'/'+fname+'.txt')
+        scores = mir_eval.transcription.evaluate(ref_int, ref_pitch, est_int, est_pitch)
+        for attr in scores:
+            result[attr] = result.get(attr, 0.0) + scores[attr]
+    for attr in result:
+        result[attr] /= max(len(a_list), 1)
+    return result, n_frame / max(time_model, 1e-9)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-model_file', help='input model file (float32 pickle)', default='best_model.pkl')
+    parser.add_argument('-f_out', help='output model file (quantized pickle)', default='best_model_int8.pkl')
+    parser.add_argument('-quantize', help='quantization (dynamic|static)', default='dynamic')
+    parser.add_argument('-backend', help='quantized engine (fbgemm|qnnpack)', default='fbgemm')
+    parser.add_argument('-f_list_calib', help='file list for the calibration (static)', default='../corpus/MAESTRO-V3/list/valid.list')
+    parser.add_argument('-n_calib', help='number of files for the calibration(4)', type=int, default=4)
+    parser.add_argument('-f_list', help='file list for the report (no report if not set)', default=None)
+    parser.add_argument('-d_fe', help='corpus feature directory', default='../corpus/MAESTRO-V3/feature')
+    parser.add_argument('-d_ref', help='reference directory', default='../corpus/MAESTRO-V3/reference')
+    parser.add_argument('-f_report', help='report file (json)', default=None)
+    parser.add_argument('-mode', help='mode to transcript (combination|single)', default='combination')
+    parser.add_argument('-output', help='output_1st(1st)|output_2nd(2nd)', default='2nd')
+    parser.add_argument('-thred_mpe', help='threshold value for mpe detection', type=float, default=0.5)
+    parser.add_argument('-thred_onset', help='threshold value for onset detection', type=float, default=0.5)
+    parser.add_argument('-thred_offset', help='threshold value for offset detection', type=float, default=0.5)
+    parser.add_argument('-n_stride', help='number of samples for offset', type=int, default=0)
+    parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-batch', help='number of windows per forward pass(8)', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.mode != 'combination':
+        args.output = None
+
+    print('** AMT: int8 quantization **')
+    print(' config file    : '+str(args.f_config))
+    print(' model file     : '+str(args.model_file))
+    print(' output file    : '+str(args.f_out))
+    print(' quantize       : '+str(args.quantize))
+    if args.quantize == 'static':
+        print(' calibration    : '+str(args.f_list_calib)+' ('+str(args.n_calib)+' files)')
+    print(' report list    : '+str(args.f_list))
+    print(' batch          : '+str(args.batch))
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    # float32 model (on cpu, for the comparison)
+    AMT_fp32 = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+    AMT_fp32.device = 'cpu'
+    AMT_fp32.model = AMT_fp32.model.to('cpu')
+
+    ## quantization
+    time_s = time.time()
+    if args.quantize == 'dynamic':
+        model = amt_quantize.quantize_dynamic(AMT_fp32.model)
+    elif args.quantize == 'static':
+        # activation ranges are observed while transcribing the calibration files
+        AMT_calib = amt.AMT(config, None, batch_size=args.batch, verbose_flag=False)
+        AMT_calib.device = 'cpu'
+        AMT_calib.model = amt_quantize.prepare_static(AMT_fp32.model, backend=args.backend)
+        for fname in read_list(args.f_list_calib)[:args.n_calib]:
+            print(' calibration    : '+str(fname))
+            # (all the outputs of both stages, so that every Linear is observed;
+            #  velocity is evaluated densely, so that its head sees every frame)
+            AMT_calib.transcript(read_feature(args.d_fe, fname), mode=args.mode, ablation_flag=args.ablation,
+                                 output_stage=None)
+        model = amt_quantize.convert_static(AMT_calib.model)
+    else:
+        raise ValueError('unknown quantization: '+str(args.quantize))
+    print(' time (sec)     : '+str(time.time() - time_s))
+
+    with open(args.f_out, 'wb') as f:
+        pickle.dump(model, f, protocol=4)
+
+    ## report
+    if args.f_list is not None:
+        AMT_int8 = amt.AMT(config, args.f_out, batch_size=args.batch, verbose_flag=False)
+        a_list = read_list(args.f_list)
+        a_report = {}
+        for name, AMT in [('float32', AMT_fp32), ('int8', AMT_int8)]:
+            result, fps = evaluate_model(AMT, a_list, args)
+            a_report[name] = {'frames/sec': fps, 'score': result}
+
+        print('** report ('+str(len(a_list))+' files) **')
+        for attr in ['Precision', 'Recall', 'F-measure', 'F-measure_no_offset']:
+            print(' '+attr.ljust(20)+': '+str(a_report['float32']['score'].get(attr))+' -> '+str(a_report['int8']['score'].get(attr)))
+        print(' '+'frames/sec'.ljust(20)+': '+str(a_report['float32']['frames/sec'])+' -> '+str(a_report['int8']['frames/sec']))
+        if args.f_report is not None:
+            with open(args.f_report, 'w', encoding='utf-8') as f:
+                json.dump(a_report, f, ensure_ascii=False, indent=4, sort_keys=False)
+    print('** done **')
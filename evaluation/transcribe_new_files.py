@@ -5,29 +5,194 @@ import pickle
 import json
 import sys
 import glob
+import time
+import queue
+import threading
+import functools
+from multiprocessing import Pool
+import torch
 sys.path.append(os.getcwd())
 from model import amt
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError
+from model import feature_cache
+from model import work_queue
 import random
 
-try:
-    from speechbrain.pretrained import SpectralMaskEnhancement
-    model = SpectralMaskEnhancement.from_hparams("speechbrain/mtl-mimic-voicebank")
-except:
-    pass
+# audio files to transcribe (decoded in memory, see amt.load_audio())
+# (when the same name exists with several extensions, the first one of a_ext is used)
+a_ext = ['wav', 'flac', 'ogg', 'mp3']
 
-def check_and_convert_mp3_to_wav(fname):
-    wav_file = fname.replace('.mp3', '.wav')
-    if not os.path.exists(wav_file):
-        print('converting ' + fname + ' to .wav...')
+
+##
+## speech enhancement (optional pre-processing, -enhance)
+##
+class Enhancer():
+    # speechbrain SpectralMaskEnhancement applied to the 16kHz mono waveform
+    # (speechbrain is imported and the model is loaded on the first call)
+    def __init__(self, source='speechbrain/mtl-mimic-voicebank'):
+        self.source = source
+        self.model = None
+        self.lock = threading.Lock()
+
+    def __call__(self, wave_mono_16k):
+        with self.lock:
+            if self.model is None:
+                try:
+                    from speechbrain.inference.enhancement import SpectralMaskEnhancement
+                except ImportError:
+                    from speechbrain.pretrained import SpectralMaskEnhancement
+                self.model = SpectralMaskEnhancement.from_hparams(self.source)
+            wave = self.model.enhance_batch(wave_mono_16k.unsqueeze(0), lengths=torch.tensor([1.0]))
+        return wave[0].detach().cpu()
+
+
+##
+## pipeline: decode (threads) -> model (main thread) -> mpe2note/MIDI (processes)
+## with bounded queues between the stages
+##
+class Stage_Stat():
+    # per-stage counters (shared by the worker threads)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num = 0
+        self.time = 0.0
+        self.a_depth = []
+
+    def add(self, time_stage, depth=None, num=1):
+        with self.lock:
+            self.num += num
+            self.time += time_stage
+            if depth is not None:
+                self.a_depth.append(depth)
+
+    def report(self, name):
+        print(' '+name)
+        print('  files         : '+str(self.num))
+        print('  time (sec)    : '+str(self.time))
+        print('  time / file   : '+str(self.time / max(self.num, 1)))
+        if len(self.a_depth) > 0:
+            print('  queue (mean)  : '+str(sum(self.a_depth) / len(self.a_depth)))
+            print('  queue (max)   : '+str(max(self.a_depth)))
+
+
+class Job_Source():
+    # jobs (fname, output_fname) of this worker
+    #  wq is None: the listed files
+    #  wq (Work_Queue): files claimed one by one from the queue shared with the other workers
+    # make_job(fname): job of fname (None if its output already exists)
+    def __init__(self, a_list, make_job, wq=None):
+        self.lock = threading.Lock()
+        self.a_list = list(a_list)
+        self.make_job = make_job
+        self.wq = wq
+
+    def get(self):
+        # return: next job (None if there is nothing left)
+        while True:
+            if self.wq is None:
+                with self.lock:
+                    if len(self.a_list) == 0:
+                        return None
+                    fname = self.a_list.pop(0)
+            else:
+                fname = self.wq.claim()
+                if fname is None:
+                    return None
+            job = self.make_job(fname)
+            if job is not None:
+                return job
+            self.done(fname)
+
+    def done(self, fname):
+        if self.wq is not None:
+            self.wq.done(fname)
+
+    def fail(self, fname, error):
+        print(error)
+        if self.wq is not None:
+            self.wq.fail(fname, error)
+
+
+def load_feature(AMT, fname, enhancer=None, sec_chunk=0.0):
+    if enhancer is not None:
+        # (enhanced features are not cached)
+        return AMT.wave2feature(enhancer(AMT.load_wave(fname)))
+    if sec_chunk > 0.0:
+        # (read sec_chunk at a time, for very long recordings)
+        return AMT.wav2feature_chunk(fname, sec_block=sec_chunk)
+    return AMT.wav2feature(fname)
+
+
+def decode_job(load, job_source, stat):
+    # load(fname): a_feature of fname
+    # yield: ((fname, output_fname), a_feature) (files that fail to load are skipped)
+    while True:
+        job = job_source.get()
+        if job is None:
+            break
+        fname, output_fname = job
+        print('[' + fname + ']')
+        time_s = time.time()
         try:
-            sound = AudioSegment.from_mp3(fname)
-            sound.export(fname.replace('.mp3', '.wav'), format="wav")
-        except CouldntDecodeError:
-            print('failed to convert ' + fname)
-            return None
-    return wav_file
+            a_feature = load(fname)
+        except Exception as e:
+            job_source.fail(fname, e)
+            continue
+        stat.add(time.time() - time_s)
+        yield (fname, output_fname), a_feature
+
+
+def decode_worker(load, job_source, queue_feature, stat):
+    # job_source -> queue_feature (None at the end)
+    for item in decode_job(load, job_source, stat):
+        queue_feature.put(item)
+    queue_feature.put(None)
+
+
+def read_feature(queue_feature, n_worker, stat_wait):
+    # yield the items of queue_feature until all the decode workers end
+    n_end = 0
+    while n_end < n_worker:
+        depth = queue_feature.qsize()
+        time_s = time.time()
+        item = queue_feature.get()
+        stat_wait.add(time.time() - time_s, depth, num=int(item is not None))
+        if item is None:
+            n_end += 1
+            continue
+        yield item
+
+
+AMT_post = None
+def init_post(config):
+    global AMT_post
+    AMT_post = amt.AMT(config, None, verbose_flag=False)
+
+
+def post_process(job):
+    # job: (fname, output_fname, output, a_param)
+    # return: (fname, output_fname, time, error)
+    fname, output_fname, output, a_param = job
+    time_s = time.time()
+    try:
+        output_2nd_onset, output_2nd_offset, output_2nd_mpe, output_2nd_velocity = output
+
+        # note (mpe2note)
+        a_note_2nd_predict = AMT_post.mpe2note(
+            a_onset=output_2nd_onset,
+            a_offset=output_2nd_offset,
+            a_mpe=output_2nd_mpe,
+            a_velocity=output_2nd_velocity,
+            thred_onset=a_param['thred_onset'],
+            thred_offset=a_param['thred_offset'],
+            thred_mpe=a_param['thred_mpe'],
+            mode_velocity='ignore_zero',
+            mode_offset='shorter'
+        )
+
+        AMT_post.note2midi(a_note_2nd_predict, output_fname)
+    except Exception as e:
+        return fname, output_fname, time.time() - time_s, str(e)
+    return fname, output_fname, time.time() - time_s, None
 
 
 if __name__ == '__main__':
@@ -41,7 +206,7 @@ if __name__ == '__main__':
     parser.add_argument('-model_file', help='input model file', default='best_model.pkl')
     parser.add_argument('-start_index', help='start index', type=int, default=None)
     parser.add_argument('-end_index', help='end index', type=int, default=None)
-    parser.add_argument('-skip_transcribe_mp3', action='store_true', default=False)
+    parser.add_argument('-skip_transcribe_mp3', help='skip .mp3 files', action='store_true', default=False)
     # parameters
     parser.add_argument('-mode', help='mode to transcript (combination|single)', default='combination')
     parser.add_argument('-thred_mpe', help='threshold value for mpe detection', type=float, default=0.5)
@@ -49,24 +214,40 @@ if __name__ == '__main__':
     parser.add_argument('-thred_offset', help='threshold value for offset detection', type=float, default=0.5)
     parser.add_argument('-n_stride', help='number of samples for offset', type=int, default=0)
     parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-enhance', help='speech enhancement (speechbrain) before the feature extraction', action='store_true')
+    parser.add_argument('-quantize', help='int8 dynamic quantization of the Linear layers (CPU)', action='store_true')
+    parser.add_argument('-amp', help='mixed precision inference (none|fp16|bf16)(none)', default='none')
+    parser.add_argument('-chunk', help='read the audio this many sec at a time to bound the memory (0: whole file)(0)', type=float, default=0.0)
+    parser.add_argument('-batch', help='number of windows per forward pass, shared across files(8)', type=int, default=8)
+    parser.add_argument('-d_cache', help='feature cache directory (no cache if not set)', default=None)
+    parser.add_argument('-cache_size', help='maximum size of the feature cache in GB (no limit if not set)', type=float, default=None)
+    parser.add_argument('-cache_dtype', help='dtype of the cached feature (float32|float16)', default='float32')
+    parser.add_argument('-n_decode', help='number of decode/feature threads (0: decode in the main loop)(2)', type=int, default=2)
+    parser.add_argument('-n_write', help='number of mpe2note/MIDI writer processes (0: write in the main loop)(2)', type=int, default=2)
+    parser.add_argument('-queue', help='maximum number of files waiting between the stages(4)', type=int, default=4)
+    parser.add_argument('-f_queue', help='SQLite file of the work queue shared by the workers (no queue if not set)', default=None)
+    parser.add_argument('-lease', help='lease of a claimed file in sec, renewed by heartbeats(600)', type=float, default=600.0)
+    parser.add_argument('-max_try', help='number of tries before a file is marked as failed(3)', type=int, default=3)
     args = parser.parse_args()
 
     assert (args.input_dir_to_transcribe is not None) or (args.input_file_to_transcribe is not None), "input file or directory is not specified"
 
     if args.input_dir_to_transcribe is not None:
-        if not args.skip_transcribe_mp3:
-            # list file
-            a_mp3s = (
-                    glob.glob(os.path.join(args.input_dir_to_transcribe, '*.mp3')) +
-                    glob.glob(os.path.join(args.input_dir_to_transcribe, '*', '*.mp3'))
-            )
-            print(f'transcribing {len(a_mp3s)} files: [{str(a_mp3s)}]...')
-            list(map(check_and_convert_mp3_to_wav, a_mp3s))
-
-        a_list = (
-            glob.glob(os.path.join(args.input_dir_to_transcribe, '*.wav')) +
-            glob.glob(os.path.join(args.input_dir_to_transcribe, '*', '*.wav'))
-        )
+        # list file
+        a_list = []
+        a_stem = set()
+        for ext in a_ext:
+            if (ext == 'mp3') and args.skip_transcribe_mp3:
+                continue
+            for fname in (
+                glob.glob(os.path.join(args.input_dir_to_transcribe, '*.'+ext)) +
+                glob.glob(os.path.join(args.input_dir_to_transcribe, '*', '*.'+ext))
+            ):
+                if os.path.splitext(fname)[0] not in a_stem:
+                    a_stem.add(os.path.splitext(fname)[0])
+                    a_list.append(fname)
+        print(f'transcribing {len(a_list)} files...')
+
         if (args.start_index is not None) or (args.end_index is not None):
             if args.start_index is None:
                 args.start_index = 0
@@ -77,9 +258,6 @@ if __name__ == '__main__':
         random.shuffle(a_list)
 
     elif args.input_file_to_transcribe is not None:
-        args.input_file_to_transcribe = check_and_convert_mp3_to_wav(args.input_file_to_transcribe)
-        if args.input_file_to_transcribe is None:
-            sys.exit()
         a_list = [args.input_file_to_transcribe]
         print(f'transcribing {str(a_list)} files...')
 
@@ -87,63 +265,133 @@ if __name__ == '__main__':
     with open(args.f_config, 'r', encoding='utf-8') as f:
         config = json.load(f)
 
+    # feature cache
+    if args.d_cache is not None:
+        cache_size = None if args.cache_size is None else int(args.cache_size * (1 << 30))
+        cache = feature_cache.Feature_Cache(args.d_cache, config, max_size=cache_size, dtype=args.cache_dtype)
+    else:
+        cache = None
+
+    # mpe2note/MIDI writer processes (started before the model is loaded)
+    pool = Pool(args.n_write, initializer=init_post, initargs=(config,)) if args.n_write > 0 else None
+
     # AMT class
-    AMT = amt.AMT(config, args.model_file, verbose_flag=False)
+    AMT = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False, feature_cache=cache,
+                  quantize='dynamic' if args.quantize is True else None, amp=None if args.amp == 'none' else args.amp)
+    if pool is None:
+        init_post(config)
 
     long_filename_counter = 0
-    for fname in a_list:
+    def make_job(fname):
         if args.output_file is not None:
             output_fname = args.output_file
         else:
-            output_fname = fname.replace('.wav', '')
+            output_fname = os.path.splitext(fname)[0]
             if len(output_fname) > 200:
                 output_fname = output_fname[:200] + f'_fnabbrev-{long_filename_counter}'
             output_fname += '_transcribed.mid'
             output_fname = os.path.join(args.output_dir, os.path.basename(output_fname))
             if os.path.exists(output_fname):
-                continue
+                return None
+        return fname, output_fname
 
-        print('[' + fname + ']')
-        try:
-            a_feature = AMT.wav2feature(fname)
+    # work queue: every worker adds its list (files already in the queue are
+    # kept), then claims files until none is left
+    if args.f_queue is not None:
+        wq = work_queue.Work_Queue(args.f_queue, lease=args.lease, max_try=args.max_try)
+        wq.add(a_list)
+        wq.start_heartbeat()
+        print(' work queue     : '+str(args.f_queue)+' '+str(wq.status()))
+    else:
+        wq = None
+    job_source = Job_Source(a_list, make_job, wq=wq)
+    enhancer = Enhancer() if args.enhance is True else None
+    load = functools.partial(load_feature, AMT, enhancer=enhancer, sec_chunk=args.chunk)
 
-            # transcript
-            if args.n_stride > 0:
-                output = AMT.transcript_stride(a_feature, args.n_stride, mode=args.mode, ablation_flag=args.ablation)
-            else:
-                output = AMT.transcript(a_feature, mode=args.mode, ablation_flag=args.ablation)
-            (output_1st_onset, output_1st_offset, output_1st_mpe, output_1st_velocity,
-             output_2nd_onset, output_2nd_offset, output_2nd_mpe, output_2nd_velocity) = output
-
-            # note (mpe2note)
-            a_note_1st_predict = AMT.mpe2note(
-                a_onset=output_1st_onset,
-                a_offset=output_1st_offset,
-                a_mpe=output_1st_mpe,
-                a_velocity=output_1st_velocity,
-                thred_onset=args.thred_onset,
-                thred_offset=args.thred_offset,
-                thred_mpe=args.thred_mpe,
-                mode_velocity='ignore_zero',
-                mode_offset='shorter'
-            )
-
-            a_note_2nd_predict = AMT.mpe2note(
-                a_onset=output_2nd_onset,
-                a_offset=output_2nd_offset,
-                a_mpe=output_2nd_mpe,
-                a_velocity=output_2nd_velocity,
-                thred_onset=args.thred_onset,
-                thred_offset=args.thred_offset,
-                thred_mpe=args.thred_mpe,
-                mode_velocity='ignore_zero',
-                mode_offset='shorter'
-            )
-
-            AMT.note2midi(a_note_2nd_predict, output_fname)
-        except Exception as e:
-            print(e)
-            continue
+    stat_decode = Stage_Stat()
+    stat_wait = Stage_Stat()
+    stat_model = Stage_Stat()
+    stat_write = Stage_Stat()
+    time_start = time.time()
+
+    ## (1) decode/feature
+    if args.n_decode > 0:
+        queue_feature = queue.Queue(maxsize=args.queue)
+        a_thread = [threading.Thread(target=decode_worker, args=(load, job_source, queue_feature, stat_decode), daemon=True)
+                    for _ in range(args.n_decode)]
+        for thread in a_thread:
+            thread.start()
+        a_input_file = read_feature(queue_feature, args.n_decode, stat_wait)
+    else:
+        a_input_file = decode_job(load, job_source, stat_decode)
+
+    ## (3) mpe2note/MIDI
+    # (at most `queue` files are waiting for the writers)
+    a_param = {'thred_onset': args.thred_onset, 'thred_offset': args.thred_offset, 'thred_mpe': args.thred_mpe}
+    sem_write = threading.BoundedSemaphore(max(args.queue, 1))
+    a_depth_write = [0]
+    lock_write = threading.Lock()
+    def done_write(result):
+        fname, output_fname, time_write, error = result
+        if error is None:
+            print('[' + fname + '] -> ' + output_fname)
+            job_source.done(fname)
+        else:
+            job_source.fail(fname, error)
+        stat_write.add(time_write)
+        with lock_write:
+            a_depth_write[0] -= 1
+        sem_write.release()
+
+    def error_write(fname, e):
+        job_source.fail(fname, e)
+        with lock_write:
+            a_depth_write[0] -= 1
+        sem_write.release()
+
+    ## (2) model
+    # transcript (only output_2nd is written, so the 1st stage heads are skipped)
+    # (velocity is only evaluated where onset >= thred_onset)
+    # windows of several files share the same batch, and each file is
+    # written as soon as its last window is done
+    # (a file that fails in the model is marked as failed, and the other files go on)
+    n_offset = args.n_stride if args.n_stride > 0 else None
+    a_output_file = AMT.transcript_files(a_input_file, n_offset=n_offset,
+                                         mode=args.mode, ablation_flag=args.ablation,
+                                         output_stage='2nd', thred_onset=args.thred_onset,
+                                         on_error=lambda key, e: job_source.fail(key[0], e))
+    # (time of the model stage excludes the waits for the decode stage)
+    time_s = time.time()
+    time_wait_s = stat_wait.time
+    for (fname, output_fname), output in a_output_file:
+        time_model = (time.time() - time_s) - (stat_wait.time - time_wait_s)
+        job = (fname, output_fname, output, a_param)
+        sem_write.acquire()
+        with lock_write:
+            stat_model.add(time_model, a_depth_write[0])
+            a_depth_write[0] += 1
+        if pool is None:
+            done_write(post_process(job))
+        else:
+            pool.apply_async(post_process, (job,), callback=done_write, error_callback=functools.partial(error_write, fname))
+        time_s = time.time()
+        time_wait_s = stat_wait.time
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    time_end = time.time()
+    if wq is not None:
+        print(' work queue     : '+str(args.f_queue)+' '+str(wq.status()))
+        wq.close()
+
+    # queue: files waiting for the next stage when the stage takes/hands over a file
+    print('** pipeline **')
+    stat_decode.report('decode/feature')
+    stat_wait.report('model (waiting for decode/feature)')
+    stat_model.report('model')
+    stat_write.report('mpe2note/MIDI')
+    print(' total (sec)    : '+str(time_end - time_start))
 
     print('** done **')
 
@@ -222,4 +470,16 @@ python evaluation/transcribe_new_files.py \
     -f_config corpus/MAESTRO-V3/dataset/config-aug.json \
     -model_file evaluation/checkpoint/MAESTRO-V3/model-with-aug-data_006_009.pkl \
     -start_index 5741 -end_index 6185
+
+
+## same corpus without the index ranges: run this on every box, each box
+## claims files from the shared queue until the corpus is done
+## (files of a box that stopped are taken over when their lease expires)
+
+python evaluation/transcribe_new_files.py \
+    -input_dir_to_transcribe '../corpus/*' \
+    -output_dir ../data/2024-01-09__full-corpus__006-009-model/ \
+    -f_config corpus/MAESTRO-V3/dataset/config-aug.json \
+    -model_file evaluation/checkpoint/MAESTRO-V3/model-with-aug-data_006_009.pkl \
+    -f_queue ../data/2024-01-09__full-corpus__006-009-model/queue.sqlite
 """
@@ -0,0 +1,83 @@
+#! python
+
+import os
+import argparse
+import json
+import sys
+import time
+import torchaudio
+sys.path.append(os.getcwd())
+from model import amt
+from model import amt_stream
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-input_file', help='input audio file')
+    parser.add_argument('-output_file', help='output MIDI file')
+    parser.add_argument('-f_config', help='config json file', default='../corpus/config.json')
+    parser.add_argument('-model_file', help='input model file', default='best_model.pkl')
+    parser.add_argument('-chunk', help='chunk length in sec (1.0)', type=float, default=1.0)
+    parser.add_argument('-mode', help='mode to transcript (combination|single)', default='combination')
+    parser.add_argument('-output', help='output_1st(1st)|output_2nd(2nd)', default='2nd')
+    parser.add_argument('-thred_mpe', help='threshold value for mpe detection', type=float, default=0.5)
+    parser.add_argument('-thred_onset', help='threshold value for onset detection', type=float, default=0.5)
+    parser.add_argument('-thred_offset', help='threshold value for offset detection', type=float, default=0.5)
+    parser.add_argument('-ablation', help='ablation mode', action='store_true')
+    parser.add_argument('-batch', help='number of windows per forward pass(1)', type=int, default=1)
+    parser.add_argument('-verbose', help='print notes when they are emitted', action='store_true')
+    args = parser.parse_args()
+
+    print('** AMT: streaming transcription **')
+    print(' input file     : '+str(args.input_file))
+    print(' output file    : '+str(args.output_file))
+    print(' config file    : '+str(args.f_config))
+    print(' model file     : '+str(args.model_file))
+    print(' chunk (sec)    : '+str(args.chunk))
+    print(' mode           : '+str(args.mode))
+    print(' output         : '+str(args.output))
+    print(' batch          : '+str(args.batch))
+
+    with open(args.f_config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    AMT = amt.AMT(config, args.model_file, batch_size=args.batch, verbose_flag=False)
+
+    # the file is read chunk by chunk, as if it were a live feed
+    info = torchaudio.info(args.input_file)
+    sr = info.sample_rate
+    len_chunk = max(int(args.chunk * sr), 1)
+    stream = amt_stream.AMT_Stream(AMT, sr, mode=args.mode, output=args.output, ablation_flag=args.ablation,
+                                   thred_onset=args.thred_onset, thred_offset=args.thred_offset, thred_mpe=args.thred_mpe,
+                                   mode_velocity='ignore_zero', mode_offset='shorter')
+
+    a_note = []
+    time_s = time.time()
+    n_offset = 0
+    while True:
+        wave, _ = torchaudio.load(args.input_file, frame_offset=n_offset, num_frames=len_chunk)
+        if wave.shape[-1] == 0:
+            break
+        n_offset += wave.shape[-1]
+        a_note_chunk = stream.transcript_chunk(wave)
+        if args.verbose is True:
+            for note in a_note_chunk:
+                print(' '+str(n_offset/sr)+' '+str(note))
+        a_note += a_note_chunk
+    a_note += stream.flush()
+    time_e = time.time()
+
+    a_note = sorted(sorted(a_note, key=lambda x: x['pitch']), key=lambda x: x['onset'])
+    AMT.note2midi(a_note, args.output_file)
+
+    a_latency = stream.latency()
+    print('** latency (sec) **')
+    print(' window         : '+str(a_latency['window']))
+    print(' stft           : '+str(a_latency['stft']))
+    print(' resample       : '+str(a_latency['resample']))
+    print(' total          : '+str(a_latency['total']))
+    print(' note (mean)    : '+str(a_latency['note_mean']))
+    print(' note (max)     : '+str(a_latency['note_max']))
+    print(' notes          : '+str(a_latency['note_num']))
+    print(' audio (sec)    : '+str(n_offset/sr))
+    print(' process (sec)  : '+str(time_e-time_s))
+    print('** done **')
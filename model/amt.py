@@ -1,13 +1,388 @@
 #! python
 
 import pickle
+import threading
+import contextlib
 import torch
 import numpy as np
 import torchaudio
 import pretty_midi
+from model import amt_backend
+from model import amt_quantize
+
+# amp: autocast dtype
+a_amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+##
+## note detection (vectorized)
+##
+def detect_peak(a_value, thred, hop_sec, loc_s=0):
+    # a_value: [n_frame, n_note]
+    # local maximum (>= thred) along time; a plateau is compared with the
+    # nearest different value on both sides, the same as mpe2note_loop
+    # (loc_s: frame number of a_value[0], for a buffer cut out of a longer sequence)
+    a_value = np.asarray(a_value)
+    n_frame = a_value.shape[0]
+    a_frame = np.arange(n_frame).reshape(-1, 1)
+
+    # a_run_s/a_run_e: first/last frame of the plateau each frame belongs to
+    flag_change = np.zeros(a_value.shape, dtype=bool)
+    flag_change[1:] = a_value[1:] != a_value[:-1]
+    a_run_s = np.maximum.accumulate(np.where(flag_change, a_frame, 0), axis=0)
+    flag_change_e = np.zeros(a_value.shape, dtype=bool)
+    flag_change_e[:-1] = flag_change[1:]
+    a_run_e = np.minimum.accumulate(np.where(flag_change_e, a_frame, n_frame-1)[::-1], axis=0)[::-1]
+
+    flag_left = (a_run_s == 0) | (np.take_along_axis(a_value, np.maximum(a_run_s-1, 0), axis=0) < a_value)
+    flag_right = (a_run_e == n_frame-1) | (np.take_along_axis(a_value, np.minimum(a_run_e+1, n_frame-1), axis=0) < a_value)
+    # (compared/interpolated with the same precision as the scalar arithmetic in mpe2note_loop)
+    dtype = np.result_type(a_value.dtype.type(0) + 0.0)
+    flag_peak = (a_value.astype(dtype) >= np.asarray(thred, dtype=dtype)) & flag_left & flag_right
+
+    # a_pitch/a_loc: sorted by pitch, then by frame
+    a_pitch, a_loc = np.nonzero(flag_peak.T)
+    a_loc_e = a_run_e[a_loc, a_pitch] + loc_s
+
+    # sub-frame position (parabolic interpolation with both neighbors)
+    a_time = (a_loc + loc_s) * hop_sec
+    flag_inner = (a_loc > 0) & (a_loc < n_frame-1)
+    a_loc_inner = a_loc[flag_inner]
+    a_pitch_inner = a_pitch[flag_inner]
+    a_prev = a_value[a_loc_inner-1, a_pitch_inner]
+    a_curr = a_value[a_loc_inner, a_pitch_inner]
+    a_next = a_value[a_loc_inner+1, a_pitch_inner]
+    a_shift = np.zeros(len(a_loc_inner), dtype=dtype)
+    flag_l = a_prev > a_next
+    flag_r = a_prev < a_next
+    half_hop = np.asarray(hop_sec * 0.5, dtype=dtype)
+    a_shift[flag_l] = -(half_hop * (a_prev - a_next)[flag_l].astype(dtype) / (a_curr - a_next)[flag_l].astype(dtype))
+    a_shift[flag_r] = half_hop * (a_next - a_prev)[flag_r].astype(dtype) / (a_curr - a_prev)[flag_r].astype(dtype)
+    a_loc_inner = a_loc_inner + loc_s
+    a_time[flag_inner] = np.where(a_shift != 0.0, (a_loc_inner * hop_sec).astype(dtype) + a_shift, a_loc_inner * hop_sec)
+
+    # a_loc_e: last frame of the plateau of each peak
+    return a_pitch, a_loc + loc_s, a_time, a_loc_e
+
+
+def find_drop(a_value, thred):
+    # a_value: [n_frame, n_note]
+    # a_drop[i][j]: first frame >= i where a_value[][j] < thred (n_frame if none)
+    # a_drop: [n_frame+1, n_note]
+    a_value = np.asarray(a_value)
+    n_frame = a_value.shape[0]
+    a_frame = np.arange(n_frame+1, dtype=np.int32).reshape(-1, 1)
+    flag_drop = np.ones((n_frame+1, a_value.shape[1]), dtype=bool)
+    dtype = np.result_type(a_value.dtype.type(0) + 0.0)
+    flag_drop[:n_frame] = a_value.astype(dtype) < np.asarray(thred, dtype=dtype)
+    a_drop = np.minimum.accumulate(np.where(flag_drop, a_frame, n_frame)[::-1], axis=0)[::-1]
+
+    return a_drop
+
+
+def decode_note(a_onset_peak, a_offset_peak, a_mpe_drop, n_frame, hop_sec, mode_offset='shorter', loc_s=0):
+    # a_onset_peak/a_offset_peak: (a_pitch, a_loc, a_time) of detect_peak()
+    # a_mpe_drop: find_drop() of mpe[loc_s:n_frame]
+    # return: dict of [n_onset] arrays (sorted by pitch, then by frame)
+    #  offset: offset time before cutting at the next note (see cut_offset())
+    #  flag_*/loc_*: detected next onset/offset/mpe drop of each onset
+    a_onset_pitch, a_onset_loc, a_onset_time = a_onset_peak[:3]
+    a_offset_pitch, a_offset_loc, a_offset_time = a_offset_peak[:3]
+
+    # next onset of the same pitch (or the end of the data)
+    flag_next = np.zeros(len(a_onset_loc), dtype=bool)
+    flag_next[:-1] = a_onset_pitch[1:] == a_onset_pitch[:-1]
+    a_loc_next = np.full(len(a_onset_loc), n_frame, dtype=np.int64)
+    a_loc_next[:-1][flag_next[:-1]] = a_onset_loc[1:][flag_next[:-1]]
+    a_time_next = np.full(len(a_onset_loc), (n_frame-1) * hop_sec)
+    a_time_next[:-1][flag_next[:-1]] = a_onset_time[1:][flag_next[:-1]]
+
+    # offset: first offset after the onset (same pitch)
+    a_onset_key = a_onset_pitch * (n_frame+1) + a_onset_loc
+    a_offset_key = a_offset_pitch * (n_frame+1) + a_offset_loc
+    a_idx_offset = np.searchsorted(a_offset_key, a_onset_key, side='right')
+    # (sentinel pitch -1 for onsets without any offset after them)
+    a_offset_pitch = np.append(a_offset_pitch, -1)
+    a_offset_loc = np.append(a_offset_loc, 0)
+    a_offset_time = np.append(a_offset_time, 0.0)
+    flag_offset = a_offset_pitch[a_idx_offset] == a_onset_pitch
+    a_loc_detect = np.where(flag_offset, a_offset_loc[a_idx_offset], a_onset_loc+1)
+    a_time_offset = np.where(flag_offset, a_offset_time[a_idx_offset], 0.0)
+    flag_clip = a_loc_detect > a_loc_next
+    a_loc_offset = np.where(flag_clip, a_loc_next, a_loc_detect)
+    a_time_offset = np.where(flag_clip, a_time_next, a_time_offset)
+
+    # offset by MPE
+    # (1frame longer): first frame below thred_mpe in [loc_onset+1, loc_next)
+    a_loc_mpe = a_mpe_drop[np.minimum(a_onset_loc+1, n_frame)-loc_s, a_onset_pitch] + loc_s
+    flag_mpe = a_loc_mpe < a_loc_next
+    a_loc_mpe = np.where(flag_mpe, a_loc_mpe, a_onset_loc+1)
+    a_time_mpe = a_loc_mpe * hop_sec
+
+    if mode_offset == 'offset':
+        ## (a) offset
+        a_time_both = a_time_offset
+    elif mode_offset == 'longer':
+        ## (b) longer
+        a_time_both = np.where(a_loc_offset >= a_loc_mpe, a_time_offset, a_time_mpe)
+    else:
+        ## (c) shorter
+        a_time_both = np.where(a_loc_offset <= a_loc_mpe, a_time_offset, a_time_mpe)
+    a_offset_value = np.select([flag_offset & flag_mpe, flag_offset, flag_mpe],
+                               [a_time_both, a_time_offset, a_time_mpe],
+                               a_time_next)
+
+    return {'pitch': a_onset_pitch, 'loc': a_onset_loc, 'onset': a_onset_time, 'offset': a_offset_value,
+            'flag_next': flag_next, 'loc_next': a_loc_next,
+            'flag_offset': flag_offset, 'loc_offset': a_loc_detect,
+            'flag_mpe': flag_mpe, 'loc_mpe': a_loc_mpe}
+
+
+def cut_offset(a_pitch, a_onset, a_offset, flag_note):
+    # cut the offset at the onset of the next note (same pitch)
+    # (only notes with flag_note are taken into account)
+    a_offset = np.array(a_offset)
+    a_idx = np.nonzero(flag_note)[0]
+    a_pitch_note = a_pitch[a_idx]
+    a_onset_note = a_onset[a_idx]
+    a_offset_note = a_offset[a_idx]
+    flag_cut = (a_pitch_note[1:] == a_pitch_note[:-1]) & (a_onset_note[1:] < a_offset_note[:-1])
+    a_offset_note[:-1][flag_cut] = a_onset_note[1:][flag_cut]
+    a_offset[a_idx] = a_offset_note
+
+    return a_offset
+
+
+def note_list(a_pitch, a_onset, a_offset, a_velocity):
+    # a_note: sorted by onset, then by pitch
+    a_note = []
+    for i in np.lexsort((a_pitch, a_onset)):
+        a_note.append({'pitch': int(a_pitch[i]), 'onset': float(a_onset[i]), 'offset': float(a_offset[i]), 'velocity': int(a_velocity[i])})
+    return a_note
+
+
+def assemble_note(a_onset_peak, a_offset_peak, a_mpe_drop, a_velocity, n_frame, hop_sec, note_min,
+                  mode_velocity='ignore_zero', mode_offset='shorter'):
+    # notes of AMT.mpe2note() from detect_peak()/find_drop() results
+    # (the peaks can be shared by several thresholds/mode_offset, e.g. in a threshold sweep)
+    # a_velocity: [n_frame, n_note]
+    a_note = decode_note(a_onset_peak, a_offset_peak, a_mpe_drop, n_frame, hop_sec, mode_offset=mode_offset)
+
+    a_velocity_value = np.asarray(a_velocity)[a_note['loc'], a_note['pitch']].astype(np.int64)
+    if mode_velocity == 'ignore_zero':
+        flag_note = a_velocity_value > 0
+    else:
+        flag_note = np.ones(len(a_velocity_value), dtype=bool)
+    a_offset_value = cut_offset(a_note['pitch'], a_note['onset'], a_note['offset'], flag_note)
+
+    return note_list(a_note['pitch'][flag_note] + note_min,
+                     a_note['onset'][flag_note],
+                     a_offset_value[flag_note],
+                     a_velocity_value[flag_note])
+
+
+##
+## streaming feature extraction
+##
+class Resample_Stream():
+    # torchaudio.transforms.Resample applied chunk by chunk
+    # (the concatenated output is the same as one call on the whole signal, up to float rounding)
+    def __init__(self, orig_freq, new_freq):
+        self.flag_through = (orig_freq == new_freq)
+        if self.flag_through is True:
+            return
+        self.tr = torchaudio.transforms.Resample(orig_freq, new_freq)
+        self.n_orig = int(orig_freq) // self.tr.gcd
+        self.n_new = int(new_freq) // self.tr.gcd
+        # resampled block b (n_new samples) needs input [b*n_orig-width, b*n_orig+width+n_orig)
+        self.wave = torch.zeros(self.tr.width)
+        self.n_input = 0
+        self.n_output = 0
+
+    def __call__(self, wave, flag_end=False):
+        # wave: [n_sample] (mono)
+        if self.flag_through is True:
+            return wave
+        self.wave = torch.cat([self.wave, wave.to(self.wave.dtype)])
+        self.n_input += len(wave)
+        if flag_end is True:
+            self.wave = torch.cat([self.wave, torch.zeros(self.tr.width+self.n_orig)])
+
+        len_kernel = self.tr.kernel.shape[-1]
+        n_block = 0
+        if len(self.wave) >= len_kernel:
+            n_block = (len(self.wave) - len_kernel) // self.n_orig + 1
+        if n_block == 0:
+            return torch.zeros(0)
+        wave_block = self.wave[:(n_block-1)*self.n_orig+len_kernel]
+        wave_new = torch.nn.functional.conv1d(wave_block[None, None], self.tr.kernel, stride=self.n_orig)
+        wave_new = wave_new.transpose(1, 2).reshape(-1)
+        self.wave = self.wave[n_block*self.n_orig:]
+
+        if flag_end is True:
+            n_target = int(np.ceil(self.n_new * self.n_input / self.n_orig))
+            wave_new = wave_new[:max(n_target-self.n_output, 0)]
+        self.n_output += len(wave_new)
+        return wave_new
+
+
+class Feature_Stream():
+    # AMT.wav2feature() applied chunk by chunk
+    # (frames are emitted as soon as their STFT window is complete;
+    #  the edges are padded with zeros, i.e. pad_mode 'constant')
+    def __init__(self, config, sr):
+        if config['feature']['pad_mode'] != 'constant':
+            raise ValueError('Feature_Stream supports pad_mode constant only: '+str(config['feature']['pad_mode']))
+        self.config = config
+        self.tr_fsconv = Resample_Stream(sr, self.config['feature']['sr'])
+        self.tr_mel = torchaudio.transforms.MelSpectrogram(
+            sample_rate=self.config['feature']['sr'],
+            n_fft=self.config['feature']['fft_bins'],
+            win_length=self.config['feature']['window_length'],
+            hop_length=self.config['feature']['hop_sample'],
+            n_mels=self.config['feature']['mel_bins'],
+            norm='slaney',
+            center=False
+        )
+        self.n_fft = self.config['feature']['fft_bins']
+        self.hop_sample = self.config['feature']['hop_sample']
+        self.wave = torch.zeros(self.n_fft // 2)
+
+    def __call__(self, wave, flag_end=False):
+        # wave: [n_channel, n_sample] or [n_sample]
+        # a_feature: [n_frame, n_mels]
+        wave = torch.as_tensor(wave, dtype=torch.float32)
+        if wave.dim() > 1:
+            wave = torch.mean(wave, dim=0)
+        wave_16k = self.tr_fsconv(wave, flag_end=flag_end)
+        self.wave = torch.cat([self.wave, wave_16k])
+        if flag_end is True:
+            self.wave = torch.cat([self.wave, torch.zeros(self.n_fft // 2)])
+
+        n_frame = 0
+        if len(self.wave) >= self.n_fft:
+            n_frame = (len(self.wave) - self.n_fft) // self.hop_sample + 1
+        if n_frame == 0:
+            return torch.zeros(0, self.config['feature']['mel_bins'])
+        mel_spec = self.tr_mel(self.wave[:(n_frame-1)*self.hop_sample+self.n_fft])
+        self.wave = self.wave[n_frame*self.hop_sample:]
+        a_feature = (torch.log(mel_spec + self.config['feature']['log_offset'])).T
+
+        return a_feature
+
+
+##
+## audio file -> waveform (in memory)
+##
+def load_audio(f_audio):
+    # f_audio: wav/flac/ogg/mp3/... file
+    # return: wave [n_channel, n_sample] (float32 in [-1, 1]), sr
+    # (formats the torchaudio backend cannot read are decoded with pydub (ffmpeg),
+    #  without writing a converted file)
+    try:
+        return torchaudio.load(f_audio)
+    except (RuntimeError, OSError, ImportError):
+        pass
+    from pydub import AudioSegment
+    sound = AudioSegment.from_file(f_audio)
+    a_wave = np.array(sound.get_array_of_samples(), dtype=np.float32).reshape(-1, sound.channels).T
+    a_wave /= float(1 << (8 * sound.sample_width - 1))
+    return torch.from_numpy(np.ascontiguousarray(a_wave)), sound.frame_rate
+
+
+def read_audio_block(f_audio, sec_block=60.0):
+    # yield: (wave [n_channel, n_sample], sr) of each block of sec_block
+    # the file is read block by block with a seekable reader:
+    #  soundfile (wav/flac/ogg/...), the wave module (PCM wav), or
+    #  torchaudio.load(frame_offset=) where torchaudio.info() exists (torchaudio < 2.9)
+    # (other files, e.g. mp3, are decoded at once and then split: the memory is
+    #  not bounded by the block)
+    for reader in [_read_block_soundfile, _read_block_wave, _read_block_torchaudio]:
+        a_block = reader(f_audio, sec_block)
+        if a_block is not None:
+            yield from a_block
+            return
+
+    print('(warning) '+str(f_audio)+': no seekable reader, the whole file is decoded (memory not bounded by sec_block)')
+    wave, sr = load_audio(f_audio)
+    len_block = max(int(sec_block * sr), 1)
+    for i in range(0, wave.shape[-1], len_block):
+        yield wave[:, i:i+len_block], sr
+
+
+def _read_block_soundfile(f_audio, sec_block):
+    # return: generator of the blocks, None if soundfile cannot open the file
+    try:
+        import soundfile
+        f = soundfile.SoundFile(f_audio)
+    except (ImportError, OSError, RuntimeError):
+        return None
+    def read_block():
+        with f:
+            len_block = max(int(sec_block * f.samplerate), 1)
+            while True:
+                a_wave = f.read(len_block, dtype='float32', always_2d=True)
+                if len(a_wave) == 0:
+                    break
+                yield torch.from_numpy(np.ascontiguousarray(a_wave.T)), f.samplerate
+    return read_block()
+
+
+def _read_block_wave(f_audio, sec_block):
+    # return: generator of the blocks, None if the file is not a PCM wav file
+    # (scaled to [-1, 1] as torchaudio.load() does: 8 bit is unsigned)
+    import wave
+    try:
+        f = wave.open(str(f_audio), 'rb')
+    except (wave.Error, EOFError, OSError):
+        return None
+    sample_width = f.getsampwidth()
+    if sample_width not in [1, 2, 3, 4]:
+        f.close()
+        return None
+    def read_block():
+        with f:
+            n_channel = f.getnchannels()
+            sr = f.getframerate()
+            len_block = max(int(sec_block * sr), 1)
+            while True:
+                a_byte = f.readframes(len_block)
+                if len(a_byte) == 0:
+                    break
+                if sample_width == 1:
+                    a_wave = (np.frombuffer(a_byte, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+                elif sample_width == 3:
+                    # (24 bit: the 3 bytes are the upper bytes of an int32)
+                    a_int = np.zeros((len(a_byte) // 3, 4), dtype=np.uint8)
+                    a_int[:, 1:] = np.frombuffer(a_byte, dtype=np.uint8).reshape(-1, 3)
+                    a_wave = a_int.view('<i4').reshape(-1).astype(np.float32) / float(1 << 31)
+                else:
+                    dtype = '<i2' if sample_width == 2 else '<i4'
+                    a_wave = np.frombuffer(a_byte, dtype=dtype).astype(np.float32) / float(1 << (8 * sample_width - 1))
+                yield torch.from_numpy(np.ascontiguousarray(a_wave.reshape(-1, n_channel).T)), sr
+    return read_block()
+
+
+def _read_block_torchaudio(f_audio, sec_block):
+    # return: generator of the blocks, None without torchaudio.info() (torchaudio >= 2.9)
+    try:
+        info = torchaudio.info(f_audio)
+    except (RuntimeError, OSError, ImportError, AttributeError):
+        return None
+    def read_block():
+        sr = info.sample_rate
+        len_block = max(int(sec_block * sr), 1)
+        n_offset = 0
+        while True:
+            wave, _ = torchaudio.load(f_audio, frame_offset=n_offset, num_frames=len_block)
+            if wave.shape[-1] == 0:
+                break
+            n_offset += wave.shape[-1]
+            yield wave, sr
+    return read_block()
+
 
 class AMT():
-    def __init__(self, config, model_path, batch_size=1, verbose_flag=False):
+    def __init__(self, config, model_path, batch_size=1, verbose_flag=False, feature_cache=None, quantize=None, amp=None):
         if verbose_flag is True:
             print('torch version: '+torch.__version__)
             print('torch cuda   : '+str(torch.cuda.is_available()))
@@ -18,18 +393,77 @@ class AMT():
 
         self.config = config
 
+        # model_path: pickled model (.pkl) | exported graph (.pt/.ts: TorchScript, .onnx: onnxruntime)
+        #  (see evaluation/export_model.py)
+        self.flag_runtime = False
         if model_path == None:
             self.model = None
+        elif model_path.endswith(('.pt', '.ts', '.onnx')):
+            self.model = amt_backend.Model_Runtime(model_path, device=self.device)
+            self.flag_runtime = True
+            if verbose_flag is True:
+                print('runtime outputs: '+str(self.model.output_names))
         else:
             with open(model_path, 'rb') as f:
                 self.model = pickle.load(f)
+            # quantize: None | 'dynamic' (int8 Linear layers, see evaluation/quantize_model.py)
+            if quantize == 'dynamic':
+                self.model = amt_quantize.quantize_dynamic(self.model)
+            if amt_quantize.is_quantized(self.model):
+                # (int8 kernels are CPU only)
+                self.device = 'cpu'
             self.model = self.model.to(self.device)
             self.model.eval()
             if verbose_flag is True:
                 print(self.model)
 
+        if batch_size is None:
+            batch_size = 1
         self.batch_size = batch_size
 
+        # amp: None (float32) | 'fp16' | 'bf16' (autocast of the pickled model; bf16 for CPU)
+        # (outputs are returned as float32)
+        self.amp = amp
+
+        # feature_cache: Feature_Cache (model/feature_cache.py) used by wav2feature()
+        self.feature_cache = feature_cache
+
+        # transforms are built once (Resample: per source sample rate)
+        self.lock_transform = threading.Lock()
+        self.a_tr_fsconv = {}
+        self.tr_mel = None
+
+
+    def get_resample(self, sr):
+        # torchaudio.transforms.Resample(sr -> config['feature']['sr'])
+        with self.lock_transform:
+            if sr not in self.a_tr_fsconv:
+                self.a_tr_fsconv[sr] = torchaudio.transforms.Resample(sr, self.config['feature']['sr'])
+            return self.a_tr_fsconv[sr]
+
+
+    def get_mel(self):
+        with self.lock_transform:
+            if self.tr_mel is None:
+                self.tr_mel = torchaudio.transforms.MelSpectrogram(
+                    sample_rate=self.config['feature']['sr'],
+                    n_fft=self.config['feature']['fft_bins'],
+                    win_length=self.config['feature']['window_length'],
+                    hop_length=self.config['feature']['hop_sample'],
+                    pad_mode=self.config['feature']['pad_mode'],
+                    n_mels=self.config['feature']['mel_bins'],
+                    norm='slaney'
+                )
+            return self.tr_mel
+
+
+    def load_wave(self, f_audio):
+        # f_audio: wav/flac/ogg/mp3/... file
+        # return: mono waveform at config['feature']['sr'] [n_sample]
+        wave, sr = load_audio(f_audio)
+        wave_mono = torch.mean(wave, dim=0)
+        return self.get_resample(sr)(wave_mono)
+
 
     def wav2feature(self, f_wav):
         ### torchaudio
@@ -52,159 +486,351 @@ class AMT():
         ## melfilter: htk
         ## normalize: none -> slaney
 
-        wave, sr = torchaudio.load(f_wav)
-        wave_mono = torch.mean(wave, dim=0)
-        tr_fsconv = torchaudio.transforms.Resample(sr, self.config['feature']['sr'])
-        wave_mono_16k = tr_fsconv(wave_mono)
-        tr_mel = torchaudio.transforms.MelSpectrogram(
-            sample_rate=self.config['feature']['sr'],
-            n_fft=self.config['feature']['fft_bins'],
-            win_length=self.config['feature']['window_length'],
-            hop_length=self.config['feature']['hop_sample'],
-            pad_mode=self.config['feature']['pad_mode'],
-            n_mels=self.config['feature']['mel_bins'],
-            norm='slaney'
-        )
-        mel_spec = tr_mel(wave_mono_16k)
+        if self.feature_cache is not None:
+            key = self.feature_cache.key(f_wav)
+            a_cache = self.feature_cache.get(key)
+            if a_cache is not None:
+                return torch.from_numpy(np.array(a_cache, dtype=np.float32))
+
+        a_feature = self.wave2feature(self.load_wave(f_wav))
+
+        if self.feature_cache is not None:
+            self.feature_cache.put(key, a_feature.numpy())
+            if self.feature_cache.dtype == 'float16':
+                # (same values as the ones read from the cache)
+                a_feature = a_feature.to(torch.float16).to(torch.float32)
+
+        return a_feature
+
+
+    def wav2feature_batch(self, a_f_wav):
+        # wav2feature() of several files: the clips of the same sample rate are
+        # resampled one by one (with the shared kernel), zero padded to the
+        # longest one and transformed to mel spectrogram in one call
+        # (the zeros after a clip are the same as the padding of wav2feature(),
+        #  so the features are the same up to float rounding of the batched STFT;
+        #  with pad_mode other than 'constant' they are computed clip by clip)
+        # return: [a_feature [n_frame, n_mels]] (same order as a_f_wav)
+        a_feature = [None] * len(a_f_wav)
+        a_key = [None] * len(a_f_wav)
+        a_wave = {}
+        for i, f_wav in enumerate(a_f_wav):
+            if self.feature_cache is not None:
+                a_key[i] = self.feature_cache.key(f_wav)
+                a_cache = self.feature_cache.get(a_key[i])
+                if a_cache is not None:
+                    a_feature[i] = torch.from_numpy(np.array(a_cache, dtype=np.float32))
+                    a_key[i] = None
+                    continue
+            wave, sr = load_audio(f_wav)
+            # a_wave[sr]: [(i, wave_mono_16k)]
+            a_wave.setdefault(sr, []).append((i, self.get_resample(sr)(torch.mean(wave, dim=0))))
+
+        hop_sample = self.config['feature']['hop_sample']
+        for sr in a_wave:
+            if self.config['feature']['pad_mode'] == 'constant':
+                wave_batch = torch.zeros(len(a_wave[sr]), max([len(wave) for _, wave in a_wave[sr]]))
+                for b, (_, wave) in enumerate(a_wave[sr]):
+                    wave_batch[b, :len(wave)] = wave
+                mel_spec = self.get_mel()(wave_batch)
+                # mel_spec: [n_clip, n_mels, n_frame]
+                a_feature_sr = [(torch.log(mel_spec[b, :, :len(wave)//hop_sample+1] + self.config['feature']['log_offset'])).T
+                                for b, (_, wave) in enumerate(a_wave[sr])]
+            else:
+                a_feature_sr = [self.wave2feature(wave) for _, wave in a_wave[sr]]
+            for (i, _), feature in zip(a_wave[sr], a_feature_sr):
+                a_feature[i] = feature.contiguous()
+
+        if self.feature_cache is not None:
+            for i in range(len(a_f_wav)):
+                if a_key[i] is None:
+                    continue
+                self.feature_cache.put(a_key[i], a_feature[i].numpy())
+                if self.feature_cache.dtype == 'float16':
+                    a_feature[i] = a_feature[i].to(torch.float16).to(torch.float32)
+
+        return a_feature
+
+
+    def wav2feature_chunk(self, f_wav, sec_block=60.0, f_out=None):
+        # same feature as wav2feature() (up to float rounding), with the memory
+        # bounded by one block of audio: the file is read sec_block at a time,
+        # and Feature_Stream carries the resampler/STFT state across the blocks
+        # f_out: .npy file the feature is written to (returned memory-mapped)
+        # return: a_feature [n_frame, n_mels] (numpy)
+        # (the feature cache is not used)
+        # (with pad_mode other than 'constant', Feature_Stream does not apply:
+        #  the whole file is converted by wav2feature())
+        if self.config['feature']['pad_mode'] != 'constant':
+            a_feature = self.wav2feature(f_wav).numpy().astype(np.float32)
+            if f_out is None:
+                return a_feature
+            np.save(f_out, a_feature)
+            return np.load(f_out, mmap_mode='r')
+
+        fe = None
+        a_block = []
+        f = None
+        n_frame = 0
+        if f_out is not None:
+            # the header is written again with the number of frames at the end
+            # (an upper bound of the shape reserves its length)
+            f = open(f_out, 'wb')
+            len_header = self._write_npy_header(f, 10**12)
+
+        for wave, sr in read_audio_block(f_wav, sec_block):
+            if fe is None:
+                fe = Feature_Stream(self.config, sr)
+            a_feature = fe(wave).numpy()
+            n_frame += len(a_feature)
+            if f is None:
+                a_block.append(a_feature)
+            else:
+                f.write(np.ascontiguousarray(a_feature, dtype=np.float32).tobytes())
+        if fe is None:
+            fe = Feature_Stream(self.config, self.config['feature']['sr'])
+        a_feature = fe(torch.zeros(0), flag_end=True).numpy()
+        n_frame += len(a_feature)
+
+        if f is None:
+            a_block.append(a_feature)
+            return np.concatenate(a_block, axis=0).astype(np.float32)
+
+        f.write(np.ascontiguousarray(a_feature, dtype=np.float32).tobytes())
+        f.seek(0)
+        assert self._write_npy_header(f, n_frame) == len_header
+        f.close()
+        return np.load(f_out, mmap_mode='r')
+
+
+    def _write_npy_header(self, f, n_frame):
+        # header of a [n_frame, n_mels] float32 .npy file, padded to a fixed length
+        # return: length of the header
+        header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                       'fortran_order': False,
+                       'shape': (n_frame, self.config['feature']['mel_bins'])})
+        header = header.ljust(128 - len(np.lib.format.MAGIC_PREFIX) - 4 - 1) + '\n'
+        f.write(np.lib.format.magic(1, 0) + np.array(len(header), dtype='<u2').tobytes() + header.encode('latin1'))
+        return f.tell()
+
+
+    def wave2feature(self, wave_mono_16k):
+        # wave_mono_16k: mono waveform at config['feature']['sr'] [n_sample]
+        # return: a_feature [n_frame, n_mels]
+        mel_spec = self.get_mel()(wave_mono_16k)
         a_feature = (torch.log(mel_spec + self.config['feature']['log_offset'])).T
 
         return a_feature
 
 
-    def transcript(self, a_feature, mode='combination', ablation_flag=False):
+    def run_model(self, input_spec, mode='combination', ablation_flag=False, idx_s=0, idx_e=None, output_stage=None, thred_onset=None):
+        # input_spec: [n_batch, n_bins, margin_b+num_frame+margin_f]
+        # return: (onset, offset, mpe, velocity) of output_1st (and output_2nd for combination)
+        #  onset/offset/mpe: [n_batch, idx_e-idx_s, n_note]
+        #  velocity: [n_batch, idx_e-idx_s, n_note] (argmax)
+        # output_stage('1st'|'2nd'): only the outputs of the stage (combination)
+        # thred_onset: (with output_stage) velocity only where onset >= thred_onset, 0 elsewhere
+        #  (a superset of the onsets mpe2note() detects with the same threshold)
+        with torch.no_grad(), self.autocast():
+            if self.flag_runtime is True:
+                # exported graph: outputs are selected by name, velocity is dense
+                a_output_runtime = self.model(input_spec)
+                a_name = amt_backend.output_name(output_stage, mode)
+                for name in a_name:
+                    if name not in a_output_runtime:
+                        raise ValueError('the exported model has no output '+name+' (outputs: '+str(list(a_output_runtime.keys()))+')')
+                a_output = [a_output_runtime[name] for name in a_name]
+            elif (mode == 'combination') and (output_stage is not None):
+                if ablation_flag is True:
+                    # (ablation models always compute both stages)
+                    a_output = list(self.model(input_spec))
+                    a_output = a_output[0:4] if output_stage == '1st' else a_output[4:8]
+                else:
+                    a_output = list(self.model(input_spec, output_stage=output_stage, thred_onset=thred_onset))
+            elif mode == 'combination':
+                if ablation_flag is True:
+                    output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.model(input_spec)
+                else:
+                    output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.model(input_spec)
+                # output_onset: [batch_size, n_frame, n_note]
+                # output_offset: [batch_size, n_frame, n_note]
+                # output_mpe: [batch_size, n_frame, n_note]
+                # output_velocity: [batch_size, n_frame, n_note, n_velocity]
+                a_output = [output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B]
+            else:
+                output_onset_A, output_offset_A, output_mpe_A, output_velocity_A = self.model(input_spec)
+                a_output = [output_onset_A, output_offset_A, output_mpe_A, output_velocity_A]
+
+        for k in range(len(a_output)):
+            output = a_output[k][:, idx_s:idx_e]
+            if output.is_floating_point():
+                output = output.float()
+            if (k % 4 == 3) and (output.dim() == 4):
+                output = output.argmax(3)
+                if (self.flag_runtime is True) and (output_stage is not None) and (thred_onset is not None):
+                    # (same as the sparse velocity of the pickled model)
+                    # (a_output[k-3]: onset of the stage, already converted)
+                    output = output.to('cpu')
+                    output = torch.where(torch.from_numpy(a_output[k-3]) >= thred_onset, output, torch.zeros_like(output))
+            a_output[k] = output.to('cpu').detach().numpy()
+
+        return a_output
+
+
+    def autocast(self):
+        # (exported graphs run in their own precision)
+        if (self.amp is None) or (self.flag_runtime is True):
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device, dtype=a_amp_dtype[self.amp])
+
+
+    def prepare_window(self, a_feature, n_offset=None):
         # a_feature: [num_frame, n_mels]
+        # n_offset: None (windows of num_frame) | offset for transcript_stride() (windows of num_frame/2)
+        # return:
+        #  a_input: padded feature [margin_b+len_out+margin_f(+stride), n_bins]
+        #  a_idx: first frame of each window in a_input
+        #  len_out: number of output frames
+        #  (idx_s, idx_e): output frames taken from each window
         a_feature = np.array(a_feature, dtype=np.float32)
 
-        a_tmp_b = np.full([self.config['input']['margin_b'], self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
-        len_s = int(np.ceil(a_feature.shape[0] / self.config['input']['num_frame']) * self.config['input']['num_frame']) - a_feature.shape[0]
-        a_tmp_f = np.full([len_s+self.config['input']['margin_f'], self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+        if n_offset is None:
+            a_tmp_b = np.full([self.config['input']['margin_b'], self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+            len_s = int(np.ceil(a_feature.shape[0] / self.config['input']['num_frame']) * self.config['input']['num_frame']) - a_feature.shape[0]
+            a_tmp_f = np.full([len_s+self.config['input']['margin_f'], self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+            # a_input: [margin_b+a_feature.shape[0]+len_s+margin_f, n_bins]
+            len_step = self.config['input']['num_frame']
+            idx_s = 0
+        else:
+            half_frame = int(self.config['input']['num_frame']/2)
+            a_tmp_b = np.full([self.config['input']['margin_b'] + n_offset, self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+            tmp_len = a_feature.shape[0] + self.config['input']['margin_b'] + self.config['input']['margin_f'] + half_frame
+            len_s = int(np.ceil(tmp_len / half_frame) * half_frame) - tmp_len
+            a_tmp_f = np.full([len_s+self.config['input']['margin_f']+(half_frame-n_offset), self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+            # a_input: [n_offset+margin_b+a_feature.shape[0]+len_s+(half_frame-n_offset)+margin_f, n_bins]
+            len_step = half_frame
+            idx_s = n_offset
         a_input = torch.from_numpy(np.concatenate([a_tmp_b, a_feature, a_tmp_f], axis=0))
-        # a_input: [margin_b+a_feature.shape[0]+len_s+margin_f, n_bins]
+        a_idx = list(range(0, a_feature.shape[0], len_step))
 
-        a_output_onset_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-        a_output_offset_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-        a_output_mpe_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-        a_output_velocity_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.int8)
+        return a_input, a_idx, a_feature.shape[0]+len_s, (idx_s, idx_s+len_step)
 
-        if mode == 'combination':
-            a_output_onset_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-            a_output_offset_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-            a_output_mpe_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-            a_output_velocity_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.int8)
 
-        self.model.eval()
-        for i in range(0, a_feature.shape[0], self.config['input']['num_frame']):
-            input_spec = (a_input[i:i+self.config['input']['margin_b']+self.config['input']['num_frame']+self.config['input']['margin_f']]).T.unsqueeze(0).to(self.device)
+    def alloc_output(self, len_out, mode='combination', output_stage=None):
+        # a_output_all: onset/offset/mpe/velocity (A), [onset/offset/mpe/velocity (B)]
+        # (output_stage('1st'|'2nd'): onset/offset/mpe/velocity of the stage)
+        a_output_all = []
+        for k in range(8 if (mode == 'combination') and (output_stage is None) else 4):
+            a_output_all.append(np.zeros((len_out, self.config['midi']['num_note']), dtype=np.int8 if k % 4 == 3 else np.float32))
+        return a_output_all
 
-            with torch.no_grad():
-                if mode == 'combination':
-                    if ablation_flag is True:
-                        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.model(input_spec)
-                    else:
-                        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.model(input_spec)
-                    # output_onset: [batch_size, n_frame, n_note]
-                    # output_offset: [batch_size, n_frame, n_note]
-                    # output_mpe: [batch_size, n_frame, n_note]
-                    # output_velocity: [batch_size, n_frame, n_note, n_velocity]
-                else:
-                    output_onset_A, output_offset_A, output_mpe_A, output_velocity_A = self.model(input_spec)
 
-            a_output_onset_A[i:i + self.config['input']['num_frame']] = (output_onset_A.squeeze(0)).to('cpu').detach().numpy()
-            a_output_offset_A[i:i + self.config['input']['num_frame']] = (output_offset_A.squeeze(0)).to('cpu').detach().numpy()
-            a_output_mpe_A[i:i + self.config['input']['num_frame']] = (output_mpe_A.squeeze(0)).to('cpu').detach().numpy()
-            a_output_velocity_A[i:i + self.config['input']['num_frame']] = (output_velocity_A.squeeze(0).argmax(2)).to('cpu').detach().numpy()
+    def transcript(self, a_feature, mode='combination', ablation_flag=False, output_stage=None, thred_onset=None):
+        # a_feature: [num_frame, n_mels]
+        return self._transcript(a_feature, None, mode=mode, ablation_flag=ablation_flag, output_stage=output_stage, thred_onset=thred_onset)
 
-            if mode == 'combination':
-                a_output_onset_B[i:i+self.config['input']['num_frame']] = (output_onset_B.squeeze(0)).to('cpu').detach().numpy()
-                a_output_offset_B[i:i+self.config['input']['num_frame']] = (output_offset_B.squeeze(0)).to('cpu').detach().numpy()
-                a_output_mpe_B[i:i+self.config['input']['num_frame']] = (output_mpe_B.squeeze(0)).to('cpu').detach().numpy()
-                a_output_velocity_B[i:i+self.config['input']['num_frame']] = (output_velocity_B.squeeze(0).argmax(2)).to('cpu').detach().numpy()
 
-        if mode == 'combination':
-            return a_output_onset_A, a_output_offset_A, a_output_mpe_A, a_output_velocity_A, a_output_onset_B, a_output_offset_B, a_output_mpe_B, a_output_velocity_B
-        else:
-            return a_output_onset_A, a_output_offset_A, a_output_mpe_A, a_output_velocity_A
+    def transcript_stride(self, a_feature, n_offset, mode='combination', ablation_flag=False, output_stage=None, thred_onset=None):
+        # a_feature: [num_frame, n_mels]
+        return self._transcript(a_feature, n_offset, mode=mode, ablation_flag=ablation_flag, output_stage=output_stage, thred_onset=thred_onset)
 
 
-    def transcript_stride(self, a_feature, n_offset, mode='combination', ablation_flag=False):
-        # a_feature: [num_frame, n_mels]
-        a_feature = np.array(a_feature, dtype=np.float32)
+    def _transcript(self, a_feature, n_offset, mode='combination', ablation_flag=False, output_stage=None, thred_onset=None):
+        a_input, a_idx, len_out, (idx_s, idx_e) = self.prepare_window(a_feature, n_offset)
+        a_output_all = self.alloc_output(len_out, mode=mode, output_stage=output_stage)
 
-        half_frame = int(self.config['input']['num_frame']/2)
-        a_tmp_b = np.full([self.config['input']['margin_b'] + n_offset, self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
-        tmp_len = a_feature.shape[0] + self.config['input']['margin_b'] + self.config['input']['margin_f'] + half_frame
-        len_s = int(np.ceil(tmp_len / half_frame) * half_frame) - tmp_len
-        a_tmp_f = np.full([len_s+self.config['input']['margin_f']+(half_frame-n_offset), self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+        # windows are stacked into batches of batch_size (the last batch may be shorter)
+        len_window = self.config['input']['margin_b'] + self.config['input']['num_frame'] + self.config['input']['margin_f']
 
-        a_input = torch.from_numpy(np.concatenate([a_tmp_b, a_feature, a_tmp_f], axis=0))
-        # a_input: [n_offset+margin_b+a_feature.shape[0]+len_s+(half_frame-n_offset)+margin_f, n_bins]
+        self.model.eval()
+        for b in range(0, len(a_idx), self.batch_size):
+            a_idx_batch = a_idx[b:b+self.batch_size]
+            input_spec = torch.stack([(a_input[i:i+len_window]).T for i in a_idx_batch]).to(self.device)
+            # input_spec: [n_batch, n_bins, margin_b+num_frame+margin_f]
+
+            a_output = self.run_model(input_spec, mode=mode, ablation_flag=ablation_flag, idx_s=idx_s, idx_e=idx_e,
+                                      output_stage=output_stage, thred_onset=thred_onset)
+
+            # each window contributes [idx_s:idx_e], so the batch fills [i:i+n_batch*(idx_e-idx_s)]
+            i = a_idx_batch[0]
+            n = len(a_idx_batch) * (idx_e - idx_s)
+            for k in range(len(a_output_all)):
+                a_output_all[k][i:i+n] = a_output[k].reshape(n, -1)
+
+        return tuple(a_output_all)
 
-        a_output_onset_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-        a_output_offset_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-        a_output_mpe_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-        a_output_velocity_A = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.int8)
 
-        if mode == 'combination':
-            a_output_onset_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-            a_output_offset_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-            a_output_mpe_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.float32)
-            a_output_velocity_B = np.zeros((a_feature.shape[0]+len_s, self.config['midi']['num_note']), dtype=np.int8)
+    def transcript_files(self, a_input_file, n_offset=None, mode='combination', ablation_flag=False, output_stage=None, thred_onset=None, on_error=None):
+        # a_input_file: iterable of (key, a_feature) (read lazily, one file ahead of the batch)
+        # yield: (key, output) as soon as all the windows of the file are done
+        #  (output: same as transcript()/transcript_stride(n_offset))
+        # on_error(key, e): a file that raises is dropped and the other files go on (raised if on_error is None)
+        # windows of several files are stacked into the same batch, so that short files fill the batches
+        len_window = self.config['input']['margin_b'] + self.config['input']['num_frame'] + self.config['input']['margin_f']
+
+        def run_batch(a_batch):
+            input_spec = torch.stack([(file['input'][i:i+len_window]).T for file, i in a_batch]).to(self.device)
+            # input_spec: [n_batch, n_bins, margin_b+num_frame+margin_f]
+            return self.run_model(input_spec, mode=mode, ablation_flag=ablation_flag, idx_s=idx_s, idx_e=idx_e,
+                                  output_stage=output_stage, thred_onset=thred_onset)
+
+        # a_queue: windows waiting for the model [(file, i)]
+        # file: {'key', 'input', 'output', 'num_rest'} (num_rest < 0: failed)
+        a_queue = []
+        iter_file = iter(a_input_file)
+        flag_end = False
 
         self.model.eval()
-        for i in range(0, a_feature.shape[0], half_frame):
-            input_spec = (a_input[i:i+self.config['input']['margin_b']+self.config['input']['num_frame']+self.config['input']['margin_f']]).T.unsqueeze(0).to(self.device)
+        while (flag_end is False) or (len(a_queue) > 0):
+            # fill the queue up to one batch
+            while (flag_end is False) and (len(a_queue) < self.batch_size):
+                try:
+                    key, a_feature = next(iter_file)
+                except StopIteration:
+                    flag_end = True
+                    break
+                try:
+                    a_input, a_idx, len_out, (idx_s, idx_e) = self.prepare_window(a_feature, n_offset)
+                    file = {'key': key, 'input': a_input, 'num_rest': len(a_idx),
+                            'output': self.alloc_output(len_out, mode=mode, output_stage=output_stage)}
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(key, e)
+                    continue
+                if len(a_idx) == 0:
+                    yield key, tuple(file['output'])
+                for i in a_idx:
+                    a_queue.append((file, i))
+            if len(a_queue) == 0:
+                continue
 
-            with torch.no_grad():
-                if mode == 'combination':
-                    if ablation_flag is True:
-                        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.model(input_spec)
-                    else:
-                        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.model(input_spec)
-                    # output_onset: [batch_size, n_frame, n_note]
-                    # output_offset: [batch_size, n_frame, n_note]
-                    # output_mpe: [batch_size, n_frame, n_note]
-                    # output_velocity: [batch_size, n_frame, n_note, n_velocity]
-                else:
-                    output_onset_A, output_offset_A, output_mpe_A, output_velocity_A = self.model(input_spec)
+            a_batch = a_queue[:self.batch_size]
+            a_queue = a_queue[self.batch_size:]
+            try:
+                a_result = [(a_batch, run_batch(a_batch))]
+            except Exception as e:
+                if on_error is None:
+                    raise
+                # (run the windows of each file of the batch separately, so that only the failing file is dropped)
+                a_result = []
+                for file in list({id(file): file for file, _ in a_batch}.values()):
+                    a_batch_file = [(file_b, i) for file_b, i in a_batch if file_b is file]
+                    try:
+                        a_result.append((a_batch_file, run_batch(a_batch_file)))
+                    except Exception as e_file:
+                        file['num_rest'] = -1
+                        on_error(file['key'], e_file)
+                a_queue = [(file, i) for file, i in a_queue if file['num_rest'] >= 0]
 
-            a_output_onset_A[i:i+half_frame] = (
-                (output_onset_A
-                    .squeeze(0)[n_offset : n_offset+half_frame])
-                    .to('cpu').detach().numpy()
-            )
-            a_output_offset_A[i:i+half_frame] = (
-                (output_offset_A
-                    .squeeze(0)
-                    [n_offset:n_offset+half_frame])
-                .to('cpu').detach().numpy()
-            )
-            a_output_mpe_A[i:i+half_frame] = (
-                (output_mpe_A
-                    .squeeze(0)
-                    [n_offset:n_offset+half_frame])
-                .to('cpu').detach().numpy()
-            )
-            a_output_velocity_A[i:i+half_frame] = (output_velocity_A.squeeze(0)[n_offset:n_offset+half_frame].argmax(2)).to('cpu').detach().numpy()
-
-            if mode == 'combination':
-                a_output_onset_B[i:i+half_frame] = (output_onset_B.squeeze(0)[n_offset:n_offset+half_frame]).to('cpu').detach().numpy()
-                a_output_offset_B[i:i+half_frame] = (output_offset_B.squeeze(0)[n_offset:n_offset+half_frame]).to('cpu').detach().numpy()
-                a_output_mpe_B[i:i+half_frame] = (output_mpe_B.squeeze(0)[n_offset:n_offset+half_frame]).to('cpu').detach().numpy()
-                a_output_velocity_B[i:i+half_frame] = (output_velocity_B.squeeze(0)[n_offset:n_offset+half_frame].argmax(2)).to('cpu').detach().numpy()
-
-        if mode == 'combination':
-            return (
-                a_output_onset_A,
-                a_output_offset_A,
-                a_output_mpe_A,
-                a_output_velocity_A,
-                a_output_onset_B,
-                a_output_offset_B,
-                a_output_mpe_B,
-                a_output_velocity_B
-            )
-        else:
-            return a_output_onset_A, a_output_offset_A, a_output_mpe_A, a_output_velocity_A
+            # route the outputs back to each file
+            for a_batch_done, a_output in a_result:
+                for b, (file, i) in enumerate(a_batch_done):
+                    for k in range(len(file['output'])):
+                        file['output'][k][i:i+idx_e-idx_s] = a_output[k][b]
+                    file['num_rest'] -= 1
+                    if file['num_rest'] == 0:
+                        yield file['key'], tuple(file['output'])
 
 
     def mpe2note(
@@ -228,6 +854,38 @@ class AMT():
         ##  longer : use longer one of mpe and offset
         ##  offset : use offset (ignore mpe)
 
+        ## vectorized version of mpe2note_loop (same notes)
+        hop_sec = float(self.config['feature']['hop_sample'] / self.config['feature']['sr'])
+        a_mpe = np.asarray(a_mpe)
+
+        return assemble_note(detect_peak(a_onset, thred_onset, hop_sec),
+                             detect_peak(a_offset, thred_offset, hop_sec),
+                             find_drop(a_mpe, thred_mpe),
+                             a_velocity, len(a_mpe), hop_sec, self.config['midi']['note_min'],
+                             mode_velocity=mode_velocity, mode_offset=mode_offset)
+
+
+    def mpe2note_loop(
+            self,
+            a_onset=None,
+            a_offset=None,
+            a_mpe=None,
+            a_velocity=None,
+            thred_onset=0.5,
+            thred_offset=0.5,
+            thred_mpe=0.5,
+            mode_velocity='ignore_zero',
+            mode_offset='shorter'
+    ):
+        ## mode_velocity
+        ##  org: 0-127
+        ##  ignore_zero: 0-127 (output note does not include 0) (default)
+
+        ## mode_offset
+        ##  shorter: use shorter one of mpe and offset (default)
+        ##  longer : use longer one of mpe and offset
+        ##  offset : use offset (ignore mpe)
+
         a_note = []
         hop_sec = float(self.config['feature']['hop_sample'] / self.config['feature']['sr'])
 
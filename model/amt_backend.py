@@ -0,0 +1,124 @@
+#! python
+
+import json
+import inspect
+import torch
+import torch.nn as nn
+from model import model_spec2midi
+
+##
+## exported graph of Model_SPEC2MIDI (TorchScript / ONNX)
+##
+# output names of the exported graph: <onset|offset|mpe|velocity>_<1st|2nd>
+#  (velocity: logits [batch_size, n_frame, n_note, n_velocity])
+a_output_head = ['onset', 'offset', 'mpe', 'velocity']
+f_meta_torchscript = 'amt.json'
+
+
+def output_name(output_stage=None, mode='combination'):
+    # output_stage: None (all outputs) | '1st' | '2nd'
+    if mode != 'combination':
+        return [head+'_1st' for head in a_output_head]
+    if output_stage is None:
+        return [head+'_1st' for head in a_output_head] + [head+'_2nd' for head in a_output_head]
+    return [head+'_'+output_stage for head in a_output_head]
+
+
+class Model_Export(nn.Module):
+    # Model_SPEC2MIDI (or an ablation model) with the outputs fixed for export
+    # (no attention map, dense velocity)
+    def __init__(self, model, output_stage=None, mode='combination', ablation_flag=False):
+        super().__init__()
+        self.model = model
+        self.output_stage = output_stage
+        self.mode = mode
+        self.ablation_flag = ablation_flag
+
+    def forward(self, input_spec):
+        # input_spec: [batch_size, n_bin, margin_b+num_frame+margin_f]
+        if (self.mode == 'combination') and (self.ablation_flag is False):
+            if self.output_stage is not None:
+                return tuple(self.model(input_spec, output_stage=self.output_stage))
+            a_output = self.model(input_spec)
+            # (attention is dropped)
+            return tuple(a_output[0:4]) + tuple(a_output[5:9])
+        a_output = tuple(self.model(input_spec))
+        if (self.mode == 'combination') and (self.output_stage is not None):
+            a_output = a_output[0:4] if self.output_stage == '1st' else a_output[4:8]
+        return a_output
+
+
+def export_model(model, f_out, config, fmt='torchscript', output_stage=None, mode='combination', ablation_flag=False, batch_size=1, opset=13):
+    # model: Model_SPEC2MIDI (eval mode, on cpu)
+    # fmt: torchscript (.pt) | onnx (.onnx); the batch size is dynamic for both
+    model_export = Model_Export(model, output_stage=output_stage, mode=mode, ablation_flag=ablation_flag).eval()
+    len_input = config['input']['margin_b'] + config['input']['num_frame'] + config['input']['margin_f']
+    input_spec = torch.full((batch_size, config['feature']['n_bins'], len_input), config['input']['min_value'], dtype=torch.float32)
+    a_name = output_name(output_stage, mode)
+
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            model_trace = torch.jit.trace(model_export, input_spec, check_trace=False)
+            model_trace = torch.jit.freeze(model_trace)
+            torch.jit.save(model_trace, f_out, _extra_files={f_meta_torchscript: json.dumps({'output': a_name})})
+        elif fmt == 'onnx':
+            kwargs = {}
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+                kwargs['dynamo'] = False
+            dynamic_axes = {'input_spec': {0: 'batch_size'}}
+            for name in a_name:
+                dynamic_axes[name] = {0: 'batch_size'}
+            # (scaled_dot_product_attention has no ONNX export below opset 14:
+            #  the graph is exported through the explicit attention)
+            flag_fused = model_spec2midi.flag_fused_attention
+            model_spec2midi.flag_fused_attention = False
+            try:
+                torch.onnx.export(model_export, input_spec, f_out, input_names=['input_spec'], output_names=a_name,
+                                  dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, **kwargs)
+            finally:
+                model_spec2midi.flag_fused_attention = flag_fused
+        else:
+            raise ValueError('unknown format: '+str(fmt))
+
+
+##
+## inference backend: runs an exported graph
+##
+class Model_Runtime():
+    # f_model: .pt/.ts (TorchScript) | .onnx (onnxruntime, CPU)
+    # __call__(input_spec): {output name: tensor}
+    def __init__(self, f_model, device='cpu', n_thread=None):
+        self.device = device
+        if f_model.endswith('.onnx'):
+            # (onnxruntime is only needed for this backend)
+            import onnxruntime
+            option = onnxruntime.SessionOptions()
+            option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if n_thread is not None:
+                option.intra_op_num_threads = n_thread
+            a_provider = ['CPUExecutionProvider']
+            if (device == 'cuda') and ('CUDAExecutionProvider' in onnxruntime.get_available_providers()):
+                a_provider = ['CUDAExecutionProvider'] + a_provider
+            self.session = onnxruntime.InferenceSession(f_model, sess_options=option, providers=a_provider)
+            self.output_names = [output.name for output in self.session.get_outputs()]
+            self.model = None
+        else:
+            a_extra = {f_meta_torchscript: ''}
+            self.model = torch.jit.load(f_model, map_location=device, _extra_files=a_extra)
+            self.model.eval()
+            self.output_names = json.loads(a_extra[f_meta_torchscript])['output']
+            self.session = None
+
+    def eval(self):
+        # (the exported graph is always in inference mode)
+        return self
+
+    def __call__(self, input_spec):
+        # input_spec: [batch_size, n_bin, margin_b+num_frame+margin_f]
+        if self.session is not None:
+            a_output = self.session.run(self.output_names, {'input_spec': input_spec.to('cpu').numpy()})
+            a_output = [torch.from_numpy(output) for output in a_output]
+        else:
+            with torch.no_grad():
+                a_output = self.model(input_spec.to(self.device))
+        return dict(zip(self.output_names, a_output))
@@ -0,0 +1,69 @@
+#! python
+
+import copy
+import torch
+import torch.nn as nn
+
+##
+## int8 quantization of the Linear layers (CPU inference)
+##  dynamic: weights int8, activations quantized on the fly
+##  static : weights int8, activation scales calibrated on a few files
+##           (each nn.Linear is wrapped with QuantStub/DeQuantStub, the other
+##            layers stay float32)
+##
+def quantize_dynamic(model):
+    model = copy.deepcopy(model).to('cpu').eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def prepare_static(model, backend='fbgemm'):
+    # return: model with observers; run it on the calibration data, then convert_static()
+    model = copy.deepcopy(model).to('cpu').eval()
+    torch.backends.quantized.engine = backend
+    _wrap_linear(model)
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    for module in model.modules():
+        if _is_wrapped(module):
+            module.qconfig = qconfig
+    torch.quantization.prepare(model, inplace=True)
+    return model
+
+
+def convert_static(model):
+    # (a Linear whose observer saw no data would get scale 1.0/zero point 0)
+    a_name = unobserved(model)
+    if len(a_name) > 0:
+        raise ValueError('not calibrated (run every output stage in the calibration): '+', '.join(a_name))
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+def unobserved(model):
+    # return: names of the wrapped Linear layers whose input observer has seen no data
+    a_name = []
+    for name, module in model.named_modules():
+        if _is_wrapped(module):
+            observer = module[0].activation_post_process
+            if (observer.min_val.numel() == 0) or bool(torch.isinf(observer.min_val).any()):
+                a_name.append(name)
+    return a_name
+
+
+def is_quantized(model):
+    # (quantized modules only run on CPU)
+    for module in model.modules():
+        if '.quantized' in type(module).__module__:
+            return True
+    return False
+
+
+def _wrap_linear(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, nn.Sequential(torch.quantization.QuantStub(), child, torch.quantization.DeQuantStub()))
+        else:
+            _wrap_linear(child)
+
+
+def _is_wrapped(module):
+    return isinstance(module, nn.Sequential) and (len(module) == 3) and isinstance(module[0], torch.quantization.QuantStub)
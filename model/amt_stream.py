@@ -0,0 +1,266 @@
+#! python
+
+import torch
+import numpy as np
+from model.amt import Feature_Stream, detect_peak, find_drop, decode_note, cut_offset, note_list
+
+##
+## streaming transcription
+##
+class AMT_Stream():
+    # usage:
+    #  stream = AMT_Stream(AMT, sr)
+    #  for wave in chunks:                       # wave: [n_channel, n_sample] or [n_sample]
+    #      a_note += stream.transcript_chunk(wave)
+    #  a_note += stream.flush()
+    # notes are emitted as soon as they can not change any more, and the
+    # concatenated notes are the same as AMT.transcript() + AMT.mpe2note()
+    # on the whole signal (up to float rounding of the features)
+    def __init__(
+            self,
+            AMT,
+            sr,
+            mode='combination',
+            output='2nd',
+            ablation_flag=False,
+            thred_onset=0.5,
+            thred_offset=0.5,
+            thred_mpe=0.5,
+            mode_velocity='ignore_zero',
+            mode_offset='shorter'
+    ):
+        self.AMT = AMT
+        self.config = AMT.config
+        self.sr = sr
+        self.mode = mode
+        self.ablation_flag = ablation_flag
+        # output stage to decode (combination)
+        self.output = output
+        self.thred_onset = thred_onset
+        self.thred_offset = thred_offset
+        self.thred_mpe = thred_mpe
+        self.mode_velocity = mode_velocity
+        self.mode_offset = mode_offset
+        self.hop_sec = float(self.config['feature']['hop_sample'] / self.config['feature']['sr'])
+        num_note = self.config['midi']['num_note']
+
+        ## feature
+        self.feature_stream = Feature_Stream(self.config, sr)
+        # a_feature: [margin_b+n_frame, n_bins] (from frame n_window*num_frame-margin_b)
+        self.a_feature = np.full([self.config['input']['margin_b'], self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+        self.n_sample = 0
+        self.n_feature = 0
+        self.n_window = 0
+
+        ## posterior (from frame loc_s)
+        # a_onset/a_offset have n_head rows before loc_s: [nearest different value, value at loc_s-1]
+        # (enough to decide the peaks after loc_s in the same way as the whole sequence)
+        self.loc_s = 0
+        self.n_head = 0
+        self.a_onset = np.zeros((0, num_note), dtype=np.float32)
+        self.a_offset = np.zeros((0, num_note), dtype=np.float32)
+        self.a_mpe = np.zeros((0, num_note), dtype=np.float32)
+        self.a_velocity = np.zeros((0, num_note), dtype=np.int8)
+        # a_loc_done: last onset frame already emitted (each pitch)
+        self.a_loc_done = np.full(num_note, -1, dtype=np.int64)
+        self.flag_end = False
+
+        ## latency
+        self.num_note = 0
+        self.sum_delay = 0.0
+        self.max_delay = 0.0
+
+
+    def transcript_chunk(self, wave):
+        # wave: [n_channel, n_sample] or [n_sample] at self.sr
+        # return: notes finished by this chunk (same format as AMT.mpe2note())
+        assert self.flag_end is False, 'stream is already flushed'
+        wave = torch.as_tensor(wave, dtype=torch.float32)
+        self.n_sample += wave.shape[-1]
+        self._add_feature(self.feature_stream(wave))
+        return self._run_window()
+
+
+    def flush(self):
+        # end of the stream: pad the last window and emit the remaining notes
+        if self.flag_end is True:
+            return []
+        self._add_feature(self.feature_stream(torch.zeros(0), flag_end=True))
+        self.flag_end = True
+        return self._run_window()
+
+
+    def latency(self):
+        # algorithmic latency (sec)
+        #  window  : a frame is decoded after its window and margin_f are complete
+        #  stft    : half of the STFT window (center)
+        #  resample: right context of the resampling filter
+        a_latency = {}
+        a_latency['window'] = (self.config['input']['num_frame'] + self.config['input']['margin_f']) * self.hop_sec
+        a_latency['stft'] = (self.config['feature']['fft_bins'] // 2) / self.config['feature']['sr']
+        tr_fsconv = self.feature_stream.tr_fsconv
+        if tr_fsconv.flag_through is True:
+            a_latency['resample'] = 0.0
+        else:
+            a_latency['resample'] = (tr_fsconv.tr.width + tr_fsconv.n_orig) / self.sr
+        a_latency['total'] = a_latency['window'] + a_latency['stft'] + a_latency['resample']
+        # measured: audio received when a note is emitted - its onset time (sec)
+        a_latency['note_num'] = self.num_note
+        a_latency['note_mean'] = self.sum_delay / self.num_note if self.num_note > 0 else 0.0
+        a_latency['note_max'] = self.max_delay
+        return a_latency
+
+
+    def _add_feature(self, a_feature):
+        # a_feature: [n_frame, n_mels]
+        self.a_feature = np.concatenate([self.a_feature, np.asarray(a_feature, dtype=np.float32)], axis=0)
+        self.n_feature += len(a_feature)
+
+
+    def _run_window(self):
+        num_frame = self.config['input']['num_frame']
+        len_window = self.config['input']['margin_b'] + num_frame + self.config['input']['margin_f']
+
+        if self.flag_end is True:
+            # same padding as AMT.transcript()
+            len_s = int(np.ceil(self.n_feature / num_frame) * num_frame) - self.n_feature
+            a_tmp_f = np.full([len_s+self.config['input']['margin_f'], self.config['feature']['n_bins']], self.config['input']['min_value'], dtype=np.float32)
+            self.a_feature = np.concatenate([self.a_feature, a_tmp_f], axis=0)
+
+        n_window = 0
+        if len(self.a_feature) >= len_window:
+            n_window = (len(self.a_feature) - len_window) // num_frame + 1
+        a_input = torch.from_numpy(self.a_feature)
+
+        self.AMT.model.eval()
+        for b in range(0, n_window, self.AMT.batch_size):
+            a_idx_batch = range(b*num_frame, min(b+self.AMT.batch_size, n_window)*num_frame, num_frame)
+            input_spec = torch.stack([(a_input[i:i+len_window]).T for i in a_idx_batch]).to(self.AMT.device)
+            # input_spec: [n_batch, n_bins, margin_b+num_frame+margin_f]
+
+            a_output = self.AMT.run_model(input_spec, mode=self.mode, ablation_flag=self.ablation_flag, output_stage=self.output,
+                                           thred_onset=self.thred_onset)
+            n = len(a_idx_batch) * num_frame
+            self.a_onset = np.concatenate([self.a_onset, a_output[0].reshape(n, -1)], axis=0)
+            self.a_offset = np.concatenate([self.a_offset, a_output[1].reshape(n, -1)], axis=0)
+            self.a_mpe = np.concatenate([self.a_mpe, a_output[2].reshape(n, -1)], axis=0)
+            self.a_velocity = np.concatenate([self.a_velocity, a_output[3].reshape(n, -1).astype(np.int8)], axis=0)
+
+        self.a_feature = self.a_feature[n_window*num_frame:]
+        self.n_window += n_window
+
+        if (n_window == 0) and (self.flag_end is False):
+            return []
+        return self._emit_note()
+
+
+    def _tail_start(self, a_value, thred):
+        # first frame from which the peaks are not decided yet (each pitch)
+        # (the plateau at the end may still rise, so it is not decided if it is >= thred)
+        n_frame = self.loc_s + len(self.a_mpe)
+        a_last = a_value[-1]
+        flag_diff = (a_value != a_last)[::-1]
+        n_same = np.where(flag_diff.any(axis=0), flag_diff.argmax(axis=0), len(a_value))
+        a_tail = len(a_value) - n_same + (self.loc_s - self.n_head)
+        dtype = np.result_type(a_value.dtype.type(0) + 0.0)
+        return np.where(a_last.astype(dtype) >= np.asarray(thred, dtype=dtype), a_tail, n_frame)
+
+
+    def _emit_note(self):
+        n_frame = self.loc_s + len(self.a_mpe)
+        if n_frame == self.loc_s:
+            return []
+        loc_b = self.loc_s - self.n_head
+
+        # peaks after loc_s whose plateau is complete (all of them at the end of the stream)
+        a_onset_peak = detect_peak(self.a_onset, self.thred_onset, self.hop_sec, loc_b)
+        a_offset_peak = detect_peak(self.a_offset, self.thred_offset, self.hop_sec, loc_b)
+        if self.flag_end is True:
+            a_onset_tail = np.full(len(self.a_loc_done), n_frame, dtype=np.int64)
+            a_offset_tail = np.full(len(self.a_loc_done), n_frame, dtype=np.int64)
+        else:
+            a_onset_tail = self._tail_start(self.a_onset, self.thred_onset)
+            a_offset_tail = self._tail_start(self.a_offset, self.thred_offset)
+        flag_onset = (a_onset_peak[1] >= self.loc_s) & (a_onset_peak[1] < a_onset_tail[a_onset_peak[0]])
+        flag_offset = (a_offset_peak[1] >= self.loc_s) & (a_offset_peak[1] < a_offset_tail[a_offset_peak[0]])
+        a_onset_peak = [a[flag_onset] for a in a_onset_peak]
+        a_offset_peak = [a[flag_offset] for a in a_offset_peak]
+
+        a_note = decode_note(a_onset_peak, a_offset_peak, find_drop(self.a_mpe, self.thred_mpe),
+                             n_frame, self.hop_sec, mode_offset=self.mode_offset, loc_s=self.loc_s)
+        a_pitch = a_note['pitch']
+        a_loc = a_note['loc']
+
+        # a note is decided when the following peaks can not change its offset:
+        #  (a) the next onset is known and the offset peaks up to it are decided
+        #  (b) (shorter) the offset/mpe drop is found before any onset still to come
+        if self.flag_end is True:
+            flag_decide = np.ones(len(a_loc), dtype=bool)
+        else:
+            flag_offset_in = a_note['flag_offset'] & (a_note['loc_offset'] <= a_note['loc_next'])
+            flag_offset_tail = a_offset_tail[a_pitch] > a_note['loc_next']
+            if self.mode_offset == 'shorter':
+                flag_a = a_note['flag_next'] & (flag_offset_in | flag_offset_tail)
+                flag_off_first = a_note['flag_offset'] & ((a_note['flag_mpe'] == False) | (a_note['loc_offset'] <= a_note['loc_mpe']))
+                a_loc_first = np.where(flag_off_first, a_note['loc_offset'], a_note['loc_mpe'])
+                # (1 frame apart, so that the interpolated onset can not cut the offset)
+                flag_b = ((a_note['flag_next'] == False) & (a_note['flag_offset'] | a_note['flag_mpe']) &
+                          (a_loc_first + 1 < a_onset_tail[a_pitch]) &
+                          (flag_off_first | (a_offset_tail[a_pitch] > a_note['loc_mpe'])))
+                flag_decide = flag_a | flag_b
+            else:
+                flag_decide = a_note['flag_next'] & (flag_offset_in | (flag_offset_tail & a_note['flag_offset']))
+
+        # notes are emitted in order of onset (each pitch)
+        flag_new = a_loc > self.a_loc_done[a_pitch]
+        a_loc_block = np.full(len(self.a_loc_done), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(a_loc_block, a_pitch[flag_new & (flag_decide == False)], a_loc[flag_new & (flag_decide == False)])
+        flag_emit = flag_new & flag_decide & (a_loc < a_loc_block[a_pitch])
+        np.maximum.at(self.a_loc_done, a_pitch[flag_emit], a_loc[flag_emit])
+
+        a_velocity_value = self.a_velocity[a_loc-self.loc_s, a_pitch].astype(np.int64)
+        if self.mode_velocity == 'ignore_zero':
+            flag_note = a_velocity_value > 0
+        else:
+            flag_note = np.ones(len(a_velocity_value), dtype=bool)
+        a_offset_value = cut_offset(a_pitch, a_note['onset'], a_note['offset'], flag_note)
+        flag_emit &= flag_note
+        a_note_emit = note_list(a_pitch[flag_emit] + self.config['midi']['note_min'],
+                                a_note['onset'][flag_emit],
+                                a_offset_value[flag_emit],
+                                a_velocity_value[flag_emit])
+
+        time_now = self.n_sample / self.sr
+        for note in a_note_emit:
+            self.num_note += 1
+            self.sum_delay += time_now - note['onset']
+            self.max_delay = max(self.max_delay, time_now - note['onset'])
+
+        # drop the posteriors which are not needed any more
+        # (before the first onset not emitted yet, and before the undecided peaks)
+        flag_wait = a_loc > self.a_loc_done[a_pitch]
+        loc_s_new = min(int(a_onset_tail.min()), n_frame-1)
+        if flag_wait.any():
+            loc_s_new = min(loc_s_new, int(a_loc[flag_wait].min()))
+        if (self.flag_end is False) and (loc_s_new > self.loc_s):
+            self._cut_posterior(loc_s_new)
+
+        return a_note_emit
+
+
+    def _cut_posterior(self, loc_s_new):
+        n_cut = loc_s_new - self.loc_s
+        r = self.n_head + n_cut - 1
+        for attr in ['a_onset', 'a_offset']:
+            a_value = getattr(self, attr)
+            # [nearest different value (or smaller one if none), value at loc_s_new-1]
+            a_prev = a_value[r]
+            a_left = a_prev - 1.0
+            if r > 0:
+                flag_diff = (a_value[:r] != a_prev)[::-1]
+                a_left = np.where(flag_diff.any(axis=0), a_value[r-1-flag_diff.argmax(axis=0), np.arange(a_value.shape[1])], a_left)
+            setattr(self, attr, np.concatenate([a_left[None].astype(a_value.dtype), a_prev[None], a_value[r+1:]], axis=0))
+        self.a_mpe = self.a_mpe[n_cut:]
+        self.a_velocity = self.a_velocity[n_cut:]
+        self.n_head = 2
+        self.loc_s = loc_s_new
@@ -0,0 +1,102 @@
+#! python
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+##
+## feature cache
+##
+class Feature_Cache():
+    # on-disk cache of AMT.wav2feature() results
+    #  key  : sha256(audio file content + config['feature'] + dtype)
+    #  value: <d_cache>/<key[:2]>/<key>.npy ([n_frame, n_mels], memory-mappable)
+    # the least recently used files are removed when the total size exceeds max_size (bytes)
+    # (the total size is kept as a running sum of the writes, and the cache
+    #  directory is scanned only when it exceeds max_size; files written by
+    #  other processes are counted at that scan; it then evicts down to
+    #  max_size*low_water, so that a full cache is not scanned on every write)
+    low_water = 0.9
+
+    def __init__(self, d_cache, config, max_size=None, dtype='float32'):
+        assert dtype in ['float32', 'float16'], 'dtype should be float32 or float16'
+        self.d_cache = d_cache.rstrip('/')
+        self.config = config
+        self.max_size = max_size
+        self.dtype = dtype
+        self.param = json.dumps(config['feature'], sort_keys=True) + dtype
+        self.total_size = None
+        self.lock = threading.Lock()
+        os.makedirs(self.d_cache, exist_ok=True)
+
+    def key(self, f_wav):
+        h = hashlib.sha256()
+        with open(f_wav, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(self.param.encode('utf-8'))
+        return h.hexdigest()
+
+    def fname(self, key):
+        return self.d_cache + '/' + key[:2] + '/' + key + '.npy'
+
+    def get(self, key, mmap_mode='r'):
+        # a_feature: [n_frame, n_mels] (None if not cached)
+        fname = self.fname(key)
+        try:
+            a_feature = np.load(fname, mmap_mode=mmap_mode)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # access time for LRU
+        # (the file may have been evicted by another process in the meantime)
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            pass
+        return a_feature
+
+    def put(self, key, a_feature):
+        fname = self.fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        # (written to a temporary file first, so that readers never see a partial file)
+        fname_tmp = fname + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(fname_tmp, 'wb') as f:
+            np.save(f, np.asarray(a_feature, dtype=self.dtype))
+        size = os.path.getsize(fname_tmp)
+        try:
+            size -= os.path.getsize(fname)
+        except FileNotFoundError:
+            pass
+        os.replace(fname_tmp, fname)
+        if self.max_size is None:
+            return
+        with self.lock:
+            if self.total_size is not None:
+                self.total_size += size
+                if self.total_size <= self.max_size:
+                    return
+            self.evict()
+
+    def evict(self):
+        # remove the least recently used files until the total size <= max_size*low_water
+        # (scans the whole cache; the remaining size is the new running total)
+        a_file = []
+        for d in os.scandir(self.d_cache):
+            if not d.is_dir():
+                continue
+            for e in os.scandir(d.path):
+                if e.name.endswith('.npy'):
+                    st = e.stat()
+                    a_file.append((st.st_mtime, st.st_size, e.path))
+        total_size = sum([size for _, size, _ in a_file])
+        for _, size, path in sorted(a_file):
+            if total_size <= self.max_size * self.low_water:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self.total_size = total_size
@@ -2,6 +2,15 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+# attention without weights uses the fused kernel (torch >= 2.0) when available
+# (False: always the explicit softmax(QK^T/sqrt(d))V path)
+flag_fused_attention = hasattr(F, 'scaled_dot_product_attention')
+
+# encoder front end: conv over the whole time axis, tok_embedding_freq as a conv1d
+# (False: the unfold path, which copies the input n_proc times)
+flag_conv_frontend = True
 
 ##
 ## Model
@@ -12,15 +21,21 @@ class Model_SPEC2MIDI(nn.Module):
         self.encoder_spec2midi = encoder
         self.decoder_spec2midi = decoder
 
-    def forward(self, input_spec):
+    def forward(self, input_spec, output_stage=None, thred_onset=None, logits=False):
         #input_spec = [batch_size, n_bin, margin+n_frame+margin] (8, 256, 192)
         #print('Model_SPEC2MIDI(0) input_spec: '+str(input_spec.shape))
+        #output_stage: None (all outputs) | '1st' | '2nd' (inference: onset, offset, mpe, velocity of the stage)
+        #thred_onset: velocity only where onset >= thred_onset (with output_stage, see Decoder_SPEC2MIDI)
+        #logits: onset, offset, mpe before the sigmoid (training with BCEWithLogitsLoss, autocast safe)
 
         enc_vector = self.encoder_spec2midi(input_spec)
         #enc_freq = [batch_size, n_frame, n_bin, hid_dim] (8, 128, 256, 256)
         #print('Model_SPEC2MIDI(1) enc_vector: '+str(enc_vector.shape))
 
-        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.decoder_spec2midi(enc_vector)
+        if output_stage is not None:
+            return self.decoder_spec2midi(enc_vector, output_stage=output_stage, thred_onset=thred_onset, logits=logits)
+
+        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = self.decoder_spec2midi(enc_vector, logits=logits)
         #output_onset_A = [batch_size, n_frame, n_note] (8, 128, 88)
         #output_onset_B = [batch_size, n_frame, n_note] (8, 128, 88)
         #output_velocity_A = [batch_size, n_frame, n_note, n_velocity] (8, 128, 88, 128)
@@ -62,6 +77,38 @@ class Encoder_SPEC2MIDI(nn.Module):
         #print('Encoder_SPEC2MIDI(0) spec_in: '+str(spec_in.shape))
         batch_size = spec_in.shape[0]
 
+        # (a quantized tok_embedding_freq has no float weight for the conv)
+        if (flag_conv_frontend is True) and isinstance(self.tok_embedding_freq, nn.Linear):
+            spec_emb_freq = self.frontend_conv(spec_in)
+        else:
+            spec_emb_freq = self.frontend_unfold(spec_in)
+        # spec_emb_freq: [batch_size*n_frame, n_bin, hid_dim] (8*128, 256, 256)
+        #print('Encoder_SPEC2MIDI(4) spec_emb_freq: '+str(spec_emb_freq.shape))
+
+        # position coding
+        # (pos_embedding_freq(arange(n_bin)) is its weight: broadcast, no index tensor)
+        pos_freq = self.pos_embedding_freq.weight[:self.n_bin].unsqueeze(0)
+        #pos_freq = [1, n_bin, hid_dim] (1, 256, 256)
+        #print('Encoder_SPEC2MIDI(5) pos_freq: '+str(pos_freq.shape))
+
+        # embedding
+        spec_freq = self.dropout((spec_emb_freq * self.scale_freq) + pos_freq)
+        #spec_freq = [batch_size*n_frame, n_bin, hid_dim] (8*128, 256, 256)
+        #print('Encoder_SPEC2MIDI(6) spec_freq: '+str(spec_freq.shape))
+
+        # transformer encoder
+        for layer_freq in self.layers_freq:
+            spec_freq = layer_freq(spec_freq)
+        spec_freq = spec_freq.reshape(batch_size, self.n_frame, self.n_bin, self.hid_dim)
+        #spec_freq = [batch_size, n_frame, n_bin, hid_dim] (8, 128, 256, 256)
+        #print('Encoder_SPEC2MIDI(7) spec_freq: '+str(spec_freq.shape))
+
+        return spec_freq
+
+    def frontend_unfold(self, spec_in):
+        # (reference) every frame gets a copy of its [n_bin, n_proc] window
+        batch_size = spec_in.shape[0]
+
         spec = spec_in.unfold(2, self.n_proc, 1).permute(0, 2, 1, 3).contiguous()
         #spec = [batch_size, n_frame, n_bin, n_proc] (8, 128, 256, 65) (batch_size=8, n_frame=128, n_bins=256, n_proc=65)
         #print('Encoder_SPEC2MIDI(1) spec: '+str(spec.shape))
@@ -74,36 +121,34 @@ class Encoder_SPEC2MIDI(nn.Module):
         # spec_cnn: [batch_size*n_frame, n_bin, cnn_channel, n_proc-(cnn_kernel-1)] (8*128, 256, 4, 61)
         #print('Encoder_SPEC2MIDI(2) spec_cnn: '+str(spec_cnn.shape))
 
-        ##
-        ## frequency
-        ##
         spec_cnn_freq = spec_cnn.reshape(batch_size*self.n_frame, self.n_bin, self.cnn_dim)
         # spec_cnn_freq: [batch_size*n_frame, n_bin, cnn_channel, (n_proc)-(cnn_kernel-1)] (8*128, 256, 244)
         #print('Encoder_SPEC2MIDI(3) spec_cnn_freq: '+str(spec_cnn_freq.shape))
 
-        # embedding
         spec_emb_freq = self.tok_embedding_freq(spec_cnn_freq)
         # spec_emb_freq: [batch_size*n_frame, n_bin, hid_dim] (8*128, 256, 256)
-        #print('Encoder_SPEC2MIDI(4) spec_emb_freq: '+str(spec_emb_freq.shape))
-
-        # position coding
-        pos_freq = torch.arange(0, self.n_bin).unsqueeze(0).repeat(batch_size*self.n_frame, 1).to(self.device)
-        #pos_freq = [batch_size, n_frame, n_bin] (8*128, 256)
-        #print('Encoder_SPEC2MIDI(5) pos_freq: '+str(pos_freq.shape))
-
-        # embedding
-        spec_freq = self.dropout((spec_emb_freq * self.scale_freq) + self.pos_embedding_freq(pos_freq))
-        #spec_freq = [batch_size*n_frame, n_bin, hid_dim] (8*128, 256, 256)
-        #print('Encoder_SPEC2MIDI(6) spec_freq: '+str(spec_freq.shape))
+        return spec_emb_freq
+
+    def frontend_conv(self, spec_in):
+        # same as frontend_unfold() without the [batch_size, n_frame, n_bin, n_proc]
+        # copy and the [batch_size*n_frame, n_bin, cnn_dim] input of tok_embedding_freq:
+        #  conv over all the frames once, then the tok_embedding_freq weight
+        #  [hid_dim, cnn_channel*(n_proc-(cnn_kernel-1))] is applied as a conv1d
+        #  over time (kernel n_proc-(cnn_kernel-1)), one output per frame
+        batch_size = spec_in.shape[0]
+        n_cnn = self.n_proc - (self.cnn_kernel - 1)
 
-        # transformer encoder
-        for layer_freq in self.layers_freq:
-            spec_freq = layer_freq(spec_freq)
-        spec_freq = spec_freq.reshape(batch_size, self.n_frame, self.n_bin, self.hid_dim)
-        #spec_freq = [batch_size, n_frame, n_bin, hid_dim] (8, 128, 256, 256)
-        #print('Encoder_SPEC2MIDI(7) spec_freq: '+str(spec_freq.shape))
+        spec_cnn = self.conv(spec_in.unsqueeze(1))
+        # spec_cnn: [batch_size, cnn_channel, n_bin, n_margin+n_frame+n_margin-(cnn_kernel-1)] (8, 4, 256, 188)
+        spec_cnn = spec_cnn.permute(0, 2, 1, 3).reshape(batch_size*self.n_bin, self.cnn_channel, -1)
+        # spec_cnn: [batch_size*n_bin, cnn_channel, n_margin+n_frame+n_margin-(cnn_kernel-1)] (8*256, 4, 188)
 
-        return spec_freq
+        weight = self.tok_embedding_freq.weight.reshape(self.hid_dim, self.cnn_channel, n_cnn)
+        spec_emb_freq = F.conv1d(spec_cnn, weight, self.tok_embedding_freq.bias)
+        # spec_emb_freq: [batch_size*n_bin, hid_dim, n_frame] (8*256, 256, 128)
+        spec_emb_freq = spec_emb_freq.reshape(batch_size, self.n_bin, self.hid_dim, self.n_frame).permute(0, 3, 1, 2).reshape(batch_size*self.n_frame, self.n_bin, self.hid_dim)
+        # spec_emb_freq: [batch_size*n_frame, n_bin, hid_dim] (8*128, 256, 256)
+        return spec_emb_freq
 
 
 ##
@@ -142,7 +187,12 @@ class Decoder_SPEC2MIDI(nn.Module):
         self.fc_mpe_time = nn.Linear(hid_dim, 1)
         self.fc_velocity_time = nn.Linear(hid_dim, self.n_velocity)
 
-    def forward(self, enc_spec):
+    def forward(self, enc_spec, output_stage=None, thred_onset=None, logits=False):
+        #output_stage: None (all outputs) | '1st' (CAfreq only) | '2nd' (without the heads of CAfreq)
+        # ('1st'/'2nd' return onset, offset, mpe, velocity of the stage, without attention)
+        #thred_onset: (with output_stage) the velocity head is evaluated only where onset >= thred_onset,
+        # and velocity is returned as argmax [batch_size, n_frame, n_note] (0 elsewhere)
+        #logits: onset, offset, mpe are returned without the sigmoid (not with thred_onset)
         batch_size = enc_spec.shape[0]
         enc_spec = enc_spec.reshape([batch_size*self.n_frame, self.n_bin, self.hid_dim])
         #enc_spec = [batch_size*n_frame, n_bin, hid_dim] (8*128, 256, 256)
@@ -151,28 +201,43 @@ class Decoder_SPEC2MIDI(nn.Module):
         ##
         ## CAfreq freq(256)/note(88)
         ##
-        pos_freq = torch.arange(0, self.n_note).unsqueeze(0).repeat(batch_size*self.n_frame, 1).to(self.device)
-        midi_freq = self.pos_embedding_freq(pos_freq)
-        #pos_freq = [batch_size*n_frame, n_note] (8*128, 88)
+        # (pos_embedding_freq(arange(n_note)) is its weight: expanded view, no index tensor)
+        pos_freq = self.pos_embedding_freq.weight[:self.n_note].unsqueeze(0)
+        midi_freq = pos_freq.expand(batch_size*self.n_frame, -1, -1)
+        #pos_freq = [1, n_note, hid_dim] (1, 88, 256)
         #midi_freq = [batch_size, n_note, hid_dim] (8*128, 88, 256)
         #print('Decoder_SPEC2MIDI(1) pos_freq: '+str(pos_freq.shape))
         #print('Decoder_SPEC2MIDI(1) midi_freq: '+str(midi_freq.shape))
 
-        midi_freq, attention_freq = self.layer_zero_freq(enc_spec, midi_freq)
-        for layer_freq in self.layers_freq:
-            midi_freq, attention_freq = layer_freq(enc_spec, midi_freq)
-        dim = attention_freq.shape
-        attention_freq = attention_freq.reshape([batch_size, self.n_frame, dim[1], dim[2], dim[3]])
+        # (only the attention of the last layer is returned, and none with output_stage)
+        flag_weight = output_stage is None
+        midi_freq, attention_freq = self.layer_zero_freq(enc_spec, midi_freq, need_weights=flag_weight and (len(self.layers_freq) == 0))
+        for i, layer_freq in enumerate(self.layers_freq):
+            midi_freq, attention_freq = layer_freq(enc_spec, midi_freq, need_weights=flag_weight and (i == len(self.layers_freq)-1))
+        if output_stage is None:
+            dim = attention_freq.shape
+            attention_freq = attention_freq.reshape([batch_size, self.n_frame, dim[1], dim[2], dim[3]])
+        else:
+            attention_freq = None
         #midi_freq = [batch_size*n_frame, n_note, hid_dim] (8*128, 88, 256)
         #attention_freq = [batch_size, n_frame, n_heads, n_note, n_bin] (8, 128, 4, 88, 256)
         #print('Decoder_SPEC2MIDI(2) midi_freq: '+str(midi_freq.shape))
         #print('Decoder_SPEC2MIDI(2) attention_freq: '+str(attention_freq.shape))
 
         ## output(freq)
-        output_onset_freq = self.sigmoid(self.fc_onset_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note]))
-        output_offset_freq = self.sigmoid(self.fc_offset_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note]))
-        output_mpe_freq = self.sigmoid(self.fc_mpe_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note]))
-        output_velocity_freq = self.fc_velocity_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note, self.n_velocity])
+        if output_stage != '2nd':
+            output_onset_freq = self.fc_onset_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note])
+            output_offset_freq = self.fc_offset_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note])
+            output_mpe_freq = self.fc_mpe_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note])
+            if logits is False:
+                output_onset_freq = self.sigmoid(output_onset_freq)
+                output_offset_freq = self.sigmoid(output_offset_freq)
+                output_mpe_freq = self.sigmoid(output_mpe_freq)
+            if (output_stage == '1st') and (thred_onset is not None):
+                midi_velocity = midi_freq.reshape([batch_size, self.n_frame, self.n_note, self.hid_dim])
+                output_velocity_freq = self.velocity_sparse(self.fc_velocity_freq, midi_velocity, output_onset_freq >= thred_onset)
+            else:
+                output_velocity_freq = self.fc_velocity_freq(midi_freq).reshape([batch_size, self.n_frame, self.n_note, self.n_velocity])
         #output_onset_freq = [batch_size, n_frame, n_note] (8, 128, 88)
         #output_offset_freq = [batch_size, n_frame, n_note] (8, 128, 88)
         #output_mpe_freq = [batch_size, n_frame, n_note] (8, 128, 88)
@@ -181,15 +246,17 @@ class Decoder_SPEC2MIDI(nn.Module):
         #print('Decoder_SPEC2MIDI(3) output_offset_freq: '+str(output_offset_freq.shape))
         #print('Decoder_SPEC2MIDI(3) output_mpe_freq: '+str(output_mpe_freq.shape))
         #print('Decoder_SPEC2MIDI(3) output_velocity_freq: '+str(output_velocity_freq.shape))
+        if output_stage == '1st':
+            return output_onset_freq, output_offset_freq, output_mpe_freq, output_velocity_freq
 
         ##
         ## SAtime time(64)
         ##
         #midi_time: [batch_size*n_frame, n_note, hid_dim] -> [batch_size*n_note, n_frame, hid_dim]
         midi_time = midi_freq.reshape([batch_size, self.n_frame, self.n_note, self.hid_dim]).permute(0, 2, 1, 3).contiguous().reshape([batch_size*self.n_note, self.n_frame, self.hid_dim])
-        pos_time = torch.arange(0, self.n_frame).unsqueeze(0).repeat(batch_size*self.n_note, 1).to(self.device)
-        midi_time = self.dropout((midi_time * self.scale_time) + self.pos_embedding_time(pos_time))
-        #pos_time = [batch_size*n_note, n_frame] (8*88, 128)
+        pos_time = self.pos_embedding_time.weight[:self.n_frame].unsqueeze(0)
+        midi_time = self.dropout((midi_time * self.scale_time) + pos_time)
+        #pos_time = [1, n_frame, hid_dim] (1, 128, 256)
         #midi_time = [batch_size*n_note, n_frame, hid_dim] (8*88, 128, 256)
         #print('Decoder_SPEC2MIDI(4) pos_time: '+str(pos_time.shape))
         #print('Decoder_SPEC2MIDI(4) midi_time: '+str(midi_time.shape))
@@ -200,10 +267,18 @@ class Decoder_SPEC2MIDI(nn.Module):
         #print('Decoder_SPEC2MIDI(5) midi_time: '+str(midi_time.shape))
 
         ## output(time)
-        output_onset_time = self.sigmoid(self.fc_onset_time(midi_time).reshape([batch_size, self.n_note, self.n_frame]).permute(0, 2, 1).contiguous())
-        output_offset_time = self.sigmoid(self.fc_offset_time(midi_time).reshape([batch_size, self.n_note, self.n_frame]).permute(0, 2, 1).contiguous())
-        output_mpe_time = self.sigmoid(self.fc_mpe_time(midi_time).reshape([batch_size, self.n_note, self.n_frame]).permute(0, 2, 1).contiguous())
-        output_velocity_time = self.fc_velocity_time(midi_time).reshape([batch_size, self.n_note, self.n_frame, self.n_velocity]).permute(0, 2, 1, 3).contiguous()
+        output_onset_time = self.fc_onset_time(midi_time).reshape([batch_size, self.n_note, self.n_frame]).permute(0, 2, 1).contiguous()
+        output_offset_time = self.fc_offset_time(midi_time).reshape([batch_size, self.n_note, self.n_frame]).permute(0, 2, 1).contiguous()
+        output_mpe_time = self.fc_mpe_time(midi_time).reshape([batch_size, self.n_note, self.n_frame]).permute(0, 2, 1).contiguous()
+        if logits is False:
+            output_onset_time = self.sigmoid(output_onset_time)
+            output_offset_time = self.sigmoid(output_offset_time)
+            output_mpe_time = self.sigmoid(output_mpe_time)
+        if (output_stage == '2nd') and (thred_onset is not None):
+            midi_velocity = midi_time.reshape([batch_size, self.n_note, self.n_frame, self.hid_dim]).permute(0, 2, 1, 3)
+            output_velocity_time = self.velocity_sparse(self.fc_velocity_time, midi_velocity, output_onset_time >= thred_onset)
+        else:
+            output_velocity_time = self.fc_velocity_time(midi_time).reshape([batch_size, self.n_note, self.n_frame, self.n_velocity]).permute(0, 2, 1, 3).contiguous()
         #output_onset_time = [batch_size, n_frame, n_note] (8, 128, 88)
         #output_offset_time = [batch_size, n_frame, n_note] (8, 128, 88)
         #output_mpe_time = [batch_size, n_frame, n_note] (8, 128, 88)
@@ -212,9 +287,20 @@ class Decoder_SPEC2MIDI(nn.Module):
         #print('Decoder_SPEC2MIDI(6) output_offset_time: '+str(output_offset_time.shape))
         #print('Decoder_SPEC2MIDI(6) output_mpe_time: '+str(output_mpe_time.shape))
         #print('Decoder_SPEC2MIDI(6) output_velocity_time: '+str(output_velocity_time.shape))
+        if output_stage == '2nd':
+            return output_onset_time, output_offset_time, output_mpe_time, output_velocity_time
 
         return output_onset_freq, output_offset_freq, output_mpe_freq, output_velocity_freq, attention_freq, output_onset_time, output_offset_time, output_mpe_time, output_velocity_time
 
+    def velocity_sparse(self, fc_velocity, midi_velocity, flag_onset):
+        #midi_velocity = [batch_size, n_frame, n_note, hid_dim]
+        #flag_onset = [batch_size, n_frame, n_note] (positions to evaluate)
+        #output_velocity = [batch_size, n_frame, n_note] (argmax, 0 elsewhere)
+        idx = flag_onset.nonzero(as_tuple=True)
+        output_velocity = torch.zeros(flag_onset.shape, dtype=torch.long, device=flag_onset.device)
+        output_velocity[idx] = fc_velocity(midi_velocity[idx]).argmax(-1)
+        return output_velocity
+
 
 ##
 ## sub functions
@@ -231,7 +317,7 @@ class EncoderLayer(nn.Module):
         #src = [batch_size, src_len, hid_dim]
 
         #self attention
-        _src, _ = self.self_attention(src, src, src)
+        _src, _ = self.self_attention(src, src, src, need_weights=False)
         #dropout, residual connection and layer norm
         src = self.layer_norm(src + self.dropout(_src))
         #src = [batch_size, src_len, hid_dim]
@@ -252,12 +338,13 @@ class DecoderLayer_Zero(nn.Module):
         self.positionwise_feedforward = PositionwiseFeedforwardLayer(hid_dim, pf_dim, dropout)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, enc_src, trg):
+    def forward(self, enc_src, trg, need_weights=True):
         #trg = [batch_size, trg_len, hid_dim]
         #enc_src = [batch_size, src_len, hid_dim]
+        #need_weights: False -> attention is None
 
         #encoder attention
-        _trg, attention = self.encoder_attention(trg, enc_src, enc_src)
+        _trg, attention = self.encoder_attention(trg, enc_src, enc_src, need_weights=need_weights)
         #dropout, residual connection and layer norm
         trg = self.layer_norm(trg + self.dropout(_trg))
         #trg = [batch_size, trg_len, hid_dim]
@@ -280,18 +367,19 @@ class DecoderLayer(nn.Module):
         self.positionwise_feedforward = PositionwiseFeedforwardLayer(hid_dim, pf_dim, dropout)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, enc_src, trg):
+    def forward(self, enc_src, trg, need_weights=True):
         #trg = [batch_size, trg_len, hid_dim]
         #enc_src = [batch_size, src_len, hid_dim]
+        #need_weights: False -> attention is None
 
         #self attention
-        _trg, _ = self.self_attention(trg, trg, trg)
+        _trg, _ = self.self_attention(trg, trg, trg, need_weights=False)
         #dropout, residual connection and layer norm
         trg = self.layer_norm(trg + self.dropout(_trg))
         #trg = [batch_size, trg_len, hid_dim]
 
         #encoder attention
-        _trg, attention = self.encoder_attention(trg, enc_src, enc_src)
+        _trg, attention = self.encoder_attention(trg, enc_src, enc_src, need_weights=need_weights)
         #dropout, residual connection and layer norm
         trg = self.layer_norm(trg + self.dropout(_trg))
         #trg = [batch_size, trg_len, hid_dim]
@@ -319,11 +407,12 @@ class MultiHeadAttentionLayer(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.scale = torch.sqrt(torch.FloatTensor([self.head_dim])).to(device)
 
-    def forward(self, query, key, value):
+    def forward(self, query, key, value, need_weights=True):
         batch_size = query.shape[0]
         #query = [batch_size, query_len, hid_dim]
         #key = [batch_size, key_len, hid_dim]
         #value = [batch_size, value_len, hid_dim]
+        #need_weights: False -> attention is None (fused kernel if flag_fused_attention)
 
         Q = self.fc_q(query)
         K = self.fc_k(key)
@@ -339,13 +428,20 @@ class MultiHeadAttentionLayer(nn.Module):
         #K = [batch_size, n_heads, key_len, head_dim]
         #V = [batch_size, n_heads, value_len, head_dim]
 
-        energy = torch.matmul(Q, K.permute(0, 1, 3, 2)) / self.scale
-        #energy = [batch_size, n_heads, seq len, seq len]
+        if (need_weights is False) and (flag_fused_attention is True):
+            # [query_len, key_len] intermediates are not materialized
+            x = F.scaled_dot_product_attention(Q, K, V, dropout_p=self.dropout.p if self.training else 0.0)
+            attention = None
+        else:
+            energy = torch.matmul(Q, K.permute(0, 1, 3, 2)) / self.scale
+            #energy = [batch_size, n_heads, seq len, seq len]
 
-        attention = torch.softmax(energy, dim = -1)
-        #attention = [batch_size, n_heads, query_len, key_len]
+            attention = torch.softmax(energy, dim = -1)
+            #attention = [batch_size, n_heads, query_len, key_len]
 
-        x = torch.matmul(self.dropout(attention), V)
+            x = torch.matmul(self.dropout(attention), V)
+            if need_weights is False:
+                attention = None
         #x = [batch_size, n_heads, seq len, head_dim]
 
         x = x.permute(0, 2, 1, 3).contiguous()
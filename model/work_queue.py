@@ -0,0 +1,118 @@
+#! python
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+##
+## work queue shared by several workers (boxes) through an SQLite file
+##
+class Work_Queue():
+    # item: file name, state: todo -> running -> done|failed
+    #  a worker claims a 'todo' item (or a 'running' item whose lease has
+    #  expired, i.e. its worker stopped sending heartbeats) in one transaction
+    #  a failed item (or an expired one) goes back to 'todo' until it has been tried max_try times
+    # (f_db should be on a file system with working POSIX locks, e.g. a local
+    #  disk or NFS with locking enabled)
+    def __init__(self, f_db, lease=600.0, max_try=3, worker=None):
+        self.f_db = f_db
+        self.lease = lease
+        self.max_try = max_try
+        if worker is None:
+            worker = socket.gethostname() + ':' + str(os.getpid())
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.a_running = set()
+        self.conn = sqlite3.connect(f_db, timeout=60.0, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS item ('
+                              'fname TEXT PRIMARY KEY, state TEXT NOT NULL, worker TEXT, '
+                              'lease_until REAL, n_try INTEGER NOT NULL DEFAULT 0, error TEXT)')
+        self.thread_heartbeat = None
+        self.event_stop = threading.Event()
+
+    def add(self, a_fname):
+        # items already in the queue are kept as they are (every worker can add the same list)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany("INSERT OR IGNORE INTO item (fname, state) VALUES (?, 'todo')",
+                                  [(fname,) for fname in a_fname])
+            self.conn.execute('COMMIT')
+
+    def claim(self):
+        # return: file name (None if there is nothing left to claim)
+        with self.lock:
+            now = time.time()
+            self.conn.execute('BEGIN IMMEDIATE')
+            # (an item whose worker died max_try times, e.g. out of memory, is not claimed again)
+            self.conn.execute("UPDATE item SET state = 'failed', lease_until = NULL, error = 'lease expired' "
+                              "WHERE state = 'running' AND lease_until < ? AND n_try >= ?", (now, self.max_try))
+            row = self.conn.execute("SELECT fname FROM item WHERE state = 'todo' "
+                                    "OR (state = 'running' AND lease_until < ? AND n_try < ?) "
+                                    "ORDER BY state DESC, n_try LIMIT 1", (now, self.max_try)).fetchone()
+            if row is None:
+                self.conn.execute('COMMIT')
+                return None
+            self.conn.execute("UPDATE item SET state = 'running', worker = ?, lease_until = ?, n_try = n_try + 1 "
+                              "WHERE fname = ?", (self.worker, now + self.lease, row[0]))
+            self.conn.execute('COMMIT')
+            self.a_running.add(row[0])
+        return row[0]
+
+    def heartbeat(self):
+        # extend the lease of the items this worker is running
+        with self.lock:
+            if len(self.a_running) == 0:
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany("UPDATE item SET lease_until = ? WHERE fname = ? AND worker = ? AND state = 'running'",
+                                  [(time.time() + self.lease, fname, self.worker) for fname in self.a_running])
+            self.conn.execute('COMMIT')
+
+    def done(self, fname):
+        # (also accepted after the item has been stolen by another worker)
+        with self.lock:
+            self.conn.execute("UPDATE item SET state = 'done', worker = ?, lease_until = NULL, error = NULL "
+                              "WHERE fname = ?", (self.worker, fname))
+            self.a_running.discard(fname)
+
+    def fail(self, fname, error=None):
+        # (ignored once the item has been claimed by another worker)
+        with self.lock:
+            self.conn.execute("UPDATE item SET state = CASE WHEN n_try >= ? THEN 'failed' ELSE 'todo' END, "
+                              "lease_until = NULL, error = ? WHERE fname = ? AND worker = ? AND state = 'running'",
+                              (self.max_try, None if error is None else str(error), fname, self.worker))
+            self.a_running.discard(fname)
+
+    def status(self):
+        # return: {state: number of items}
+        with self.lock:
+            a_row = self.conn.execute('SELECT state, COUNT(*) FROM item GROUP BY state').fetchall()
+        return {state: num for state, num in a_row}
+
+    def start_heartbeat(self, interval=None):
+        # heartbeat from a background thread every `interval` sec (lease/4)
+        if interval is None:
+            interval = self.lease / 4
+        def loop():
+            while not self.event_stop.wait(interval):
+                try:
+                    self.heartbeat()
+                except sqlite3.OperationalError as e:
+                    print('heartbeat failed: ' + str(e))
+        self.thread_heartbeat = threading.Thread(target=loop, daemon=True)
+        self.thread_heartbeat.start()
+
+    def close(self):
+        self.event_stop.set()
+        if self.thread_heartbeat is not None:
+            self.thread_heartbeat.join()
+        with self.lock:
+            # items this worker could not finish are released for the others
+            for fname in list(self.a_running):
+                self.conn.execute("UPDATE item SET state = 'todo', lease_until = NULL "
+                                  "WHERE fname = ? AND worker = ? AND state = 'running'", (fname, self.worker))
+            self.a_running.clear()
+            self.conn.close()
@@ -0,0 +1,139 @@
+#! python
+
+import os
+import sys
+import argparse
+import copy
+import time
+import json
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import train
+import dataset
+sys.path.append(os.getcwd())
+from model.model_spec2midi import *
+
+##
+## mixed precision training parity: float32 vs amp from the same initial weights,
+## on the same batches (loss curves and time/step)
+## (both runs use BCEWithLogitsLoss, as m_training.py with -amp)
+##
+def run_steps(model, a_batch, amp, device, args):
+    # return: [loss of each step], sec/step
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    scaler = None
+    if amp == 'fp16':
+        if hasattr(torch.amp, 'GradScaler'):
+            scaler = torch.amp.GradScaler(device)
+        else:
+            scaler = torch.cuda.amp.GradScaler()
+    criterion_bce = nn.BCEWithLogitsLoss()
+    criterion_ce = nn.CrossEntropyLoss()
+
+    a_loss = []
+    time_s = time.time()
+    for i in range(args.n_step):
+        # (one batch per step, so that a_loss is a curve, not an epoch mean)
+        a_loss.append(train.train(model, [a_batch[i % len(a_batch)]], optimizer,
+                                  criterion_bce, criterion_bce, criterion_bce, criterion_ce,
+                                  criterion_bce, criterion_bce, criterion_bce, criterion_ce,
+                                  args.weight_A, args.weight_B,
+                                  device, False, amp=amp, scaler=scaler, logits=True))
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return a_loss, (time.time() - time_s) / args.n_step
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', help='config json file', default='config.json')
+    parser.add_argument('-d_dataset', help='dataset directory', default='./dataset')
+    parser.add_argument('-f_split', help='dataset split to train on(train)', default='train')
+    parser.add_argument('-n_slice', help='dataset slice(16)', type=int, default=16)
+    parser.add_argument('-amp', help='mixed precision (fp16|bf16)(fp16 on cuda, bf16 on cpu)', default=None)
+    parser.add_argument('-n_step', help='number of training steps(50)', type=int, default=50)
+    parser.add_argument('-n_batch', help='number of distinct batches, reused cyclically(10)', type=int, default=10)
+    parser.add_argument('-batch', help='batch size(8)', type=int, default=8)
+    parser.add_argument('-lr', help='learning rate(1e-04)', type=float, default=1e-4)
+    parser.add_argument('-seed', type=int, default=1234, help='seed value(1234)')
+    parser.add_argument('-cnn_channel', help='number of cnn channel(4)', type=int, default=4)
+    parser.add_argument('-cnn_kernel', help='number of cnn kernel(5)', type=int, default=5)
+    parser.add_argument('-hid_dim', help='size of hidden layer(256)', type=int, default=256)
+    parser.add_argument('-pf_dim', help='size of position-wise feed-forward layer(512)', type=int, default=512)
+    parser.add_argument('-enc_layer', help='number of layer of transformer(encoder)(3)', type=int, default=3)
+    parser.add_argument('-dec_layer', help='number of layer of transformer(decoder)(3)', type=int, default=3)
+    parser.add_argument('-enc_head', help='number of head of transformer(encoder)(4)', type=int, default=4)
+    parser.add_argument('-dec_head', help='number of head of transformer(decoder)(4)', type=int, default=4)
+    parser.add_argument('-weight_A', help='loss weight for 1st output(1.0)', type=float, default=1.0)
+    parser.add_argument('-weight_B', help='loss weight for 2nd output(1.0)', type=float, default=1.0)
+    parser.add_argument('-f_report', help='report file (json)', default=None)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.amp is None:
+        args.amp = 'fp16' if device == 'cuda' else 'bf16'
+
+    print('** AMT(SPEC2MIDI) mixed precision training check **')
+    print(' config file      : '+str(args.config))
+    print(' dataset          : '+str(args.d_dataset)+' ('+str(args.f_split)+')')
+    print(' device           : '+str(device))
+    print(' amp              : '+str(args.amp))
+    print(' steps            : '+str(args.n_step))
+    print(' batch            : '+str(args.batch))
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    # batches (fixed, the same for both runs)
+    d_dataset = args.d_dataset.rstrip('/')
+    dataset_train = dataset.MyDataset(d_dataset+'/feature/'+args.f_split+'.pkl',
+                                      d_dataset+'/label_onset/'+args.f_split+'.pkl',
+                                      d_dataset+'/label_offset/'+args.f_split+'.pkl',
+                                      d_dataset+'/label_mpe/'+args.f_split+'.pkl',
+                                      d_dataset+'/label_velocity/'+args.f_split+'.pkl',
+                                      d_dataset+'/idx/'+args.f_split+'.pkl',
+                                      config,
+                                      args.n_slice)
+    torch.manual_seed(args.seed)
+    a_batch = []
+    for batch in torch.utils.data.DataLoader(dataset_train, batch_size=args.batch, shuffle=True):
+        a_batch.append(batch)
+        if len(a_batch) >= args.n_batch:
+            break
+
+    # model (same initial weights for both runs)
+    torch.manual_seed(args.seed)
+    encoder = Encoder_SPEC2MIDI(config['input']['margin_b'], config['input']['num_frame'], config['feature']['n_bins'],
+                                args.cnn_channel, args.cnn_kernel, args.hid_dim, args.enc_layer, args.enc_head, args.pf_dim, 0.0, device)
+    decoder = Decoder_SPEC2MIDI(config['input']['num_frame'], config['feature']['n_bins'], config['midi']['num_note'], config['midi']['num_velocity'],
+                                args.hid_dim, args.dec_layer, args.dec_head, args.pf_dim, 0.0, device)
+    model = Model_SPEC2MIDI(encoder, decoder).to(device)
+    for m in model.modules():
+        if hasattr(m, 'weight') and (m.weight is not None) and (m.weight.dim() > 1):
+            nn.init.xavier_uniform_(m.weight.data)
+
+    # (dropout is 0, so that the two runs differ only in precision)
+    a_result = {}
+    for name, amp in [('float32', None), (args.amp, args.amp)]:
+        a_loss, time_step = run_steps(copy.deepcopy(model), a_batch, amp, device, args)
+        a_result[name] = {'loss': a_loss, 'sec/step': time_step}
+
+    a_loss_fp32 = a_result['float32']['loss']
+    a_loss_amp = a_result[args.amp]['loss']
+    a_diff = [abs(l_amp - l_fp32) / max(abs(l_fp32), 1e-9) for l_fp32, l_amp in zip(a_loss_fp32, a_loss_amp)]
+
+    print('** loss (float32 -> '+args.amp+') **')
+    for i in range(0, args.n_step, max(args.n_step // 10, 1)):
+        print(' step '+str(i).rjust(5)+'   : '+str(a_loss_fp32[i])+' -> '+str(a_loss_amp[i]))
+    if (args.n_step-1) % max(args.n_step // 10, 1) != 0:
+        print(' step '+str(args.n_step-1).rjust(5)+'   : '+str(a_loss_fp32[-1])+' -> '+str(a_loss_amp[-1]))
+    print(' rel diff (mean)  : '+str(sum(a_diff) / len(a_diff)))
+    print(' rel diff (max)   : '+str(max(a_diff)))
+    print(' sec/step         : '+str(a_result['float32']['sec/step'])+' -> '+str(a_result[args.amp]['sec/step']))
+    if args.f_report is not None:
+        with open(args.f_report, 'w', encoding='utf-8') as f:
+            json.dump(a_result, f, ensure_ascii=False, indent=4, sort_keys=False)
+    print('** done **')
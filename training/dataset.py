@@ -1,30 +1,54 @@
 #! python
 
+import os
+import json
 import torch
 import pickle
+import numpy as np
+
+def load_array(f_array, fmt='pkl'):
+    # f_array: <name>.pkl
+    # fmt npy (corpus/make_dataset.py -format npy): <name>.npy is used instead,
+    # memory-mapped copy-on-write, so windows are read from the page cache on demand
+    # and the pages are shared by the DataLoader workers
+    if fmt == 'npy':
+        return np.load(os.path.splitext(f_array)[0] + '.npy', mmap_mode='c')
+    with open(f_array, 'rb') as f:
+        return pickle.load(f)
+
+
+def check_header(f_idx, config):
+    # <d_dataset>/<name>.json written by corpus/make_dataset.py: the layout must match config
+    # return: format of the arrays (pkl|npy) (pkl without the header, i.e. older datasets)
+    f_header = os.path.dirname(os.path.dirname(os.path.abspath(f_idx))) + '/' + os.path.splitext(os.path.basename(f_idx))[0] + '.json'
+    if not os.path.exists(f_header):
+        return 'pkl'
+    with open(f_header, 'r', encoding='utf-8') as f:
+        a_header = json.load(f)
+    for key in ['margin_b', 'margin_f', 'num_frame']:
+        if a_header[key] != config['input'][key]:
+            raise ValueError(f_header+': '+key+' '+str(a_header[key])+' != config '+str(config['input'][key]))
+    return a_header.get('format', 'pkl')
+
 
 class MyDataset(torch.utils.data.Dataset):
     def __init__(self, f_feature, f_label_onset, f_label_offset, f_label_mpe, f_label_velocity, f_idx, config, n_slice):
         super().__init__()
 
-        with open(f_feature, 'rb') as f:
-            feature = pickle.load(f)
+        fmt = check_header(f_idx, config)
+        feature = load_array(f_feature, fmt)
 
-        with open(f_label_onset, 'rb') as f:
-            label_onset = pickle.load(f)
-        with open(f_label_offset, 'rb') as f:
-            label_offset = pickle.load(f)
-        with open(f_label_mpe, 'rb') as f:
-            label_mpe = pickle.load(f)
+        label_onset = load_array(f_label_onset, fmt)
+        label_offset = load_array(f_label_offset, fmt)
+        label_mpe = load_array(f_label_mpe, fmt)
         if f_label_velocity is not None:
             self.flag_velocity = True
-            with open(f_label_velocity, 'rb') as f:
-                label_velocity = pickle.load(f)
+            label_velocity = load_array(f_label_velocity, fmt)
         else:
             self.flag_velocity = False
 
-        with open(f_idx, 'rb') as f:
-            idx = pickle.load(f)
+        # (idx is small, always read into memory)
+        idx = np.array(load_array(f_idx, fmt))
 
         self.feature = torch.from_numpy(feature)
         self.label_onset = torch.from_numpy(label_onset)
@@ -57,6 +57,8 @@ if __name__ == '__main__':
     parser.add_argument('-weight_A', help='loss weight for 1st output(1.0)', type=float, default=1.0)
     parser.add_argument('-weight_B', help='loss weight for 2nd output(1.0)', type=float, default=1.0)
     parser.add_argument('-valid_test', help='validation with test data', action='store_true')
+    parser.add_argument('-amp', help='mixed precision (none|fp16|bf16)(none)', default='none')
+    parser.add_argument('-bce_logits', help='BCEWithLogitsLoss for onset/offset/mpe (always with -amp)', action='store_true')
     parser.add_argument('-v', help='verbose(print debug)', action='store_true')
     args = parser.parse_args()
 
@@ -76,6 +78,7 @@ if __name__ == '__main__':
     print('  dropout         : '+str(args.dropout))
     print('  clip            : '+str(args.clip))
     print('  seed            : '+str(args.seed))
+    print('  amp             : '+str(args.amp))
     print('  validation')
     print('   valid data     : True')
     print('   test data      : '+str(args.valid_test))
@@ -143,14 +146,28 @@ if __name__ == '__main__':
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer)
 
-    criterion_onset_A = nn.BCELoss()
-    criterion_offset_A = nn.BCELoss()
-    criterion_mpe_A = nn.BCELoss()
+    # mixed precision: BCELoss on sigmoid outputs is not autocast safe,
+    # the model returns logits for BCEWithLogitsLoss instead
+    amp = None if args.amp == 'none' else args.amp
+    flag_logits = (args.bce_logits is True) or (amp is not None)
+    scaler = None
+    if amp == 'fp16':
+        # loss scaling (small fp16 gradients underflow)
+        if hasattr(torch.amp, 'GradScaler'):
+            scaler = torch.amp.GradScaler(device)
+        else:
+            scaler = torch.cuda.amp.GradScaler()
+    print(' bce logits       : '+str(flag_logits))
+    criterion_bce = nn.BCEWithLogitsLoss if flag_logits is True else nn.BCELoss
+
+    criterion_onset_A = criterion_bce()
+    criterion_offset_A = criterion_bce()
+    criterion_mpe_A = criterion_bce()
     criterion_velocity_A = nn.CrossEntropyLoss()
 
-    criterion_onset_B = nn.BCELoss()
-    criterion_offset_B = nn.BCELoss()
-    criterion_mpe_B = nn.BCELoss()
+    criterion_onset_B = criterion_bce()
+    criterion_offset_B = criterion_bce()
+    criterion_mpe_B = criterion_bce()
     criterion_velocity_B = nn.CrossEntropyLoss()
 
     d_out = args.d_out.rstrip('/')
@@ -174,6 +191,8 @@ if __name__ == '__main__':
             'dropout': args.dropout,
             'clip': args.clip,
             'seed': args.seed,
+            'amp': args.amp,
+            'bce_logits': flag_logits,
             'resume_epoch': args.resume_epoch,
             'resume_div': args.resume_div,
             'loss_weight': {
@@ -273,6 +292,8 @@ if __name__ == '__main__':
         #model = checkpoint['model']
         optimizer.load_state_dict(checkpoint['optimizer_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_dict'])
+        if (scaler is not None) and (checkpoint.get('scaler_dict') is not None):
+            scaler.load_state_dict(checkpoint['scaler_dict'])
         #random.setstate(checkpoint['random']['random'])
         torch.set_rng_state(checkpoint['random']['torch'])
         torch.random.set_rng_state(checkpoint['random']['torch_random'])
@@ -323,7 +344,7 @@ if __name__ == '__main__':
                                            criterion_onset_A, criterion_offset_A, criterion_mpe_A, criterion_velocity_A,
                                            criterion_onset_B, criterion_offset_B, criterion_mpe_B, criterion_velocity_B,
                                            args.weight_A, args.weight_B,
-                                           device, args.v)
+                                           device, args.v, amp=amp, scaler=scaler, logits=flag_logits)
 
             if args.n_div_train > 1:
                 del dataset_train, dataloader_train
@@ -348,7 +369,7 @@ if __name__ == '__main__':
                                          criterion_onset_A, criterion_offset_A, criterion_mpe_A, criterion_velocity_A,
                                          criterion_onset_B, criterion_offset_B, criterion_mpe_B, criterion_velocity_B,
                                          args.weight_A, args.weight_B,
-                                         device)
+                                         device, amp=amp, logits=flag_logits)
                     epoch_loss_valid += retval[0]
                     num_data_valid += retval[1]
                     del dataset_valid, dataloader_valid
@@ -357,7 +378,7 @@ if __name__ == '__main__':
                                                                criterion_onset_A, criterion_offset_A, criterion_mpe_A, criterion_velocity_A,
                                                                criterion_onset_B, criterion_offset_B, criterion_mpe_B, criterion_velocity_B,
                                                                args.weight_A, args.weight_B,
-                                                               device)
+                                                               device, amp=amp, logits=flag_logits)
             epoch_loss_valid /= num_data_valid
 
             # (7-3) test
@@ -381,7 +402,7 @@ if __name__ == '__main__':
                                              criterion_onset_freq, criterion_offset_freq, criterion_mpe_freq, criterion_velocity_freq,
                                              criterion_onset_time, criterion_offset_time, criterion_mpe_time, criterion_velocity_time,
                                              args.weight_A, args.weight_B,
-                                             device)
+                                             device, amp=amp, logits=flag_logits)
                         epoch_loss_test += retval[0]
                         num_data_test += retval[1]
                         del dataset_test, dataloader_test
@@ -390,7 +411,7 @@ if __name__ == '__main__':
                                                                  criterion_onset_A, criterion_offset_A, criterion_mpe_A, criterion_velocity_A,
                                                                  criterion_onset_B, criterion_offset_B, criterion_mpe_B, criterion_velocity_B,
                                                                  args.weight_A, args.weight_B,
-                                                                 device)
+                                                                 device, amp=amp, logits=flag_logits)
                 epoch_loss_test /= num_data_test
             else:
                 epoch_loss_test = 0.0
@@ -414,6 +435,7 @@ if __name__ == '__main__':
                 'best_loss_valid': best_loss_valid,
                 'optimizer_dict': optimizer.state_dict(),
                 'scheduler_dict': scheduler.state_dict(),
+                'scaler_dict': scaler.state_dict() if scaler is not None else None,
                 'model_dict': model.state_dict(),
                 'random': {
                     'torch': torch.get_rng_state(),
@@ -443,6 +465,7 @@ if __name__ == '__main__':
                     'best_loss_valid': best_loss_valid,
                     'optimizer_dict': optimizer.state_dict(),
                     'scheduler_dict': scheduler.state_dict(),
+                    'scaler_dict': scaler.state_dict() if scaler is not None else None,
                     'model_dict': model.state_dict(),
                     'random': {
                         'torch': torch.get_rng_state(),
@@ -1,7 +1,21 @@
 #! python
 
+import contextlib
 import torch
 
+##
+## mixed precision
+##
+a_amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def autocast(device, amp):
+    # amp: None (float32) | 'fp16' | 'bf16'
+    # (the losses stay in float32 under autocast: BCEWithLogitsLoss, CrossEntropyLoss)
+    if amp is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device, dtype=a_amp_dtype[amp])
+
+
 ##
 ## train
 ##
@@ -9,7 +23,9 @@ def train(model, iterator, optimizer,
           criterion_onset_A, criterion_offset_A, criterion_mpe_A, criterion_velocity_A,
           criterion_onset_B, criterion_offset_B, criterion_mpe_B, criterion_velocity_B,
           weight_A, weight_B,
-          device, verbose_flag):
+          device, verbose_flag, amp=None, scaler=None, logits=False):
+    # amp: None | 'fp16' | 'bf16' (autocast), scaler: GradScaler (fp16)
+    # logits: onset/offset/mpe criteria take logits (BCEWithLogitsLoss, required with amp)
     model.train()
     epoch_loss = 0
     
@@ -32,7 +48,8 @@ def train(model, iterator, optimizer,
             print(label_velocity)
 
         optimizer.zero_grad()
-        output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = model(input_spec)
+        with autocast(device, amp):
+            output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = model(input_spec, logits=logits)
         # output_onset_A: [batch_size, n_frame, n_note] (8, 128, 88)
         # output_onset_B: [batch_size, n_frame, n_note] (8, 128, 88)
         # output_velocity_A: [batch_size, n_frame, n_note, n_velocity] (8, 128, 88, 128)
@@ -83,25 +100,32 @@ def train(model, iterator, optimizer,
             print('(4) label_velocity   :'+str(label_velocity.size()))
             print(label_velocity)
 
-        loss_onset_A = criterion_onset_A(output_onset_A, label_onset)
-        loss_offset_A = criterion_offset_A(output_offset_A, label_offset)
-        loss_mpe_A = criterion_mpe_A(output_mpe_A, label_mpe)
-        loss_velocity_A = criterion_velocity_A(output_velocity_A, label_velocity)
-        loss_A = loss_onset_A + loss_offset_A + loss_mpe_A + loss_velocity_A
+        with autocast(device, amp):
+            loss_onset_A = criterion_onset_A(output_onset_A, label_onset)
+            loss_offset_A = criterion_offset_A(output_offset_A, label_offset)
+            loss_mpe_A = criterion_mpe_A(output_mpe_A, label_mpe)
+            loss_velocity_A = criterion_velocity_A(output_velocity_A, label_velocity)
+            loss_A = loss_onset_A + loss_offset_A + loss_mpe_A + loss_velocity_A
 
-        loss_onset_B = criterion_onset_B(output_onset_B, label_onset)
-        loss_offset_B = criterion_offset_B(output_offset_B, label_offset)
-        loss_mpe_B = criterion_mpe_B(output_mpe_B, label_mpe)
-        loss_velocity_B = criterion_velocity_B(output_velocity_B, label_velocity)
-        loss_B = loss_onset_B + loss_offset_B + loss_mpe_B + loss_velocity_B
+            loss_onset_B = criterion_onset_B(output_onset_B, label_onset)
+            loss_offset_B = criterion_offset_B(output_offset_B, label_offset)
+            loss_mpe_B = criterion_mpe_B(output_mpe_B, label_mpe)
+            loss_velocity_B = criterion_velocity_B(output_velocity_B, label_velocity)
+            loss_B = loss_onset_B + loss_offset_B + loss_mpe_B + loss_velocity_B
 
-        loss = weight_A * loss_A + weight_B * loss_B
+            loss = weight_A * loss_A + weight_B * loss_B
         if verbose_flag is True:
             print('(5) loss:'+str(loss.size()))
             print(loss)
 
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            # (steps with inf/nan gradients are skipped, and the scale is reduced)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
         epoch_loss += loss.item()
 
     return epoch_loss / len(iterator)
@@ -114,7 +138,7 @@ def valid(model, iterator,
           criterion_onset_A, criterion_offset_A, criterion_mpe_A, criterion_velocity_A,
           criterion_onset_B, criterion_offset_B, criterion_mpe_B, criterion_velocity_B,
           weight_A, weight_B,
-          device):
+          device, amp=None, logits=False):
     model.eval()
     epoch_loss = 0
     
@@ -126,7 +150,8 @@ def valid(model, iterator,
             label_mpe = label_mpe.to(device, non_blocking=True)
             label_velocity = label_velocity.to(device, non_blocking=True)
 
-            output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = model(input_spec)
+            with autocast(device, amp):
+                output_onset_A, output_offset_A, output_mpe_A, output_velocity_A, attention, output_onset_B, output_offset_B, output_mpe_B, output_velocity_B = model(input_spec, logits=logits)
 
             output_onset_A = output_onset_A.contiguous().view(-1)
             output_offset_A = output_offset_A.contiguous().view(-1)
@@ -145,19 +170,20 @@ def valid(model, iterator,
             label_mpe = label_mpe.contiguous().view(-1)
             label_velocity = label_velocity.contiguous().view(-1)
 
-            loss_onset_A = criterion_onset_A(output_onset_A, label_onset)
-            loss_offset_A = criterion_offset_A(output_offset_A, label_offset)
-            loss_mpe_A = criterion_mpe_A(output_mpe_A, label_mpe)
-            loss_velocity_A = criterion_velocity_A(output_velocity_A, label_velocity)
-            loss_A = loss_onset_A + loss_offset_A + loss_mpe_A + loss_velocity_A
+            with autocast(device, amp):
+                loss_onset_A = criterion_onset_A(output_onset_A, label_onset)
+                loss_offset_A = criterion_offset_A(output_offset_A, label_offset)
+                loss_mpe_A = criterion_mpe_A(output_mpe_A, label_mpe)
+                loss_velocity_A = criterion_velocity_A(output_velocity_A, label_velocity)
+                loss_A = loss_onset_A + loss_offset_A + loss_mpe_A + loss_velocity_A
 
-            loss_onset_B = criterion_onset_B(output_onset_B, label_onset)
-            loss_offset_B = criterion_offset_B(output_offset_B, label_offset)
-            loss_mpe_B = criterion_mpe_B(output_mpe_B, label_mpe)
-            loss_velocity_B = criterion_velocity_B(output_velocity_B, label_velocity)
-            loss_B = loss_onset_B + loss_offset_B + loss_mpe_B + loss_velocity_B
+                loss_onset_B = criterion_onset_B(output_onset_B, label_onset)
+                loss_offset_B = criterion_offset_B(output_offset_B, label_offset)
+                loss_mpe_B = criterion_mpe_B(output_mpe_B, label_mpe)
+                loss_velocity_B = criterion_velocity_B(output_velocity_B, label_velocity)
+                loss_B = loss_onset_B + loss_offset_B + loss_mpe_B + loss_velocity_B
 
-            loss = weight_A * loss_A + weight_B * loss_B
+                loss = weight_A * loss_A + weight_B * loss_B
 
             epoch_loss += loss.item()
 